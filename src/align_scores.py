@@ -1,21 +1,26 @@
 """Align scores to recordings."""
 import argparse
 import csv
-import datetime
 import logging
+import os
 import pathlib
 import sys
+import tempfile
 
-import librosa
-import librosa.display
-import librosa.sequence
-import matplotlib
-import matplotlib.pyplot as plt
 import numpy as np
-import scipy.spatial.distance
-import tqdm
+import soundfile as sf
 
-REF_DATE = datetime.datetime.fromisoformat("2000-01-01T00:00")
+import audio_store
+import dtw
+import instrumentation
+import parallel
+import warping
+from cache import Cache, hash_file, make_key
+from manifest import Manifest, record, select_stale
+
+# Version of the feature extraction, to be increased whenever it changes so
+# that the cached features get invalidated
+CACHE_VERSION = 2
 
 
 def parse_args(args=None, namespace=None):
@@ -52,15 +57,82 @@ def parse_args(args=None, namespace=None):
         default=3,
         help="number of bins per note for CQT",
     )
+    parser.add_argument(
+        "-d", "--dtw", choices=dtw.ENGINES, default="full", help="DTW engine"
+    )
+    parser.add_argument(
+        "--dtw_radius",
+        type=int,
+        help="radius of the search band or window in frames for the band, "
+        "multiscale and online DTW engines",
+    )
+    parser.add_argument(
+        "--dtw_threads",
+        type=int,
+        help="number of threads for the full DTW engine (default: the "
+        "number of cores divided by the number of worker processes)",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=pathlib.Path,
+        help="cache directory for the spectrograms",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=float,
+        help="maximum size of the cache in MB (default: no limit)",
+    )
     parser.add_argument(
         "-p", "--save_plot", action="store_true", help="save alignment plots"
     )
+    parser.add_argument(
+        "--defer_plots",
+        action="store_true",
+        help="whether to save the plots after all alignments are done",
+    )
+    parser.add_argument(
+        "--plot_jobs",
+        type=int,
+        help="number of worker processes for the deferred plots (default: "
+        "same as `jobs`)",
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="number of worker processes"
+    )
+    parser.add_argument(
+        "--largest_first",
+        action="store_true",
+        help="whether to process the longest movements first",
+    )
     parser.add_argument(
         "-s",
         "--skip_existing",
         action="store_true",
         help="whether to skip existing files",
     )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="whether to rebuild only the rows whose inputs or parameters "
+        "have changed",
+    )
+    parser.add_argument(
+        "--report",
+        type=pathlib.Path,
+        help="filename of the JSON or CSV report of the timings and peak "
+        "memory of each row",
+    )
+    parser.add_argument(
+        "--profile_dir",
+        type=pathlib.Path,
+        help="directory to save the cProfile statistics of the slowest rows",
+    )
+    parser.add_argument(
+        "--profile_slowest",
+        type=int,
+        default=5,
+        help="number of slowest rows to save the cProfile statistics for",
+    )
     parser.add_argument(
         "-q", "--quiet", action="store_true", help="show warnings only"
     )
@@ -78,14 +150,20 @@ def read_csv(filename):
     return data
 
 
-def sec2datetime(sec):
-    """Convert second to datetime."""
-    return REF_DATE + datetime.timedelta(seconds=sec)
+def sec2num(sec):
+    """Convert second(s) to number."""
+    import matplotlib.dates
+
+    ref_date = matplotlib.dates.date2num(np.datetime64("2000-01-01"))
+    return ref_date + np.asarray(sec) / 86400
 
 
-def sec2num(sec):
-    """Convert second to number."""
-    return matplotlib.dates.date2num(sec2datetime(sec))
+def decimate(s, max_frames):
+    """Downsample a spectrogram to at most `max_frames` frames."""
+    factor = -(-s.shape[1] // max_frames)
+    if factor <= 1:
+        return s
+    return dtw.downsample(s, factor)
 
 
 def plot_alignment(
@@ -97,8 +175,18 @@ def plot_alignment(
     bins_per_octave,
     filename=None,
     warp_path=None,
+    max_frames=1000,
 ):
-    """Plot the alignment result."""
+    """Plot the alignment result.
+
+    The spectrograms and the distance matrix are downsampled to at most
+    `max_frames` frames, which is about the resolution of the output image.
+
+    """
+    import matplotlib.dates
+    import matplotlib.pyplot as plt
+    import scipy.spatial.distance
+
     # Create figure
     gridspec = {"width_ratios": [1, 4], "height_ratios": [1, 4]}
     fig, axs = plt.subplots(2, 2, gridspec_kw=gridspec, figsize=(10, 10))
@@ -109,6 +197,7 @@ def plot_alignment(
     time_formatter = matplotlib.dates.DateFormatter("%M:%S")
     time_lim1 = (sec2num(0), sec2num(s1.shape[1] * hop_length / sr1))
     extent = (time_lim1[0], time_lim1[1], 0, len(s1))
+    s1 = decimate(s1, max_frames)
     axs[0, 1].imshow(
         s1,
         cmap="inferno",
@@ -135,6 +224,7 @@ def plot_alignment(
 
     time_lim2 = (sec2num(0), sec2num(s2.shape[1] * hop_length / sr2))
     extent2 = (0, len(s2), time_lim2[1], time_lim2[0])
+    s2 = decimate(s2, max_frames)
     axs[1, 0].imshow(
         s2.T,
         cmap="inferno",
@@ -189,8 +279,8 @@ def plot_alignment(
         fig.savefig(filename, bbox_inches="tight")
     if warp_path is not None:
         axs[1, 1].plot(
-            [sec2num(x * hop_length / sr1) for x in warp_path[:, 0]],
-            [sec2num(y * hop_length / sr2) for y in warp_path[:, 1]],
+            sec2num(warp_path[:, 0] * hop_length / sr1),
+            sec2num(warp_path[:, 1] * hop_length / sr2),
             "r",
         )
         if filename is not None:
@@ -201,22 +291,52 @@ def plot_alignment(
 
 
 def plot_notes(
-    s, sr, pitches, onsets, offsets, hop_length, bins_per_note, filename=None,
+    s,
+    sr,
+    pitches,
+    starts,
+    ends,
+    hop_length,
+    bins_per_note,
+    filename=None,
+    max_frames=6000,
 ):
-    """Plot the notes and spectrogram."""
-    on_offsets = np.zeros((len(pitches), 2, 2))
-    onset_markers = np.zeros((len(pitches), 2, 2))
-    for i, (pitch, onset, offset) in enumerate(zip(pitches, onsets, offsets)):
-        y_pos = bins_per_note * (pitch - librosa.note_to_midi("C3"))
-        on_offsets[i, 0] = (sec2num(onset), y_pos + 0.5)
-        on_offsets[i, 1] = (sec2num(offset), y_pos + 0.5)
-        onset_markers[i, 0] = (sec2num(onset), y_pos - 0.5)
-        onset_markers[i, 1] = (sec2num(onset), y_pos + 1.5)
+    """Plot the notes and spectrogram.
+
+    The spectrogram is downsampled to at most `max_frames` frames, which is
+    about the resolution of the output image.
+
+    """
+    import librosa
+    import matplotlib.collections
+    import matplotlib.dates
+    import matplotlib.pyplot as plt
+
+    y_pos = bins_per_note * (np.asarray(pitches) - librosa.note_to_midi("C3"))
+    starts = sec2num(starts)
+    ends = sec2num(ends)
+    on_offsets = np.stack(
+        [np.stack([starts, y_pos + 0.5], 1), np.stack([ends, y_pos + 0.5], 1)],
+        1,
+    )
+    onset_markers = np.stack(
+        [
+            np.stack([starts, y_pos - 0.5], 1),
+            np.stack([starts, y_pos + 1.5], 1),
+        ],
+        1,
+    )
 
     fig, ax = plt.subplots(figsize=(20, 2))
     time_lim1 = (sec2num(0), sec2num(s.shape[1] * hop_length / sr))
     extent = (time_lim1[0], time_lim1[1], 0, len(s))
-    ax.imshow(s, cmap="inferno", aspect="auto", origin="lower", extent=extent)
+    ax.imshow(
+        decimate(s, max_frames),
+        cmap="inferno",
+        aspect="auto",
+        origin="lower",
+        extent=extent,
+    )
     ax.add_collection(
         matplotlib.collections.LineCollection(on_offsets, colors="g", lw=1)
     )
@@ -244,148 +364,497 @@ def plot_notes(
     plt.close(fig)
 
 
-def main():
-    """Main function."""
-    # Parse the command-line arguments
-    args = parse_args()
+def compute_features(y, rate, hop_length, bins_per_note, dtype=None):
+    """Compute the constant-Q spectrogram in dB.
 
-    # Make sure output directory exists
-    args.out_dir.mkdir(exist_ok=True)
-    (args.out_dir / "alignment").mkdir(exist_ok=True)
+    The filter kernels are shared by all calls with the same parameters.
 
-    # Set up the logger
-    logging.basicConfig(
-        stream=sys.stdout,
-        level=logging.ERROR if args.quiet else logging.INFO,
-        format="%(levelname)-8s %(message)s",
+    """
+    import features
+
+    with instrumentation.phase("cqt"):
+        extractor = features.get_extractor(
+            rate, hop_length, bins_per_note, dtype
+        )
+        return extractor(y)
+
+
+def load_features(filename, args):
+    """Load an audio file and compute its constant-Q spectrogram in dB.
+
+    If a cache directory is given, the spectrogram is looked up in the cache
+    by the content of the audio file and the spectrogram parameters, and
+    returned as a memory-mapped array when found. The audio file may be
+    stored in any format supported by `audio_store`.
+
+    """
+    import librosa
+
+    filename = audio_store.find(filename)
+    if args.cache_dir is None:
+        with instrumentation.phase("decode"):
+            y, rate = librosa.load(filename, sr=None)
+        cqt_db = compute_features(y, rate, args.hop_length, args.bins_per_note)
+        return cqt_db, rate
+
+    cache = Cache(
+        args.cache_dir,
+        None if args.cache_size is None else int(args.cache_size * 2**20),
+    )
+    key = make_key(
+        hash_file(filename),
+        "cqt",
+        args.hop_length,
+        args.bins_per_note,
+        "C3",
+        5 * 12 * args.bins_per_note,
+        CACHE_VERSION,
+    )
+    with instrumentation.phase("cache"):
+        cqt_db = cache.load(key, mmap_mode="r")
+    if cqt_db is not None:
+        return cqt_db, sf.info(str(filename)).samplerate
+    with instrumentation.phase("decode"):
+        y, rate = librosa.load(filename, sr=None)
+    cqt_db = compute_features(y, rate, args.hop_length, args.bins_per_note)
+    with instrumentation.phase("cache"):
+        cache.save(key, cqt_db)
+    return cqt_db, rate
+
+
+def process(row, args):
+    """Process a row."""
+    # Get directories
+    out_filename = (
+        args.out_dir
+        / "alignment"
+        / row["collection"]
+        / (row["filename"] + ".csv")
     )
+    if args.skip_existing and out_filename.is_file():
+        return "skipped"
+    out_filename.parent.mkdir(exist_ok=True, parents=True)
 
-    # Read the CSV file
-    logging.info("Reading the CSV file...")
-    data = read_csv(args.csv_filename)
+    # Get the input filenames
+    wav_filename = audio_store.find(
+        args.input_dir / "wav" / row["collection"] / (row["filename"] + ".wav")
+    )
+    synth_filename = (
+        args.input_dir
+        / "synth"
+        / row["collection"]
+        / (row["filename"] + ".wav")
+    )
 
-    # Iterate over rows
-    logging.info("Iterating over rows...")
-    prog_bar = tqdm.tqdm(data, ncols=120)
-    for row in prog_bar:
-        # Append filename to progress bar
-        prog_bar.set_postfix_str(row["filename"])
-
-        # Get directories
-        out_filename = (
-            args.out_dir
-            / "alignment"
+    # Read the notes
+    with instrumentation.phase("read"):
+        notes = read_csv(
+            args.input_dir
+            / "notes"
             / row["collection"]
             / (row["filename"] + ".csv")
         )
-        if args.skip_existing and out_filename.is_file():
-            continue
-        out_filename.parent.mkdir(exist_ok=True, parents=True)
+    onsets = [int(row["onset"]) for row in notes]
+    offsets = [int(row["offset"]) for row in notes]
+    pitches = [int(row["pitch"]) for row in notes]
+
+    # Align the notes while streaming the recording
+    if args.dtw == "online":
+        align_online(
+            wav_filename, synth_filename, onsets, offsets, out_filename, args
+        )
+        return
 
-        # Load the audio
-        y, rate = librosa.load(
-            args.input_dir
-            / "wav"
-            / row["collection"]
-            / (row["filename"] + ".wav"),
-            sr=None,
+    # Compute spectrograms
+    cqt_db, rate = load_features(wav_filename, args)
+    cqt_db_synth, rate_synth = load_features(synth_filename, args)
+    assert rate == rate_synth
+
+    # Align the notes
+    warp_path, starts, ends = align(
+        cqt_db, cqt_db_synth, rate, rate_synth, onsets, offsets, args
+    )
+    write_alignment(out_filename, warp_path, starts, ends)
+
+    # Plot alignment
+    if args.save_plot and not args.defer_plots:
+        save_plots(
+            out_filename, cqt_db, cqt_db_synth, rate, warp_path, pitches, args
         )
-        y_synth, rate_synth = librosa.load(
-            args.input_dir
-            / "synth"
-            / row["collection"]
-            / (row["filename"] + ".wav"),
-            sr=None,
+
+
+def align(cqt_db, cqt_db_synth, rate, rate_synth, onsets, offsets, args):
+    """Align the notes to a recording by its synthesized audio.
+
+    Returns the warping path between the spectrograms of the recording and
+    the synthesized audio, and the start and end times of the notes in the
+    recording in seconds.
+
+    """
+    # Run the DTW algorithm
+    with instrumentation.phase("dtw"):
+        warp_path = dtw.compute_path(
+            cqt_db, cqt_db_synth, args.dtw, args.dtw_radius, args.dtw_threads
         )
-        assert rate == rate_synth
-
-        # Compute spectrograms
-        cqt = np.abs(
-            librosa.cqt(
-                y,
-                sr=rate,
-                hop_length=args.hop_length,
-                fmin=librosa.note_to_hz("C3"),
-                n_bins=5 * 12 * args.bins_per_note,
-                bins_per_octave=12 * args.bins_per_note,
-            )
+    warp_path = warp_path[::-1]
+
+    # Compute starts and ends
+    with instrumentation.phase("map"):
+        factor = cqt_db.shape[1] * rate_synth / rate / max(offsets)
+        mapping = warping.WarpPath(warp_path, hop_length=args.hop_length)
+        starts = (
+            mapping.to_recording(np.asarray(onsets) * factor, side="right")
+            * args.hop_length
+            / rate
         )
-        cqt_synth = np.abs(
-            librosa.cqt(
-                y_synth,
-                sr=rate_synth,
-                hop_length=args.hop_length,
-                fmin=librosa.note_to_hz("C3"),
-                n_bins=5 * 12 * args.bins_per_note,
-                bins_per_octave=12 * args.bins_per_note,
-            )
+        ends = (
+            mapping.to_recording(np.asarray(offsets) * factor, side="left")
+            * args.hop_length
+            / rate
         )
+    return warp_path, starts, ends
 
-        # Convert amplitude to db
-        cqt_db = librosa.amplitude_to_db(cqt, ref=np.max)
-        cqt_db_synth = librosa.amplitude_to_db(cqt_synth, ref=np.max)
 
-        # Run the DTW algorithm
-        _, warp_path = librosa.sequence.dtw(cqt_db, cqt_db_synth)
-        warp_path = warp_path[::-1]
-        np.save(out_filename.with_suffix(".npy"), warp_path)
+def write_alignment(out_filename, warp_path, starts, ends):
+    """Write the warping path and the start and end times of the notes."""
+    with instrumentation.phase("write"):
+        warping.save_path(out_filename.with_suffix(".npy"), warp_path)
+        with open(out_filename, "w") as f:
+            f.write("start,end\n")
+            for start, end in zip(starts, ends):
+                f.write(f"{start},{end}\n")
 
-        # Read the notes
-        notes = read_csv(
-            args.input_dir
-            / "notes"
-            / row["collection"]
-            / (row["filename"] + ".csv"),
+
+def align_online(
+    wav_filename, synth_filename, onsets, offsets, out_filename, args
+):
+    """Align the notes to a recording by online DTW.
+
+    The spectrogram of the synthesized audio is computed a chunk at a time
+    into a temporary memory-mapped file, and that of the recording is fed to
+    online DTW a chunk at a time. The start and end times of the notes are
+    written as soon as they are decided, so the memory usage does not depend
+    on the length of the recording besides the positions of the warping
+    path. The spectrograms are in dB relative to a fixed reference rather
+    than their peaks. The synthesized audio must have the same sampling
+    rate as the recording.
+
+    """
+    import features
+
+    rate = sf.info(str(wav_filename)).samplerate
+    rate_synth = sf.info(str(synth_filename)).samplerate
+    if rate_synth != rate:
+        raise ValueError(
+            f"Expect the synthesized audio at the sampling rate of the "
+            f"recording ({rate} Hz), but got {rate_synth} Hz : "
+            f"{synth_filename}"
         )
-        onsets = [int(row["onset"]) for row in notes]
-        offsets = [int(row["offset"]) for row in notes]
-        pitches = [int(row["pitch"]) for row in notes]
-
-        # Compute starts and ends
-        factor = cqt.shape[1] * rate_synth / rate / max(offsets)
-        starts_synth = [onset * factor for onset in onsets]
-        ends_synth = [offset * factor for offset in offsets]
-        starts_indices = np.clip(
-            np.searchsorted(warp_path[:, 1], starts_synth, side="right"),
-            0,
-            len(warp_path) - 1,
+    extractor = features.get_extractor(
+        rate, args.hop_length, args.bins_per_note, "float32", 1.0
+    )
+    radius = 256 if args.dtw_radius is None else args.dtw_radius
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Compute the spectrogram of the synthesized audio
+        n_frames_synth = 1 + sf.info(str(synth_filename)).frames // (
+            args.hop_length
         )
-        starts = warp_path[starts_indices, 0] * args.hop_length / rate
-        ends_indices = np.clip(
-            np.searchsorted(warp_path[:, 1], ends_synth) - 1,
-            0,
-            len(warp_path) - 1,
+        cqt_db_synth = np.lib.format.open_memmap(
+            pathlib.Path(temp_dir) / "synth.npy",
+            mode="w+",
+            dtype=np.float32,
+            shape=(n_frames_synth, extractor.n_bins),
         )
-        ends = warp_path[ends_indices, 0] * args.hop_length / rate
+        start = 0
+        chunks = features.iter_chunks(extractor, synth_filename)
+        while True:
+            with instrumentation.phase("cqt"):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            cqt_db_synth[start : start + chunk.shape[1]] = chunk.T
+            start += chunk.shape[1]
+        online_dtw = dtw.OnlineDTW(cqt_db_synth.T, radius)
+
+        # Map the notes to the frames of the synthesized audio
+        n_frames = 1 + sf.info(str(wav_filename)).frames // args.hop_length
+        factor = n_frames / max(offsets)
+        starts_synth = np.asarray(onsets) * factor
+        ends_synth = np.asarray(offsets) * factor
+        start_order = np.argsort(starts_synth, kind="stable")
+        end_order = np.argsort(ends_synth, kind="stable")
+        start_frames = np.full(len(onsets), -1, np.int64)
+        end_frames = np.full(len(onsets), -1, np.int64)
+        n_starts = n_ends = n_written = 0
+
+        positions = []
         with open(out_filename, "w") as f:
+
+            def write_note(k):
+                f.write(
+                    f"{start_frames[k] * args.hop_length / rate},"
+                    f"{end_frames[k] * args.hop_length / rate}\n"
+                )
+
             f.write("start,end\n")
-            for start, end in zip(starts, ends):
-                f.write(f"{start},{end}\n")
+            chunks = features.iter_chunks(extractor, wav_filename)
+            while True:
+                with instrumentation.phase("cqt"):
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                with instrumentation.phase("dtw"):
+                    offset = online_dtw.n_rows
+                    chunk_positions = online_dtw.update(chunk)
+                positions.append(chunk_positions)
+
+                with instrumentation.phase("map"):
+                    # Decide the starts passed by the path, i.e., the first
+                    # frame past the onset
+                    while (
+                        n_starts < len(onsets)
+                        and starts_synth[start_order[n_starts]]
+                        < chunk_positions[-1]
+                    ):
+                        k = start_order[n_starts]
+                        start_frames[k] = offset + np.searchsorted(
+                            chunk_positions, starts_synth[k], side="right"
+                        )
+                        n_starts += 1
+
+                    # Decide the ends reached by the path, i.e., the last
+                    # frame before the offset
+                    while (
+                        n_ends < len(offsets)
+                        and ends_synth[end_order[n_ends]]
+                        <= chunk_positions[-1]
+                    ):
+                        k = end_order[n_ends]
+                        end_frames[k] = max(
+                            offset
+                            + np.searchsorted(chunk_positions, ends_synth[k])
+                            - 1,
+                            0,
+                        )
+                        n_ends += 1
+
+                # Write the notes decided so far, in order
+                with instrumentation.phase("write"):
+                    while (
+                        n_written < len(onsets)
+                        and start_frames[n_written] >= 0
+                        and end_frames[n_written] >= 0
+                    ):
+                        write_note(n_written)
+                        n_written += 1
+
+            # Map the notes never reached to the last frame
+            with instrumentation.phase("write"):
+                last_frame = max(online_dtw.n_rows - 1, 0)
+                start_frames[start_frames < 0] = last_frame
+                end_frames[end_frames < 0] = last_frame
+                for k in range(n_written, len(onsets)):
+                    write_note(k)
+
+    # Save the warping path
+    with instrumentation.phase("write"):
+        positions = np.concatenate(positions)
+        warping.save_path(
+            out_filename.with_suffix(".npy"),
+            np.stack([np.arange(len(positions)), positions], 1),
+        )
+
+
+def save_plots(
+    out_filename, cqt_db, cqt_db_synth, rate, warp_path, pitches, args
+):
+    """Save the plots of an alignment."""
+    starts, ends = read_alignment(out_filename)
+    with instrumentation.phase("plot"):
+        plot_alignment(
+            cqt_db,
+            cqt_db_synth,
+            rate,
+            rate,
+            hop_length=args.hop_length,
+            bins_per_octave=12 * args.bins_per_note,
+            filename=out_filename.parent / (out_filename.stem + "_dtw.png"),
+            warp_path=warp_path,
+        )
+        plot_notes(
+            cqt_db,
+            rate,
+            pitches,
+            starts,
+            ends,
+            hop_length=args.hop_length,
+            bins_per_note=args.bins_per_note,
+            filename=out_filename.parent
+            / (out_filename.stem + "_alignment.png"),
+        )
+
+
+def read_alignment(filename):
+    """Read the starts and ends of the notes from an alignment file."""
+    alignment = np.loadtxt(filename, delimiter=",", skiprows=1, ndmin=2)
+    return alignment[:, 0], alignment[:, 1]
+
+
+def plot(row, args):
+    """Save the plots of a row from the saved alignment."""
+    out_filename = (
+        args.out_dir
+        / "alignment"
+        / row["collection"]
+        / (row["filename"] + ".csv")
+    )
+    if not out_filename.is_file():
+        return "skipped"
+    cqt_db, rate = load_features(
+        args.input_dir
+        / "wav"
+        / row["collection"]
+        / (row["filename"] + ".wav"),
+        args,
+    )
+    cqt_db_synth, _ = load_features(
+        args.input_dir
+        / "synth"
+        / row["collection"]
+        / (row["filename"] + ".wav"),
+        args,
+    )
+    warp_path = warping.load_path(out_filename.with_suffix(".npy"))
+    notes = read_csv(
+        args.input_dir
+        / "notes"
+        / row["collection"]
+        / (row["filename"] + ".csv")
+    )
+    pitches = [int(note["pitch"]) for note in notes]
+    save_plots(
+        out_filename, cqt_db, cqt_db_synth, rate, warp_path, pitches, args
+    )
 
-        # Plot alignment
-        if args.save_plot:
-            plot_alignment(
-                cqt_db,
-                cqt_db_synth,
-                rate,
-                rate_synth,
-                hop_length=args.hop_length,
-                bins_per_octave=12 * args.bins_per_note,
-                filename=out_filename.parent
-                / (out_filename.stem + "_dtw.png"),
-                warp_path=warp_path,
+
+def get_dependencies(row, args, manifest):
+    """Return the hashes of the input files and the parameters of a row."""
+    return (
+        manifest.hash_file(
+            audio_store.find(
+                args.input_dir
+                / "wav"
+                / row["collection"]
+                / (row["filename"] + ".wav")
             )
-            plot_notes(
-                cqt_db,
-                rate,
-                pitches,
-                onsets,
-                offsets,
-                hop_length=args.hop_length,
-                bins_per_note=args.bins_per_note,
-                filename=out_filename.parent
-                / (out_filename.stem + "_alignment.png"),
+        ),
+        manifest.hash_file(
+            args.input_dir
+            / "synth"
+            / row["collection"]
+            / (row["filename"] + ".wav")
+        ),
+        manifest.hash_file(
+            args.input_dir
+            / "notes"
+            / row["collection"]
+            / (row["filename"] + ".csv")
+        ),
+        manifest.hash_file(__file__),
+        manifest.hash_file(dtw.__file__),
+        manifest.hash_file(pathlib.Path(__file__).with_name("dtw_kernels.py")),
+        manifest.hash_file(pathlib.Path(__file__).with_name("features.py")),
+        manifest.hash_file(warping.__file__),
+        args.hop_length,
+        args.bins_per_note,
+        args.dtw,
+        args.dtw_radius,
+    )
+
+
+def get_outputs(row, args):
+    """Return the output filenames of a row."""
+    out_filename = (
+        args.out_dir
+        / "alignment"
+        / row["collection"]
+        / (row["filename"] + ".csv")
+    )
+    filenames = [out_filename, out_filename.with_suffix(".npy")]
+    if args.save_plot:
+        for suffix in ("_dtw.png", "_alignment.png"):
+            filenames.append(
+                out_filename.parent / (out_filename.stem + suffix)
             )
+    return filenames
+
+
+def main(args=None):
+    """Main function."""
+    # Parse the command-line arguments
+    args = parse_args(args)
+
+    # Make sure output directory exists
+    args.out_dir.mkdir(exist_ok=True)
+    (args.out_dir / "alignment").mkdir(exist_ok=True)
+
+    # Set up the logger
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.ERROR if args.quiet else logging.INFO,
+        format="%(levelname)-8s %(message)s",
+    )
+
+    # Read the CSV file
+    logging.info("Reading the CSV file...")
+    data = read_csv(args.csv_filename)
+
+    # Select the rows whose outputs are out of date
+    if args.incremental:
+        manifest = Manifest(args.out_dir / "alignment")
+        n_rows = len(data)
+        data, fingerprints = select_stale(
+            manifest, data, get_dependencies, get_outputs, args
+        )
+        logging.info(f"Found {n_rows - len(data)} up-to-date rows.")
+
+    # Share the cores among the worker processes
+    if args.dtw_threads is None:
+        args.dtw_threads = max(os.cpu_count() // args.jobs, 1)
+
+    # Iterate over rows
+    logging.info("Iterating over rows...")
+    report = instrumentation.make_report(args)
+    results = parallel.run(
+        process, data, args, args.jobs, args.largest_first, report
+    )
+    n_failed = parallel.summarize(data, results)
+
+    # Save the plots in a separate pass, always for the online engine as it
+    # does not keep the spectrograms
+    if args.save_plot and (args.defer_plots or args.dtw == "online"):
+        logging.info("Saving the plots...")
+        plot_data = [
+            row for row, result in zip(data, results) if result[1] is None
+        ]
+        plot_results = parallel.run(
+            plot,
+            plot_data,
+            args,
+            args.jobs if args.plot_jobs is None else args.plot_jobs,
+            args.largest_first,
+            report,
+        )
+        n_failed += parallel.summarize(plot_data, plot_results)
+
+    # Record the rows built successfully
+    if args.incremental:
+        record(manifest, data, fingerprints, results)
+
+    instrumentation.save_report(report, args)
+
+    if n_failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
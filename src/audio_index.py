@@ -0,0 +1,129 @@
+"""Index of the sampling rates and lengths of audio files."""
+import argparse
+import csv
+import logging
+import os
+import pathlib
+import sys
+import tempfile
+
+import soundfile as sf
+
+import audio_store
+
+INDEX_FILENAME = "index.csv"
+
+
+def parse_args(args=None, namespace=None):
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-d",
+        "--audio_dir",
+        type=pathlib.Path,
+        required=True,
+        help="audio directory",
+    )
+    parser.add_argument(
+        "-q", "--quiet", action="store_true", help="show warnings only"
+    )
+    return parser.parse_args(args=args, namespace=namespace)
+
+
+def read_info(filename):
+    """Return the sampling rate and number of samples of an audio file.
+
+    Only the header of the file is read.
+
+    """
+    info = sf.info(str(filename))
+    return info.samplerate, info.frames
+
+
+class AudioIndex:
+    """Index of the sampling rates and lengths of audio files.
+
+    The index is stored as `index.csv` in the audio directory. An entry is
+    used only if the size and modification time of the file still match,
+    otherwise the header of the file is read again.
+
+    Parameters
+    ----------
+    audio_dir : str or Path
+        Audio directory.
+
+    """
+
+    def __init__(self, audio_dir):
+        self.audio_dir = pathlib.Path(audio_dir)
+        self.entries = {}
+        index_filename = self.audio_dir / INDEX_FILENAME
+        if index_filename.is_file():
+            with open(index_filename) as f:
+                for row in csv.DictReader(f):
+                    self.entries[row["filename"]] = (
+                        int(row["size"]),
+                        int(row["mtime_ns"]),
+                        int(row["rate"]),
+                        int(row["n_samples"]),
+                    )
+
+    def _get_key(self, filename):
+        return pathlib.Path(filename).relative_to(self.audio_dir).as_posix()
+
+    def update(self, filename):
+        """Read the header of an audio file and update its entry."""
+        stat = os.stat(filename)
+        rate, n_samples = read_info(filename)
+        self.entries[self._get_key(filename)] = (
+            stat.st_size,
+            stat.st_mtime_ns,
+            rate,
+            n_samples,
+        )
+        return rate, n_samples
+
+    def lookup(self, filename):
+        """Return the sampling rate and number of samples of an audio file."""
+        entry = self.entries.get(self._get_key(filename))
+        if entry is not None:
+            stat = os.stat(filename)
+            if entry[:2] == (stat.st_size, stat.st_mtime_ns):
+                return entry[2:]
+        return self.update(filename)
+
+    def save(self):
+        """Save the index to the audio directory."""
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.audio_dir, suffix=".tmp", delete=False
+        ) as f:
+            f.write("filename,size,mtime_ns,rate,n_samples\n")
+            for key, entry in sorted(self.entries.items()):
+                f.write(f"{key},{','.join(str(x) for x in entry)}\n")
+        os.replace(f.name, self.audio_dir / INDEX_FILENAME)
+
+
+def main():
+    """Main function."""
+    # Parse the command-line arguments
+    args = parse_args()
+
+    # Set up the logger
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.ERROR if args.quiet else logging.INFO,
+        format="%(levelname)-8s %(message)s",
+    )
+
+    # Index the audio files
+    logging.info("Indexing the audio files...")
+    index = AudioIndex(args.audio_dir)
+    for suffix in audio_store.SUFFIXES:
+        for filename in sorted(args.audio_dir.glob(f"*/*{suffix}")):
+            index.lookup(filename)
+    index.save()
+    logging.info(f"Indexed {len(index.entries)} files.")
+
+
+if __name__ == "__main__":
+    main()
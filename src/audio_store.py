@@ -0,0 +1,224 @@
+"""Lossless audio storage with sample-accurate range reads."""
+import bisect
+import mmap
+import os
+import pathlib
+import tempfile
+
+import soundfile as sf
+
+# Suffixes of the supported formats, in order of lookup
+SUFFIXES = (".wav", ".flac")
+
+# Types of the FLAC metadata blocks
+_PADDING = 1
+_SEEKTABLE = 3
+
+# Table of the CRC-8 of the FLAC frame headers, with polynomial 0x07
+_CRC8_TABLE = []
+for _byte in range(256):
+    _crc = _byte
+    for _ in range(8):
+        _crc = ((_crc << 1) ^ 0x07 if _crc & 0x80 else _crc << 1) & 0xFF
+    _CRC8_TABLE.append(_crc)
+
+
+def find(filename):
+    """Return the stored file of an audio file in any supported format.
+
+    The filename may have any of the supported suffixes. Returns the first
+    existing file with the same stem, or the filename itself if none exists.
+
+    """
+    filename = pathlib.Path(filename)
+    if filename.is_file():
+        return filename
+    for suffix in SUFFIXES:
+        candidate = filename.with_suffix(suffix)
+        if candidate.is_file():
+            return candidate
+    return filename
+
+
+def write(filename, y, rate, subtype="PCM_16"):
+    """Write an audio file in the format given by its suffix.
+
+    FLAC files get a seek table by `add_seek_table`.
+
+    """
+    sf.write(filename, y, rate, subtype=subtype)
+    add_seek_table(filename)
+
+
+def read(filename, start=0, stop=None, dtype="float32", always_2d=False):
+    """Read a range of samples of an audio file.
+
+    Only the samples from `start` up to `stop` are decoded, and the range is
+    sample-accurate in any supported format. Returns the samples and the
+    sampling rate.
+
+    """
+    with sf.SoundFile(str(find(filename))) as f:
+        stop = f.frames if stop is None else min(stop, f.frames)
+        start = min(start, stop)
+        f.seek(start)
+        y = f.read(stop - start, dtype=dtype, always_2d=always_2d)
+        return y, f.samplerate
+
+
+def _crc8(data):
+    """Return the CRC-8 of the bytes of a FLAC frame header."""
+    crc = 0
+    for byte in data:
+        crc = _CRC8_TABLE[crc ^ byte]
+    return crc
+
+
+def _parse_frame_header(buffer, pos, block_size):
+    """Parse the header of a FLAC frame.
+
+    Returns the first sample and the number of samples of the frame, or
+    None if there is no valid frame header at the position.
+
+    """
+    header = buffer[pos : pos + 16]
+    if len(header) < 6 or header[0] != 0xFF or header[1] & 0xFE != 0xF8:
+        return None
+    size_code, rate_code = header[2] >> 4, header[2] & 0x0F
+    if size_code == 0 or rate_code == 15 or header[3] & 0x01:
+        return None
+
+    # Decode the UTF-8 coded frame or sample number
+    first = header[4]
+    n_extra = 0
+    mask = 0x80
+    if first & mask:
+        mask >>= 1
+        while first & mask:
+            n_extra += 1
+            mask >>= 1
+        if n_extra == 0 or n_extra > 6:
+            return None
+    number = first & (mask - 1)
+    end = 5 + n_extra
+    for byte in header[5:end]:
+        if byte & 0xC0 != 0x80:
+            return None
+        number = number << 6 | byte & 0x3F
+
+    # Decode the block size and skip the sampling rate
+    if size_code == 1:
+        n_samples = 192
+    elif size_code <= 5:
+        n_samples = 576 << (size_code - 2)
+    elif size_code == 6:
+        n_samples = header[end] + 1
+        end += 1
+    elif size_code == 7:
+        n_samples = int.from_bytes(header[end : end + 2], "big") + 1
+        end += 2
+    else:
+        n_samples = 256 << (size_code - 8)
+    if rate_code == 12:
+        end += 1
+    elif rate_code in (13, 14):
+        end += 2
+    if len(header) <= end or _crc8(header[:end]) != header[end]:
+        return None
+
+    # The number counts the frames if the block size is fixed
+    if header[1] & 0x01:
+        return number, n_samples
+    return number * block_size, n_samples
+
+
+def add_seek_table(filename, interval=1.0):
+    """Add a dense seek table to a FLAC file.
+
+    The frames of the file are located by their headers, and a seek point
+    is added at every `interval` seconds, replacing any existing seek table
+    and padding, so that seeking to any sample decodes only the frames from
+    the nearest seek point. Files in other formats are left as is, and so
+    are empty files, which libsndfile writes for audio without samples.
+
+    """
+    filename = pathlib.Path(filename)
+    if filename.suffix.lower() != ".flac" or not os.path.getsize(filename):
+        return
+    with open(filename, "rb") as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ
+    ) as buffer:
+        if buffer[:4] != b"fLaC":
+            raise ValueError(f"Not a FLAC file : {filename}")
+
+        # Read the metadata blocks
+        blocks = []
+        pos = 4
+        is_last = False
+        while not is_last:
+            is_last = bool(buffer[pos] & 0x80)
+            block_type = buffer[pos] & 0x7F
+            length = int.from_bytes(buffer[pos + 1 : pos + 4], "big")
+            blocks.append((block_type, buffer[pos + 4 : pos + 4 + length]))
+            pos += 4 + length
+        audio_start = pos
+        streaminfo = blocks[0][1]
+        block_size = int.from_bytes(streaminfo[2:4], "big")
+        rate = int.from_bytes(streaminfo[10:13], "big") >> 4
+        n_samples = int.from_bytes(streaminfo[13:18], "big") & (2**36 - 1)
+
+        # Locate the frames, each starting at the sample after the previous
+        # one so that a sync code within a frame is never taken for a frame
+        frame_samples, frame_offsets, frame_sizes = [], [], []
+        sync = buffer[audio_start : audio_start + 2]
+        expected = 0
+        pos = audio_start
+        while pos >= 0 and (not n_samples or expected < n_samples):
+            frame = _parse_frame_header(buffer, pos, block_size)
+            if frame is not None and frame[0] == expected:
+                frame_samples.append(frame[0])
+                frame_offsets.append(pos - audio_start)
+                frame_sizes.append(frame[1])
+                expected += frame[1]
+            pos = buffer.find(sync, pos + 1)
+        if n_samples and expected < n_samples:
+            raise ValueError(
+                f"Expect {n_samples} samples, but found {expected} : "
+                f"{filename}"
+            )
+
+        # Build the seek table
+        seek_points = []
+        for target in range(0, expected, max(int(interval * rate), 1)):
+            k = bisect.bisect_right(frame_samples, target) - 1
+            point = (
+                frame_samples[k].to_bytes(8, "big")
+                + frame_offsets[k].to_bytes(8, "big")
+                + frame_sizes[k].to_bytes(2, "big")
+            )
+            if not seek_points or seek_points[-1] != point:
+                seek_points.append(point)
+        blocks = (
+            blocks[:1]
+            + [(_SEEKTABLE, b"".join(seek_points))]
+            + [
+                block
+                for block in blocks[1:]
+                if block[0] not in (_SEEKTABLE, _PADDING)
+            ]
+        )
+
+        # Rewrite the file with the new metadata blocks
+        with tempfile.NamedTemporaryFile(
+            dir=filename.parent, suffix=".flac", delete=False
+        ) as out:
+            out.write(b"fLaC")
+            for i, (block_type, data) in enumerate(blocks):
+                is_last = i == len(blocks) - 1
+                out.write(bytes([block_type | 0x80 * is_last]))
+                out.write(len(data).to_bytes(3, "big"))
+                out.write(data)
+            for start in range(audio_start, len(buffer), 2**20):
+                out.write(buffer[start : start + 2**20])
+    os.chmod(out.name, os.stat(filename).st_mode)
+    os.replace(out.name, filename)
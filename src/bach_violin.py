@@ -0,0 +1,49 @@
+"""Command-line interface that runs the scripts as subcommands."""
+import argparse
+import importlib
+
+# Script and description of each subcommand
+COMMANDS = {
+    "slice": ("slice_audio", "slice the audio into clips"),
+    "process": ("process_scores", "process the scores"),
+    "synthesize": ("synthesize_scores", "synthesize the scores into audios"),
+    "align": ("align_scores", "align the scores to the recordings"),
+}
+
+
+def parse_args(args=None, namespace=None):
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser(
+        prog="bach-violin",
+        description="Run a step of the alignment process. Run "
+        "`bach-violin <command> -h` for the arguments of each command.",
+    )
+    parser.add_argument(
+        "command",
+        choices=COMMANDS,
+        help="; ".join(
+            f"{command}: {description}"
+            for command, (_, description) in COMMANDS.items()
+        ),
+    )
+    parser.add_argument(
+        "args",
+        nargs=argparse.REMAINDER,
+        help="arguments passed to the script of the command",
+    )
+    return parser.parse_args(args=args, namespace=namespace)
+
+
+def main():
+    """Main function."""
+    # Parse the command-line arguments
+    args = parse_args()
+
+    # Import only the script of the command, as the others import modules
+    # that are slow to load
+    module = importlib.import_module(COMMANDS[args.command][0])
+    module.main(args.args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,417 @@
+"""Benchmark the alignment pipeline on synthetic and bundled data."""
+import argparse
+import json
+import logging
+import os
+import pathlib
+import platform
+import shutil
+import sys
+
+import librosa
+import muspy
+import numpy as np
+
+import align_scores
+import dtw
+import instrumentation
+import process_scores
+import synthesize_scores
+
+# Parameters of the synthetic data
+RATE = 16000
+RESOLUTION = 24
+QPM = 90
+
+
+def parse_args(args=None, namespace=None):
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-i",
+        "--input_dir",
+        type=pathlib.Path,
+        help="dataset directory containing the scores (default: skip the "
+        "score benchmarks)",
+    )
+    parser.add_argument(
+        "-o",
+        "--out_filename",
+        type=pathlib.Path,
+        help="output JSON filename for the results",
+    )
+    parser.add_argument(
+        "-l",
+        "--lengths",
+        type=float,
+        nargs="+",
+        default=[1, 5, 15],
+        help="lengths of the synthetic recordings in minutes",
+    )
+    parser.add_argument(
+        "-d",
+        "--dtw",
+        choices=dtw.ENGINES,
+        nargs="+",
+        default=list(dtw.ENGINES),
+        help="DTW engines to benchmark",
+    )
+    parser.add_argument(
+        "--dtw_radius",
+        type=int,
+        help="radius of the search band or window in frames for the band, "
+        "multiscale and online DTW engines",
+    )
+    parser.add_argument(
+        "--dtw_threads",
+        type=int,
+        help="number of threads for the full DTW engine (default: all the "
+        "cores)",
+    )
+    parser.add_argument(
+        "--hop_length", type=int, default=512, help="hop length for CQT"
+    )
+    parser.add_argument(
+        "--bins_per_note",
+        type=int,
+        default=3,
+        help="number of bins per note for CQT",
+    )
+    parser.add_argument(
+        "--max_memory",
+        type=float,
+        default=4096,
+        help="maximum size in MB of the matrix of steps for the full DTW "
+        "engine, above which it is skipped",
+    )
+    parser.add_argument(
+        "-n",
+        "--n_scores",
+        type=int,
+        default=3,
+        help="number of bundled scores to benchmark",
+    )
+    parser.add_argument(
+        "-b",
+        "--baseline",
+        type=pathlib.Path,
+        help="baseline JSON filename to compare the results against",
+    )
+    parser.add_argument(
+        "-t",
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="relative slowdown against the baseline to flag as a regression",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="random seed for synthetic data"
+    )
+    parser.add_argument(
+        "-q", "--quiet", action="store_true", help="show warnings only"
+    )
+    return parser.parse_args(args=args, namespace=namespace)
+
+
+def generate_notes(duration, rng):
+    """Generate a random monophonic melody of a given duration in seconds.
+
+    Returns an array of shape (n_notes, 4) holding the onset, offset, pitch
+    and velocity of each note, with time in ticks at `QPM`.
+
+    """
+    n_ticks = int(duration * QPM / 60 * RESOLUTION)
+    durations = rng.choice([6, 12, 24, 36, 48], size=n_ticks // 6 + 1)
+    onsets = np.concatenate([[0], np.cumsum(durations)[:-1]])
+    onsets = onsets[onsets < n_ticks]
+    offsets = np.minimum(onsets + durations[: len(onsets)], n_ticks)
+    pitches = rng.integers(55, 89, size=len(onsets))
+    velocities = np.full(len(onsets), 64)
+    return np.stack([onsets, offsets, pitches, velocities], 1)
+
+
+def render(notes, tick_times, rate):
+    """Render notes into a waveform with decaying harmonic tones.
+
+    The onset and offset of each note are mapped to seconds by the time of
+    each tick in `tick_times`.
+
+    """
+    starts = np.round(tick_times[notes[:, 0]] * rate).astype(np.int64)
+    ends = np.round(tick_times[notes[:, 1]] * rate).astype(np.int64)
+    y = np.zeros(ends.max() + 1, np.float32)
+    for start, end, pitch in zip(starts, ends, notes[:, 2]):
+        t = np.arange(end - start) / rate
+        phase = 2 * np.pi * librosa.midi_to_hz(pitch) * t
+        tone = sum(np.sin(k * phase) / k for k in range(1, 5))
+        y[start:end] += tone * np.exp(-3 * t)
+    return y / np.abs(y).max()
+
+
+def make_example(minutes, seed):
+    """Create a synthetic recording, its synthesized score and its notes.
+
+    The recording is rendered with a slowly varying tempo around `QPM`, and
+    the score at a constant tempo. Returns the recording, the synthesized
+    score, the notes and the true start times of the notes in the recording.
+
+    """
+    rng = np.random.default_rng(seed)
+    notes = generate_notes(60 * minutes, rng)
+    n_ticks = notes[:, 1].max() + 1
+
+    # Vary the tempo by up to 20% with a random walk
+    tempo = np.cumsum(rng.normal(0, 0.002, n_ticks))
+    tempo = 1 + 0.2 * np.tanh(tempo)
+    warped_times = np.concatenate([[0], np.cumsum(tempo[:-1])])
+    warped_times *= 60 / QPM / RESOLUTION
+
+    # Synthesize the score at a global tempo that matches the length of the
+    # recording, as done by `synthesize_scores.py`
+    tick_times = np.linspace(0, warped_times[-1], n_ticks)
+
+    y = render(notes, warped_times, RATE)
+    y_synth = render(notes, tick_times, RATE)
+    return y, y_synth, notes, warped_times[notes[:, 0]]
+
+
+def bench_align(y, y_synth, notes, true_starts, args):
+    """Benchmark the feature extraction, DTW and note-time mapping."""
+
+    def align():
+        cqt_db = align_scores.compute_features(
+            y, RATE, args.hop_length, args.bins_per_note
+        )
+        cqt_db_synth = align_scores.compute_features(
+            y_synth, RATE, args.hop_length, args.bins_per_note
+        )
+        return align_scores.align(
+            cqt_db, cqt_db_synth, RATE, RATE, notes[:, 0], notes[:, 1], args
+        )
+
+    (_, starts, _), stats = instrumentation.call(align)
+    stats["audio_duration"] = len(y) / RATE
+    stats["onset_error"] = float(np.mean(np.abs(starts - true_starts)))
+    return stats
+
+
+def bench_process_scores(extract_notes, score_filenames):
+    """Benchmark the note extraction from the scores."""
+
+    def extract():
+        return [extract_notes(filename) for filename in score_filenames]
+
+    notes, stats = instrumentation.call(extract)
+    stats["n_notes"] = sum(len(x) for x in notes)
+    return stats
+
+
+def bench_synthesize(y_synth, notes, render_score):
+    """Benchmark the synthesis and the time stretching of a score."""
+    results = {}
+    if render_score:
+        music = synthesize_scores.make_music(notes)
+        qpm = synthesize_scores.compute_qpm(music, RATE, len(y_synth))
+        _, stats = instrumentation.call(
+            synthesize_scores.synthesize, music, qpm, RATE
+        )
+        stats["audio_duration"] = len(y_synth) / RATE
+        results["render"] = stats
+
+    def stretch():
+        return librosa.effects.time_stretch(y_synth, rate=1.1)
+
+    _, stats = instrumentation.call(stretch)
+    stats["audio_duration"] = len(y_synth) / RATE
+    results["stretch"] = stats
+    return results
+
+
+def get_scaling_exponent(lengths, times):
+    """Return the exponent of a power law fitted to the times."""
+    if len(lengths) < 2:
+        return None
+    return float(np.polyfit(np.log(lengths), np.log(times), 1)[0])
+
+
+def get_platform():
+    """Return a description of the platform the benchmarks run on."""
+    return {
+        "machine": platform.machine(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "librosa": librosa.__version__,
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def is_comparable(baseline_platform, current_platform):
+    """Return whether timings on two platforms can be compared.
+
+    The timings depend on the machine and the number of cores, so they are
+    comparable only if both match.
+
+    """
+    return all(
+        baseline_platform.get(key) == current_platform[key]
+        for key in ("machine", "cpu_count")
+    )
+
+
+def compare(results, baseline, tolerance):
+    """Log the changes against the baseline and return the regressions."""
+    regressions = []
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        ratio = stats["time"] / baseline[name]["time"]
+        message = (
+            f"{name:<32} {stats['time']:8.2f}s "
+            f"(baseline {baseline[name]['time']:8.2f}s, x{ratio:.2f})"
+        )
+        if ratio > 1 + tolerance:
+            logging.warning(f"Regression : {message}")
+            regressions.append(name)
+        else:
+            logging.info(message)
+    return regressions
+
+
+def main():
+    """Main function."""
+    # Parse the command-line arguments
+    args = parse_args()
+
+    # Set up the logger
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.ERROR if args.quiet else logging.INFO,
+        format="%(levelname)-8s %(message)s",
+    )
+
+    # Rendering needs FluidSynth and a soundfont
+    render_score = (
+        shutil.which("fluidsynth") is not None
+        and muspy.get_musescore_soundfont_path().is_file()
+    )
+    if not render_score:
+        logging.warning(
+            "Skipping the rendering benchmarks as FluidSynth or the MuseScore "
+            "General soundfont is not available."
+        )
+
+    # Warm up so that the JIT compilation is not timed
+    logging.info("Warming up...")
+    y, y_synth, notes, true_starts = make_example(0.1, args.seed)
+    for engine in args.dtw:
+        bench_align(
+            y,
+            y_synth,
+            notes,
+            true_starts,
+            argparse.Namespace(**{**vars(args), "dtw": engine}),
+        )
+
+    results = {}
+
+    # Benchmark the alignment on synthetic recordings
+    times = {engine: [] for engine in args.dtw}
+    for minutes in args.lengths:
+        logging.info(f"Generating a {minutes}-minute recording...")
+        y, y_synth, notes, true_starts = make_example(minutes, args.seed)
+        n_frames = len(y) // args.hop_length + 1
+        for engine in args.dtw:
+            if engine == "full" and n_frames**2 > args.max_memory * 2**20:
+                logging.info(
+                    f"Skipped the full DTW engine for {minutes} minutes."
+                )
+                continue
+            name = f"align/{engine}/{minutes:g}min"
+            logging.info(f"Running {name}...")
+            results[name] = bench_align(
+                y,
+                y_synth,
+                notes,
+                true_starts,
+                argparse.Namespace(**{**vars(args), "dtw": engine}),
+            )
+            times[engine].append((minutes, results[name]["time"]))
+
+        # Benchmark the synthesis
+        for key, stats in bench_synthesize(
+            y_synth, notes, render_score
+        ).items():
+            results[f"synthesize/{key}/{minutes:g}min"] = stats
+
+    # Benchmark the note extraction on the bundled scores
+    if args.input_dir is not None:
+        score_filenames = sorted((args.input_dir / "scores").glob("*/*.mxl"))[
+            : args.n_scores
+        ]
+        logging.info(f"Extracting notes from {len(score_filenames)} scores...")
+        for extract_notes in (
+            process_scores.extract_notes,
+            process_scores.extract_notes_music21,
+        ):
+            results[f"process_scores/{extract_notes.__name__}"] = (
+                bench_process_scores(extract_notes, score_filenames)
+            )
+
+    # Report the throughput and peak memory
+    for name, stats in results.items():
+        if "audio_duration" in stats:
+            throughput = f"{stats['audio_duration'] / stats['time']:.1f}x"
+        else:
+            throughput = f"{stats['n_notes'] / stats['time']:.0f} notes/s"
+        stats["throughput"] = throughput
+        message = (
+            f"{name:<32} {stats['time']:8.2f}s {throughput:>14} "
+            f"{stats['peak_rss'] / 2**20:8.0f} MB"
+        )
+        if "onset_error" in stats:
+            message += f" onset error={stats['onset_error']:.3f}s"
+        logging.info(message)
+
+    # Report the scaling with the length of the recording
+    scaling = {}
+    for engine, points in times.items():
+        exponent = get_scaling_exponent(*zip(*points)) if points else None
+        if exponent is not None:
+            scaling[engine] = exponent
+            logging.info(
+                f"Time of {engine} DTW alignment ~ length^{exponent:.2f}"
+            )
+
+    # Save the results
+    if args.out_filename is not None:
+        with open(args.out_filename, "w") as f:
+            json.dump(
+                {
+                    "platform": get_platform(),
+                    "results": results,
+                    "scaling": scaling,
+                },
+                f,
+                indent=2,
+            )
+
+    # Compare against the baseline
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        current_platform = get_platform()
+        if not is_comparable(baseline.get("platform", {}), current_platform):
+            logging.warning(
+                "Skipping the comparison against the baseline, which was "
+                f"measured on another platform : {baseline.get('platform')} "
+                f"(current: {current_platform})"
+            )
+            return
+        regressions = compare(results, baseline["results"], args.tolerance)
+        if regressions:
+            logging.error(f"Found {len(regressions)} regressions.")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
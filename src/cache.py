@@ -0,0 +1,161 @@
+"""On-disk cache of NumPy arrays."""
+import argparse
+import hashlib
+import logging
+import os
+import pathlib
+import sys
+import tempfile
+
+import numpy as np
+
+
+def parse_args(args=None, namespace=None):
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-d",
+        "--cache_dir",
+        type=pathlib.Path,
+        required=True,
+        help="cache directory",
+    )
+    parser.add_argument(
+        "--clear", action="store_true", help="whether to clear the cache"
+    )
+    parser.add_argument(
+        "-q", "--quiet", action="store_true", help="show warnings only"
+    )
+    return parser.parse_args(args=args, namespace=namespace)
+
+
+def hash_file(filename, chunk_size=1 << 20):
+    """Return the SHA-1 hash of the content of a file."""
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def make_key(*parts):
+    """Return a cache key for the given parts."""
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+class Cache:
+    """Least-recently-used on-disk cache of NumPy arrays.
+
+    Each array is stored as a NPY file named by its key. Loading an array
+    updates its modification time, and the least recently used arrays are
+    removed when the total size exceeds `max_size`.
+
+    Parameters
+    ----------
+    cache_dir : str or Path
+        Cache directory.
+    max_size : int, optional
+        Maximum total size of the cache in bytes. Defaults to no limit.
+
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.max_size = max_size
+
+    def __len__(self):
+        return len(self._list_files())
+
+    def _get_path(self, key):
+        return self.cache_dir / key[:2] / (key + ".npy")
+
+    def _list_files(self):
+        return list(self.cache_dir.glob("*/*.npy"))
+
+    def load(self, key, mmap_mode=None):
+        """Load an array from the cache, or return None if not found."""
+        path = self._get_path(key)
+        try:
+            array = np.load(path, mmap_mode=mmap_mode)
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return array
+
+    def save(self, key, array):
+        """Save an array to the cache."""
+        path = self._get_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write to a temporary file first so that readers in other processes
+        # never see a partially written file
+        with tempfile.NamedTemporaryFile(
+            dir=path.parent, suffix=".tmp", delete=False
+        ) as f:
+            np.save(f, array)
+        os.replace(f.name, path)
+
+        if self.max_size is not None:
+            self.evict()
+
+    def size(self):
+        """Return the total size of the cache in bytes."""
+        total = 0
+        for path in self._list_files():
+            try:
+                total += path.stat().st_size
+            except FileNotFoundError:
+                pass
+        return total
+
+    def evict(self):
+        """Remove the least recently used arrays until under the size limit."""
+        entries = []
+        for path in self._list_files():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+    def clear(self):
+        """Remove all arrays from the cache."""
+        for path in self._list_files():
+            path.unlink(missing_ok=True)
+
+
+def main():
+    """Main function."""
+    # Parse the command-line arguments
+    args = parse_args()
+
+    # Set up the logger
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.ERROR if args.quiet else logging.INFO,
+        format="%(levelname)-8s %(message)s",
+    )
+
+    cache = Cache(args.cache_dir)
+    if args.clear:
+        cache.clear()
+        logging.info(f"Cleared the cache at {args.cache_dir}.")
+    else:
+        logging.info(
+            f"Found {len(cache)} arrays "
+            f"({cache.size() / 2**20:.1f} MB) in {args.cache_dir}."
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,375 @@
+"""Check the quality of the alignments and rank the suspicious ones."""
+import argparse
+import csv
+import logging
+import pathlib
+import sys
+
+import numpy as np
+
+import align_scores
+import parallel
+import warping
+
+# Metrics for which a larger value is more suspicious
+METRICS = (
+    "inverted",
+    "zero_length",
+    "backward",
+    "tempo_var",
+    "tempo_outliers",
+    "slope_outliers",
+    "pitch_misses",
+)
+
+
+def parse_args(args=None, namespace=None):
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c",
+        "--csv_filename",
+        type=pathlib.Path,
+        required=True,
+        help="input CSV filename",
+    )
+    parser.add_argument(
+        "-a",
+        "--alignment_dir",
+        type=pathlib.Path,
+        required=True,
+        help="alignment directory, with the warping paths if any",
+    )
+    parser.add_argument(
+        "-n",
+        "--notes_dir",
+        type=pathlib.Path,
+        required=True,
+        help="notes directory",
+    )
+    parser.add_argument(
+        "-w",
+        "--wav_dir",
+        type=pathlib.Path,
+        help="directory of the recordings to check the energy at the aligned "
+        "pitches (default: skip the energy check)",
+    )
+    parser.add_argument(
+        "-o", "--out_filename", type=pathlib.Path, help="output CSV filename"
+    )
+    parser.add_argument(
+        "-t",
+        "--top",
+        type=int,
+        default=10,
+        help="number of most suspicious alignments to show",
+    )
+    parser.add_argument(
+        "--tempo_window",
+        type=int,
+        default=8,
+        help="number of onsets over which the local tempo is measured",
+    )
+    parser.add_argument(
+        "--slope_window",
+        type=int,
+        default=64,
+        help="number of frames over which the slope of the warping path is "
+        "measured",
+    )
+    parser.add_argument(
+        "--max_ratio",
+        type=float,
+        default=2.0,
+        help="ratio of the local tempo or slope to the global one beyond "
+        "which it counts as an outlier",
+    )
+    parser.add_argument(
+        "--energy_threshold",
+        type=float,
+        default=30.0,
+        help="threshold in dB below the loudest bin of a frame for a pitch "
+        "to count as present",
+    )
+    parser.add_argument(
+        "-l", "--hop_length", type=int, default=512, help="hop length for CQT"
+    )
+    parser.add_argument(
+        "-b",
+        "--bins_per_note",
+        type=int,
+        default=3,
+        help="number of bins per note for CQT",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=pathlib.Path,
+        help="cache directory for the spectrograms, as for `align_scores.py`",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=float,
+        help="maximum size of the cache in MB (default: no limit)",
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="number of worker processes"
+    )
+    parser.add_argument(
+        "-q", "--quiet", action="store_true", help="show warnings only"
+    )
+    return parser.parse_args(args=args, namespace=namespace)
+
+
+def read_csv(filename):
+    """Read a CSV file into a dictionary."""
+    with open(filename) as f:
+        reader = csv.DictReader(f)
+        data = [
+            {field: row[field] for field in reader.fieldnames}
+            for row in reader
+        ]
+    return data
+
+
+def check_spans(notes, starts, ends):
+    """Return the fractions of bad note spans.
+
+    Returns the fractions of the notes that end before they start, that
+    have zero length though they last in the score, and that start before
+    an earlier note in the score.
+
+    """
+    inverted = ends < starts
+    zero_length = (ends == starts) & (notes[:, 1] > notes[:, 0])
+    order = np.argsort(notes[:, 0], kind="stable")
+    later = np.diff(notes[order, 0]) > 0
+    backward = later & (np.diff(starts[order]) < 0)
+    return (
+        inverted.mean(),
+        zero_length.mean(),
+        backward.sum() / max(later.sum(), 1),
+    )
+
+
+def check_tempo(onsets, starts, window, max_ratio):
+    """Return the variance and the fraction of outliers of the local tempo.
+
+    The local tempo is measured over each `window` consecutive distinct
+    onsets, from the first note starting at each onset, relative to the
+    global tempo. Its variance is computed in octaves.
+
+    """
+    unique_onsets, indices = np.unique(onsets, return_index=True)
+    window = min(window, len(unique_onsets) - 1)
+    if window < 1:
+        return 0.0, 0.0
+    times = starts[indices]
+    duration = times[-1] - times[0]
+    if duration <= 0:
+        return 0.0, 1.0
+    ratios = (
+        (times[window:] - times[:-window])
+        / (unique_onsets[window:] - unique_onsets[:-window])
+        * (unique_onsets[-1] - unique_onsets[0])
+        / duration
+    )
+    log_ratios = np.log2(np.maximum(ratios, 1 / 16))
+    outliers = np.abs(log_ratios) > np.log2(max_ratio)
+    return log_ratios.var(), outliers.mean()
+
+
+def check_slope(warp_path, window, max_ratio):
+    """Return the fraction of outliers of the slope of a warping path.
+
+    The slope is measured over each `window` consecutive frames of the
+    synthesized audio, relative to the global slope.
+
+    """
+    n_frames = warp_path[-1, 1] + 1
+    window = min(window, n_frames - 1)
+    if window < 1:
+        return 0.0
+    # Frame of the recording matched to each frame of the synthesized audio
+    frames = warp_path[
+        np.searchsorted(warp_path[:, 1], np.arange(n_frames)), 0
+    ]
+    slopes = (
+        (frames[window:] - frames[:-window])
+        / window
+        * (n_frames - 1)
+        / max(frames[-1] - frames[0], 1)
+    )
+    outliers = (slopes > max_ratio) | (slopes < 1 / max_ratio)
+    return outliers.mean()
+
+
+def check_energy(cqt_db, rate, pitches, starts, ends, args):
+    """Return the fraction of aligned frames missing the energy of a pitch.
+
+    A frame misses the energy of a pitch when no bin within a semitone of
+    the pitch, which allows for Baroque tuning, is within `energy_threshold`
+    dB of the loudest bin of the frame. Returns the mean of the fractions of
+    missing frames over the notes.
+
+    """
+    n_bins, n_frames = cqt_db.shape
+    bins = (pitches - 48) * args.bins_per_note
+    valid = (bins >= 0) & (bins < n_bins)
+    start_frames = np.clip(
+        np.round(starts * rate / args.hop_length).astype(int), 0, n_frames - 1
+    )
+    end_frames = np.clip(
+        np.round(ends * rate / args.hop_length).astype(int),
+        start_frames + 1,
+        n_frames,
+    )
+    bins, start_frames, end_frames = (
+        bins[valid],
+        start_frames[valid],
+        end_frames[valid],
+    )
+    if not len(bins):
+        return 0.0
+
+    # Find the salient bins of each frame, widened by a semitone
+    salient = cqt_db >= cqt_db.max(axis=0) - args.energy_threshold
+    widened = salient.copy()
+    for shift in range(1, args.bins_per_note + 1):
+        widened[shift:] |= salient[:-shift]
+        widened[:-shift] |= salient[shift:]
+
+    # Count the salient frames of each note by the cumulative sums
+    cumsum = np.zeros((n_bins, n_frames + 1), np.int32)
+    np.cumsum(widened, axis=1, out=cumsum[:, 1:])
+    hits = cumsum[bins, end_frames] - cumsum[bins, start_frames]
+    return float(np.mean(1 - hits / (end_frames - start_frames)))
+
+
+def process(row, args):
+    """Compute the quality metrics of an alignment."""
+    filename = row["filename"] + ".csv"
+    alignment_filename = args.alignment_dir / row["collection"] / filename
+    if not alignment_filename.is_file():
+        return "skipped"
+    notes = np.loadtxt(
+        args.notes_dir / row["collection"] / filename,
+        delimiter=",",
+        skiprows=1,
+        ndmin=2,
+        dtype=np.int64,
+    )
+    starts, ends = align_scores.read_alignment(alignment_filename)
+    if len(notes) != len(starts):
+        raise ValueError(
+            f"Expect {len(notes)} notes, but got {len(starts)} : "
+            f"{alignment_filename}"
+        )
+
+    result = {"filename": row["filename"], "n_notes": len(notes)}
+    result["inverted"], result["zero_length"], result["backward"] = (
+        check_spans(notes, starts, ends)
+    )
+    result["tempo_var"], result["tempo_outliers"] = check_tempo(
+        notes[:, 0], starts, args.tempo_window, args.max_ratio
+    )
+
+    # Check the warping path, if saved
+    path_filename = alignment_filename.with_suffix(".npy")
+    if path_filename.is_file():
+        result["slope_outliers"] = check_slope(
+            warping.load_path(path_filename), args.slope_window, args.max_ratio
+        )
+
+    # Check the energy at the aligned pitches
+    if args.wav_dir is not None:
+        cqt_db, rate = align_scores.load_features(
+            args.wav_dir / row["collection"] / (row["filename"] + ".wav"), args
+        )
+        result["pitch_misses"] = check_energy(
+            cqt_db, rate, notes[:, 2], starts, ends, args
+        )
+
+    return result
+
+
+def score(results):
+    """Return the suspicion score of each alignment.
+
+    The score sums the positive robust z-scores of the metrics over all
+    alignments, scaled by the median absolute deviation, or by the standard
+    deviation when most of the values are equal.
+
+    """
+    scores = np.zeros(len(results))
+    for metric in METRICS:
+        values = np.array(
+            [result.get(metric, np.nan) for result in results], float
+        )
+        available = ~np.isnan(values)
+        if not available.any():
+            continue
+        median = np.median(values[available])
+        scale = 1.4826 * np.median(np.abs(values[available] - median))
+        if scale == 0:
+            scale = values[available].std()
+        if scale == 0:
+            continue
+        z_scores = np.nan_to_num((values - median) / scale)
+        scores += np.maximum(z_scores, 0)
+    return scores
+
+
+def main():
+    """Main function."""
+    # Parse the command-line arguments
+    args = parse_args()
+
+    # Set up the logger
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.ERROR if args.quiet else logging.INFO,
+        format="%(levelname)-8s %(message)s",
+    )
+
+    # Read the CSV file
+    logging.info("Reading the CSV file...")
+    data = read_csv(args.csv_filename)
+
+    # Iterate over rows
+    logging.info("Iterating over rows...")
+    results = parallel.run(process, data, args, args.jobs)
+    parallel.summarize(data, results)
+    results = [result for result, _ in results if isinstance(result, dict)]
+    if not results:
+        logging.error("No alignments to check.")
+        return
+
+    # Rank the alignments by suspicion
+    for result, value in zip(results, score(results)):
+        result["score"] = value
+    results.sort(key=lambda result: result["score"], reverse=True)
+    for result in results[: args.top]:
+        logging.info(
+            f"{result['filename']:40} score={result['score']:.2f} "
+            + " ".join(
+                f"{metric}={result[metric]:.3f}"
+                for metric in METRICS
+                if metric in result
+            )
+        )
+
+    # Write the CSV file
+    if args.out_filename is not None:
+        fieldnames = ["filename", "n_notes", "score"] + [
+            metric
+            for metric in METRICS
+            if any(metric in result for result in results)
+        ]
+        with open(args.out_filename, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(results)
+
+
+if __name__ == "__main__":
+    main()
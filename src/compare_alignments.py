@@ -0,0 +1,150 @@
+"""Compare estimated alignments against reference alignments."""
+import argparse
+import csv
+import logging
+import pathlib
+import sys
+
+import numpy as np
+
+
+def parse_args(args=None, namespace=None):
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c",
+        "--csv_filename",
+        type=pathlib.Path,
+        required=True,
+        help="input CSV filename",
+    )
+    parser.add_argument(
+        "-r",
+        "--ref_dir",
+        type=pathlib.Path,
+        required=True,
+        help="reference alignment directory",
+    )
+    parser.add_argument(
+        "-e",
+        "--est_dir",
+        type=pathlib.Path,
+        required=True,
+        help="estimated alignment directory",
+    )
+    parser.add_argument(
+        "-o", "--out_filename", type=pathlib.Path, help="output CSV filename"
+    )
+    parser.add_argument(
+        "-t",
+        "--tolerance",
+        type=float,
+        default=0.05,
+        help="tolerance in seconds for an aligned time to count as correct",
+    )
+    parser.add_argument(
+        "-q", "--quiet", action="store_true", help="show warnings only"
+    )
+    return parser.parse_args(args=args, namespace=namespace)
+
+
+def read_csv(filename):
+    """Read a CSV file into a dictionary."""
+    with open(filename) as f:
+        reader = csv.DictReader(f)
+        data = [
+            {field: row[field] for field in reader.fieldnames}
+            for row in reader
+        ]
+    return data
+
+
+def read_alignment(filename):
+    """Read an alignment CSV file into an array of starts and ends."""
+    return np.loadtxt(filename, delimiter=",", skiprows=1, ndmin=2)
+
+
+def main():
+    """Main function."""
+    # Parse the command-line arguments
+    args = parse_args()
+
+    # Set up the logger
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.ERROR if args.quiet else logging.INFO,
+        format="%(levelname)-8s %(message)s",
+    )
+
+    # Read the CSV file
+    logging.info("Reading the CSV file...")
+    data = read_csv(args.csv_filename)
+
+    # Iterate over rows
+    logging.info("Iterating over rows...")
+    results = []
+    for row in data:
+        ref_filename = (
+            args.ref_dir / row["collection"] / (row["filename"] + ".csv")
+        )
+        est_filename = (
+            args.est_dir / row["collection"] / (row["filename"] + ".csv")
+        )
+        if not ref_filename.is_file() or not est_filename.is_file():
+            continue
+
+        # Compute the differences of the aligned times
+        ref = read_alignment(ref_filename)
+        est = read_alignment(est_filename)
+        if ref.shape != est.shape:
+            logging.warning(
+                f"Skipped {row['filename']} as the numbers of notes differ "
+                f"({len(ref)} vs {len(est)})."
+            )
+            continue
+        diff = np.abs(ref - est)
+        results.append(
+            {
+                "filename": row["filename"],
+                "n_notes": len(diff),
+                "mean": diff.mean(),
+                "median": np.median(diff),
+                "max": diff.max(),
+                "accuracy": np.mean(diff <= args.tolerance),
+            }
+        )
+        logging.info(
+            f"{row['filename']:40} mean={diff.mean():.4f}s "
+            f"max={diff.max():.4f}s "
+            f"accuracy={np.mean(diff <= args.tolerance):.2%}"
+        )
+
+    if not results:
+        logging.error("No alignments to compare.")
+        return
+
+    # Summarize the results
+    n_notes = np.array([result["n_notes"] for result in results])
+    means = np.array([result["mean"] for result in results])
+    accuracies = np.array([result["accuracy"] for result in results])
+    logging.info(
+        f"Compared {len(results)} files ({n_notes.sum()} notes) : "
+        f"mean={np.average(means, weights=n_notes):.4f}s "
+        f"max={max(result['max'] for result in results):.4f}s "
+        f"accuracy={np.average(accuracies, weights=n_notes):.2%}"
+    )
+
+    # Write the CSV file
+    if args.out_filename is not None:
+        with open(args.out_filename, "w") as f:
+            f.write("filename,n_notes,mean,median,max,accuracy\n")
+            for result in results:
+                f.write(
+                    f"{result['filename']},{result['n_notes']},"
+                    f"{result['mean']},{result['median']},{result['max']},"
+                    f"{result['accuracy']}\n"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+"""Dataset class for the Bach Violin Dataset."""
+import collections
+import csv
+import pathlib
+
+import librosa
+import numpy as np
+
+import audio_store
+
+
+def read_csv(filename):
+    """Read a CSV file into a dictionary."""
+    with open(filename) as f:
+        reader = csv.DictReader(f)
+        data = [
+            {field: row[field] for field in reader.fieldnames}
+            for row in reader
+        ]
+    return data
+
+
+def parse_time(time):
+    """Convert a time string in H:MM:SS format to seconds."""
+    seconds = 0.0
+    for part in time.split(":"):
+        seconds = 60 * seconds + float(part)
+    return seconds
+
+
+class LRUCache:
+    """Least-recently-used cache of a fixed number of items."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, func):
+        """Return the cached item, or compute it by calling `func(key)`."""
+        if key in self._items:
+            self._items.move_to_end(key)
+            return self._items[key]
+        item = func(key)
+        self._items[key] = item
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+        return item
+
+
+class BachViolinDataset:
+    """Bach Violin Dataset.
+
+    All movements in `info.csv` are indexed at construction time, while the
+    notes, alignments, tempos and audio of a movement are loaded only when
+    accessed. The metadata are stored as NumPy arrays rather than Python
+    objects, so that the memory pages of a dataset created before forking
+    worker processes stay shared.
+
+    Parameters
+    ----------
+    root : str or Path
+        Root directory of the dataset, i.e., the `bach-violin` directory.
+    wav_dir : str or Path, optional
+        Directory of the sliced audio created by `slice_audio.py`. If not
+        given, the audio is decoded from the source recordings.
+    cache_size : int
+        Maximum number of movements whose notes, alignments and tempos are
+        kept in memory.
+
+    Examples
+    --------
+    >>> dataset = BachViolinDataset("bach-violin/")
+    >>> subset = dataset.filter(violinist="emil-telmanyi", work="BWV1001")
+    >>> notes = subset.get_notes(0)
+    >>> alignment = subset.get_alignment("emil-telmanyi_bwv1001_mov1")
+
+    """
+
+    def __init__(self, root, wav_dir=None, cache_size=128):
+        self.root = pathlib.Path(root)
+        self.wav_dir = None if wav_dir is None else pathlib.Path(wav_dir)
+        self.cache_size = cache_size
+
+        # Index all movements
+        info = read_csv(self.root / "info.csv")
+        self._columns = {
+            field: np.array([row[field] for row in info]) for field in info[0]
+        }
+        self._columns["start_sec"] = np.array(
+            [parse_time(row["start"]) for row in info]
+        )
+        self._columns["end_sec"] = np.array(
+            [parse_time(row["end"]) for row in info]
+        )
+        self._sources = {
+            (row["collection"], row["filename"]): row
+            for row in read_csv(self.root / "audio.csv")
+        }
+        self._indices = np.arange(len(info))
+        self._init_caches()
+
+    def _init_caches(self):
+        self._notes_cache = LRUCache(self.cache_size)
+        self._alignment_cache = LRUCache(self.cache_size)
+        self._tempo_cache = LRUCache(self.cache_size)
+
+    def __len__(self):
+        return len(self._indices)
+
+    def __getitem__(self, key):
+        """Return the metadata of a movement as a dictionary."""
+        i = self._get_index(key)
+        return {
+            field: column[i].item() for field, column in self._columns.items()
+        }
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return f"{type(self).__name__}(root={self.root}, n={len(self)})"
+
+    def _get_index(self, key):
+        if isinstance(key, str):
+            matches = np.flatnonzero(
+                self._columns["filename"][self._indices] == key
+            )
+            if len(matches) == 0:
+                raise KeyError(key)
+            return self._indices[matches[0]]
+        return self._indices[key]
+
+    def _get_path(self, key, subdir, suffix):
+        i = self._get_index(key)
+        return (
+            self.root
+            / subdir
+            / self._columns["collection"][i]
+            / (self._columns["filename"][i] + suffix)
+        )
+
+    @property
+    def filenames(self):
+        """Return the filenames of the movements."""
+        return self._columns["filename"][self._indices].tolist()
+
+    def filter(
+        self, violinist=None, work=None, baroque_tuning=None, collection=None
+    ):
+        """Return a view of the dataset with only the matching movements.
+
+        Each argument can be a single value or a list of values. The view
+        shares the index with this dataset but has its own caches.
+
+        """
+        mask = np.ones(len(self._indices), bool)
+        for field, value in (
+            ("violinist", violinist),
+            ("work", work),
+            ("baroque_tuning", baroque_tuning),
+            ("collection", collection),
+        ):
+            if value is None:
+                continue
+            if isinstance(value, (str, bool, int)):
+                value = [value]
+            if field == "baroque_tuning":
+                value = [str(int(x)) for x in value]
+            mask &= np.isin(self._columns[field][self._indices], value)
+        view = object.__new__(type(self))
+        view.__dict__.update(self.__dict__)
+        view._indices = self._indices[mask]
+        view._init_caches()
+        return view
+
+    def get_notes(self, key):
+        """Return the notes of a movement.
+
+        Returns an array of shape (n_notes, 4) holding the onset, offset,
+        pitch and velocity of each note, with time in ticks.
+
+        """
+        return self._notes_cache.get(
+            self._get_path(key, "notes", ".csv"), _load_int_csv
+        )
+
+    def get_alignment(self, key):
+        """Return the alignment of a movement.
+
+        Returns an array of shape (n_notes, 2) holding the start and end
+        time of each note in the recording, in seconds.
+
+        """
+        return self._alignment_cache.get(
+            self._get_path(key, "alignments", ".csv"), _load_float_csv
+        )
+
+    def get_tempo(self, key):
+        """Return the average tempo of a movement in qpm."""
+        return self._tempo_cache.get(
+            self._get_path(key, "tempos", ".txt"), _load_tempo
+        )
+
+    def get_source(self, key):
+        """Return the metadata of the source recording in `audio.csv`."""
+        i = self._get_index(key)
+        return self._sources[
+            (
+                self._columns["collection"][i],
+                self._columns["source_filename"][i],
+            )
+        ]
+
+    def get_audio(self, key, sr=None):
+        """Load the audio of a movement.
+
+        The audio is read from `wav_dir` if given, otherwise only the part
+        of the source recording covering the movement is decoded.
+
+        """
+        i = self._get_index(key)
+        if self.wav_dir is not None:
+            return librosa.load(
+                audio_store.find(
+                    self.wav_dir
+                    / self._columns["collection"][i]
+                    / (self._columns["filename"][i] + ".wav")
+                ),
+                sr=sr,
+            )
+        start = self._columns["start_sec"][i]
+        return librosa.load(
+            self.root
+            / "audio"
+            / self._columns["collection"][i]
+            / self._columns["source_filename"][i],
+            sr=sr,
+            offset=start,
+            duration=self._columns["end_sec"][i] - start,
+        )
+
+
+def _load_int_csv(filename):
+    return np.loadtxt(
+        filename, delimiter=",", skiprows=1, dtype=np.int64, ndmin=2
+    )
+
+
+def _load_float_csv(filename):
+    return np.loadtxt(filename, delimiter=",", skiprows=1, ndmin=2)
+
+
+def _load_tempo(filename):
+    with open(filename) as f:
+        return float(f.read())
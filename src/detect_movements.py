@@ -0,0 +1,424 @@
+"""Detect the movement boundaries in recordings of whole works."""
+import argparse
+import csv
+import logging
+import os
+import pathlib
+import sys
+
+import librosa
+import muspy
+import numpy as np
+
+import dtw
+import features
+import instrumentation
+import parallel
+import process_scores
+import synthesize_scores
+
+# Fields of the candidate rows, as in `info.csv`
+FIELDNAMES = (
+    "filename",
+    "collection",
+    "violinist",
+    "violinist_name",
+    "work",
+    "title",
+    "mov",
+    "movement",
+    "source_filename",
+    "start",
+    "end",
+    "length",
+    "repeat1",
+    "repeat2",
+    "score_filename",
+    "baroque_tuning",
+)
+
+
+def parse_args(args=None, namespace=None):
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c",
+        "--csv_filename",
+        type=pathlib.Path,
+        required=True,
+        help="input CSV filename of the recordings, e.g., `audio.csv`",
+    )
+    parser.add_argument(
+        "-i",
+        "--input_dir",
+        type=pathlib.Path,
+        required=True,
+        help="dataset directory containing the audio and scores",
+    )
+    parser.add_argument(
+        "-o",
+        "--out_filename",
+        type=pathlib.Path,
+        required=True,
+        help="output CSV filename of the candidate rows",
+    )
+    parser.add_argument(
+        "--info_filename",
+        type=pathlib.Path,
+        help="existing `info.csv` to copy the movement names from",
+    )
+    parser.add_argument(
+        "-r", "--rate", type=int, default=16000, help="sampling rate"
+    )
+    parser.add_argument(
+        "-l", "--hop_length", type=int, default=512, help="hop length for CQT"
+    )
+    parser.add_argument(
+        "--resolution",
+        type=float,
+        default=0.5,
+        help="time resolution in seconds of the alignment",
+    )
+    parser.add_argument(
+        "-d", "--dtw", choices=dtw.ENGINES, default="full", help="DTW engine"
+    )
+    parser.add_argument(
+        "--dtw_radius",
+        type=int,
+        help="radius of the search band or window in frames for the band, "
+        "multiscale and online DTW engines",
+    )
+    parser.add_argument(
+        "--dtw_threads",
+        type=int,
+        help="number of threads for the full DTW engine (default: the "
+        "number of cores divided by the number of worker processes)",
+    )
+    parser.add_argument(
+        "--gap",
+        type=int,
+        default=4,
+        help="rest in quarter notes inserted between the movements of the "
+        "score",
+    )
+    parser.add_argument(
+        "--search_window",
+        type=float,
+        default=2.0,
+        help="time in seconds around each boundary to search for the "
+        "quietest frame",
+    )
+    parser.add_argument(
+        "--symbolic",
+        action="store_true",
+        help="whether to compute the chroma of the scores directly from the "
+        "notes instead of synthesizing them",
+    )
+    parser.add_argument(
+        "--cache_dir", type=pathlib.Path, help="cache directory for the notes"
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=float,
+        help="maximum size of the cache in MB (default: no limit)",
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="number of worker processes"
+    )
+    parser.add_argument(
+        "--largest_first",
+        action="store_true",
+        help="whether to process the longest recordings first",
+    )
+    parser.add_argument(
+        "--report",
+        type=pathlib.Path,
+        help="filename of the JSON or CSV report of the timings and peak "
+        "memory of each row",
+    )
+    parser.add_argument(
+        "--profile_dir",
+        type=pathlib.Path,
+        help="directory to save the cProfile statistics of the slowest rows",
+    )
+    parser.add_argument(
+        "--profile_slowest",
+        type=int,
+        default=5,
+        help="number of slowest rows to save the cProfile statistics for",
+    )
+    parser.add_argument(
+        "-q", "--quiet", action="store_true", help="show warnings only"
+    )
+    return parser.parse_args(args=args, namespace=namespace)
+
+
+def read_csv(filename):
+    """Read a CSV file into a dictionary."""
+    with open(filename) as f:
+        reader = csv.DictReader(f)
+        data = [
+            {field: row[field] for field in reader.fieldnames}
+            for row in reader
+        ]
+    return data
+
+
+def format_time(seconds):
+    """Convert seconds to a time string in H:MM:SS.ss format."""
+    minutes, seconds = divmod(round(seconds, 2), 60)
+    hours, minutes = divmod(int(minutes), 60)
+    return f"{hours}:{minutes:02d}:{seconds:05.2f}"
+
+
+def normalize(chroma):
+    """Normalize each frame of a chroma to unit length.
+
+    Silent frames are set to a flat chroma so that they match each other.
+
+    """
+    norms = np.linalg.norm(chroma, axis=0)
+    silent = norms < 1e-6
+    chroma = chroma / np.where(silent, 1, norms)
+    chroma[:, silent] = 1 / np.sqrt(12)
+    return chroma
+
+
+def compute_chroma(cqt_db, gamma=10.0):
+    """Compute the log-compressed chroma of a constant-Q spectrogram in dB.
+
+    The spectrogram must have one bin per note starting from a C.
+
+    """
+    n_octaves = cqt_db.shape[0] // 12
+    amplitude = np.power(10.0, cqt_db[: 12 * n_octaves] / 20)
+    chroma = amplitude.reshape(n_octaves, 12, -1).sum(axis=0)
+    return normalize(np.log1p(gamma * chroma))
+
+
+def notes_to_chroma(notes, n_frames, frames_per_tick):
+    """Compute the log-compressed chroma of the active notes in each frame.
+
+    Each note adds its velocity to its pitch class in the frames it sounds.
+
+    """
+    chroma = np.zeros((12, n_frames))
+    for onset, offset, pitch, velocity in notes:
+        start = int(onset * frames_per_tick)
+        end = max(int(offset * frames_per_tick), start + 1)
+        chroma[pitch % 12, start:end] += velocity
+    return normalize(np.log1p(chroma))
+
+
+def concatenate_notes(movement_notes, gap):
+    """Concatenate the notes of the movements with rests around them.
+
+    A rest of `gap` ticks is inserted before, between and after the
+    movements. Returns the concatenated notes, the middle tick of each rest
+    and the total length in ticks.
+
+    """
+    notes, rests = [], [gap / 2]
+    offset = gap
+    for mov_notes in movement_notes:
+        notes.append(mov_notes + np.array([offset, offset, 0, 0]))
+        offset += int(mov_notes[:, 1].max())
+        rests.append(offset + gap / 2)
+        offset += gap
+    return np.concatenate(notes), np.array(rests), offset
+
+
+def detect_boundaries(chroma, chroma_score, rests, args):
+    """Find the frames of the recording matching the rests of a score.
+
+    The chroma of the score is aligned to that of the recording, both as is
+    and a semitone lower for Baroque tuning. Returns the frames of the
+    recording matched to the middle of each rest by the better alignment,
+    and whether it is the one a semitone lower. As the chromas are
+    normalized, the Euclidean distance used by the DTW engines is monotonic
+    in their cosine distance.
+
+    """
+    best = None
+    for shift in (0, -1):
+        shifted = np.roll(chroma_score, shift, axis=0)
+        with instrumentation.phase("dtw"):
+            warp_path = dtw.compute_path(
+                chroma, shifted, args.dtw, args.dtw_radius, args.dtw_threads
+            )[::-1]
+        cost = np.linalg.norm(
+            chroma[:, warp_path[:, 0]] - shifted[:, warp_path[:, 1]], axis=0
+        ).sum()
+        if best is None or cost < best[0]:
+            best = (cost, warp_path, shift)
+    _, warp_path, shift = best
+    indices = np.searchsorted(warp_path[:, 1], rests)
+    return warp_path[np.clip(indices, 0, len(warp_path) - 1), 0], shift != 0
+
+
+def refine(frames, loudness, radius):
+    """Move each frame to the quietest frame within a radius."""
+    refined = []
+    for frame in frames:
+        lo = min(max(int(frame) - radius, 0), len(loudness) - 1)
+        hi = min(int(frame) + radius + 1, len(loudness))
+        refined.append(lo + int(np.argmin(loudness[lo:hi])))
+    return np.array(refined)
+
+
+def process(row, args):
+    """Process a recording and return its candidate rows."""
+    # Extract the notes of each movement
+    n_movements = int(row["movements"])
+    score_filenames = [
+        f"{row['work'].lower()}_mov{mov}" for mov in range(1, n_movements + 1)
+    ]
+    movement_notes = [
+        process_scores.get_notes(
+            {
+                "work": row["work"],
+                "score_filename": score_filename,
+                "baroque_tuning": "0",
+            },
+            args,
+        )
+        for score_filename in score_filenames
+    ]
+
+    # Load the recording and compute its spectrogram
+    with instrumentation.phase("decode"):
+        y, _ = librosa.load(
+            args.input_dir / "audio" / row["collection"] / row["filename"],
+            sr=args.rate,
+        )
+    n_samples = len(y)
+    extractor = features.get_extractor(args.rate, args.hop_length, 1)
+    with instrumentation.phase("cqt"):
+        cqt_db = extractor(y)
+    del y
+    frame_time = args.hop_length / args.rate
+    factor = max(int(round(args.resolution / frame_time)), 1)
+    loudness = cqt_db.max(axis=0)
+    chroma = dtw.downsample(compute_chroma(cqt_db), factor)
+    del cqt_db
+
+    # Concatenate the movements at the tempo that matches the recording
+    notes, rests, n_ticks = concatenate_notes(
+        movement_notes, args.gap * muspy.DEFAULT_RESOLUTION
+    )
+    music = synthesize_scores.make_music(notes)
+    qpm = synthesize_scores.compute_qpm(music, args.rate, n_samples)
+    frames_per_tick = 60 / qpm / music.resolution / frame_time / factor
+    n_frames_score = int(np.ceil(n_ticks * frames_per_tick)) + 1
+
+    # Compute the chroma of the score
+    if args.symbolic:
+        chroma_score = notes_to_chroma(notes, n_frames_score, frames_per_tick)
+    else:
+        y_synth = synthesize_scores.synthesize(music, qpm, args.rate)
+        with instrumentation.phase("cqt"):
+            cqt_db_synth = extractor(y_synth)
+        del y_synth
+        chroma_score = dtw.downsample(compute_chroma(cqt_db_synth), factor)
+        del cqt_db_synth
+
+        # Pad the final rest, which is not synthesized
+        chroma_score = np.pad(
+            chroma_score,
+            ((0, 0), (0, max(n_frames_score - chroma_score.shape[1], 0))),
+            constant_values=1 / np.sqrt(12),
+        )
+
+    # Align the score to the recording
+    boundaries, is_baroque = detect_boundaries(
+        chroma, chroma_score, rests * frames_per_tick, args
+    )
+
+    # Move each boundary to the quietest frame around it
+    boundaries = refine(
+        boundaries * factor,
+        loudness,
+        int(round(args.search_window / frame_time)),
+    )
+
+    # Create the candidate rows
+    collection = row["collection"]
+    rows = []
+    for mov, score_filename in enumerate(score_filenames, 1):
+        start = boundaries[mov - 1] * frame_time
+        end = boundaries[mov] * frame_time
+        rows.append(
+            {
+                "filename": f"{collection}_{score_filename}",
+                "collection": collection,
+                "violinist": collection,
+                "violinist_name": row["violinist"],
+                "work": row["work"],
+                "title": row["title"],
+                "mov": str(mov),
+                "movement": args.movement_names.get(
+                    (row["work"], str(mov)), ""
+                ),
+                "source_filename": row["filename"],
+                "start": format_time(start),
+                "end": format_time(end),
+                "length": format_time(end - start),
+                "repeat1": "",
+                "repeat2": "",
+                "score_filename": score_filename,
+                "baroque_tuning": str(int(is_baroque)),
+            }
+        )
+    return rows
+
+
+def main():
+    """Main function."""
+    # Parse the command-line arguments
+    args = parse_args()
+
+    # Set up the logger
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.ERROR if args.quiet else logging.INFO,
+        format="%(levelname)-8s %(message)s",
+    )
+
+    # Read the CSV files
+    logging.info("Reading the CSV files...")
+    data = read_csv(args.csv_filename)
+    args.movement_names = {}
+    if args.info_filename is not None:
+        for row in read_csv(args.info_filename):
+            args.movement_names[(row["work"], row["mov"])] = row["movement"]
+
+    # Detect the tuning from the recordings rather than adjusting the notes
+    args.adjust_tuning_pitches = False
+
+    # Share the cores among the worker processes
+    if args.dtw_threads is None:
+        args.dtw_threads = max(os.cpu_count() // args.jobs, 1)
+
+    # Iterate over recordings
+    logging.info("Iterating over recordings...")
+    report = instrumentation.make_report(args)
+    results = parallel.run(
+        process, data, args, args.jobs, args.largest_first, report
+    )
+    n_failed = parallel.summarize(data, results)
+    instrumentation.save_report(report, args)
+
+    # Write the candidate rows
+    with open(args.out_filename, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
+        writer.writeheader()
+        for rows, _ in results:
+            if rows is not None:
+                writer.writerows(rows)
+
+    if n_failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""Memory-bounded dynamic time warping (DTW) engines.
+
+The kernels are imported from `dtw_kernels` only when an engine is run, as
+Numba is slow to import.
+
+"""
+
+import numpy as np
+
+ENGINES = ("full", "band", "multiscale", "online")
+
+
+def _fix_band(lo, hi, n_cols):
+    """Make a band monotonic and connected from (0, 0) to (N-1, M-1)."""
+    lo = np.clip(lo, 0, n_cols - 1)
+    hi = np.clip(hi, 1, n_cols)
+    lo[0] = 0
+    hi[-1] = n_cols
+    lo = np.minimum.accumulate(lo[::-1])[::-1]
+    hi = np.maximum.accumulate(np.maximum(hi, lo + 1))
+    lo[1:] = np.minimum(lo[1:], hi[:-1])
+    return lo.astype(np.int64), hi.astype(np.int64)
+
+
+def dtw_band(X, Y, lo, hi):
+    """Run DTW restricted to a band.
+
+    Parameters
+    ----------
+    X : np.ndarray, shape=(n_features, N)
+        First feature sequence.
+    Y : np.ndarray, shape=(n_features, M)
+        Second feature sequence.
+    lo, hi : np.ndarray, shape=(N,)
+        Column range `[lo[i], hi[i])` of the band for each row `i`.
+
+    Returns
+    -------
+    np.ndarray, shape=(K, 2)
+        Warping path in the same (reversed) order as returned by
+        :func:`librosa.sequence.dtw`.
+
+    """
+    import dtw_kernels
+
+    lo, hi = _fix_band(np.asarray(lo), np.asarray(hi), Y.shape[1])
+    offsets = np.zeros(len(lo) + 1, np.int64)
+    np.cumsum(hi - lo, out=offsets[1:])
+    X = np.ascontiguousarray(X.T)
+    Y = np.ascontiguousarray(Y.T)
+    _, steps = dtw_kernels.band_accumulate(X, Y, lo, hi, offsets)
+    return dtw_kernels.band_backtrack(steps, lo, hi, offsets)
+
+
+def dtw_full(X, Y, tile_size=256, n_threads=None):
+    """Run full DTW with a parallel wavefront over tiles.
+
+    The matrix is split into square tiles, which are computed along their
+    anti-diagonals by `n_threads` threads. The path is the same as returned
+    by :func:`librosa.sequence.dtw`, as the costs are computed in the same
+    order in double precision, but only the steps are kept for the whole
+    matrix, i.e., NM bytes.
+
+    Parameters
+    ----------
+    X : np.ndarray, shape=(n_features, N)
+        First feature sequence.
+    Y : np.ndarray, shape=(n_features, M)
+        Second feature sequence.
+    tile_size : int
+        Number of rows and columns of each tile.
+    n_threads : int, optional
+        Number of threads. Defaults to all the cores.
+
+    Returns
+    -------
+    np.ndarray, shape=(K, 2)
+        Warping path in the same (reversed) order as returned by
+        :func:`librosa.sequence.dtw`.
+
+    """
+    import dtw_kernels
+
+    if n_threads is not None:
+        dtw_kernels.set_num_threads(n_threads)
+    X = np.ascontiguousarray(X.T)
+    Y = np.ascontiguousarray(Y.T)
+    return dtw_kernels.backtrack(
+        dtw_kernels.wavefront_accumulate(X, Y, tile_size)
+    )
+
+
+def sakoe_chiba_band(n_rows, n_cols, radius):
+    """Return a Sakoe-Chiba band of the given radius around the diagonal."""
+    center = np.arange(n_rows) * (n_cols - 1) / max(n_rows - 1, 1)
+    lo = np.floor(center).astype(np.int64) - radius
+    hi = np.ceil(center).astype(np.int64) + radius + 1
+    return lo, hi
+
+
+def project_path(warp_path, n_rows, n_cols, factor, radius):
+    """Project a coarse warping path to a band at a finer resolution."""
+    n_coarse = (n_rows + factor - 1) // factor
+    coarse_lo = np.full(n_coarse, np.iinfo(np.int64).max)
+    coarse_hi = np.zeros(n_coarse, np.int64)
+    np.minimum.at(coarse_lo, warp_path[:, 0], warp_path[:, 1])
+    np.maximum.at(coarse_hi, warp_path[:, 0], warp_path[:, 1])
+    rows = np.arange(n_rows) // factor
+    lo = coarse_lo[rows] * factor - radius
+    hi = (coarse_hi[rows] + 1) * factor + radius
+    return lo, hi
+
+
+def downsample(X, factor):
+    """Downsample a feature sequence by averaging every `factor` frames."""
+    n_frames = (X.shape[1] + factor - 1) // factor
+    padded = np.pad(
+        X, ((0, 0), (0, n_frames * factor - X.shape[1])), mode="edge"
+    )
+    return padded.reshape(X.shape[0], n_frames, factor).mean(axis=2)
+
+
+def dtw_multiscale(X, Y, factor=4, radius=16, min_size=256):
+    """Run coarse-to-fine DTW.
+
+    The sequences are recursively downsampled by `factor` until the shorter
+    one has fewer than `min_size` frames. The coarsest level is aligned with
+    full DTW, and each finer level is aligned inside a band around the
+    projected path of the coarser level, dilated by `radius` frames.
+
+    """
+    if min(X.shape[1], Y.shape[1]) < min_size:
+        lo = np.zeros(X.shape[1], np.int64)
+        hi = np.full(X.shape[1], Y.shape[1], np.int64)
+        return dtw_band(X, Y, lo, hi)
+    coarse_path = dtw_multiscale(
+        downsample(X, factor), downsample(Y, factor), factor, radius, min_size
+    )
+    lo, hi = project_path(coarse_path, X.shape[1], Y.shape[1], factor, radius)
+    return dtw_band(X, Y, lo, hi)
+
+
+class OnlineDTW:
+    """Online DTW that follows a reference sequence frame by frame.
+
+    The frames of the query sequence are fed in chunks, and each frame is
+    matched to a window of `2 * radius + 1` frames of the reference that
+    follows the position of the previous frame. Only the accumulated costs
+    of the last frame are kept, so the memory usage does not depend on the
+    length of the query. The position of each frame is the cell of the
+    window with the lowest accumulated cost per step of the path, which
+    never moves backward.
+
+    Parameters
+    ----------
+    Y : np.ndarray, shape=(n_features, M)
+        Reference sequence.
+    radius : int
+        Radius of the search window in frames.
+
+    """
+
+    def __init__(self, Y, radius=256):
+        self.Y = np.ascontiguousarray(Y.T)
+        self.radius = radius
+        self.n_rows = 0
+        self._D = np.full(min(2 * radius + 1, Y.shape[1]), np.inf)
+        self._lo = 0
+        self._position = 0
+
+    def update(self, X):
+        """Feed a chunk of the query sequence.
+
+        Parameters
+        ----------
+        X : np.ndarray, shape=(n_features, n)
+            Next chunk of the query sequence.
+
+        Returns
+        -------
+        np.ndarray, shape=(n,)
+            Position in the reference of each frame of the chunk.
+
+        """
+        import dtw_kernels
+
+        positions = np.empty(X.shape[1], np.int64)
+        if not len(positions):
+            return positions
+        self._lo = dtw_kernels.online_accumulate(
+            np.ascontiguousarray(X.T),
+            self.Y,
+            self._D,
+            self._lo,
+            self.n_rows,
+            self.radius,
+            self._position,
+            positions,
+        )
+        self.n_rows += len(positions)
+        self._position = positions[-1]
+        return positions
+
+
+def dtw_online(X, Y, radius=256, chunk_size=1024):
+    """Run online DTW over the query sequence in chunks.
+
+    Returns the path with one point per frame of `X`, in the same (reversed)
+    order as returned by :func:`librosa.sequence.dtw`.
+
+    """
+    online_dtw = OnlineDTW(Y, radius)
+    positions = np.concatenate(
+        [
+            online_dtw.update(X[:, start : start + chunk_size])
+            for start in range(0, X.shape[1], chunk_size)
+        ]
+    )
+    return np.stack([np.arange(len(positions)), positions], 1)[::-1]
+
+
+def compute_path(X, Y, engine="full", radius=None, n_threads=None):
+    """Compute the warping path between two feature sequences.
+
+    Parameters
+    ----------
+    X : np.ndarray, shape=(n_features, N)
+        First feature sequence.
+    Y : np.ndarray, shape=(n_features, M)
+        Second feature sequence.
+    engine : {'full', 'band', 'multiscale', 'online'}
+        DTW engine to use. The 'full' engine computes the same path as
+        :func:`librosa.sequence.dtw` on several threads and needs O(NM)
+        memory. The 'band' engine restricts the search to a Sakoe-Chiba
+        band around the diagonal. The 'multiscale' engine runs
+        coarse-to-fine DTW. Both need O(N * radius) memory. The 'online'
+        engine follows `Y` frame by frame in a search window and needs
+        O(radius) memory besides the path, but the path is decided without
+        looking ahead and need not end at the last frame of `Y`.
+    radius : int, optional
+        Radius of the band or the search window in frames. Defaults to 512
+        for the 'band' engine, 16 for the 'multiscale' engine and 256 for
+        the 'online' engine.
+    n_threads : int, optional
+        Number of threads for the 'full' engine. Defaults to all the cores.
+
+    Returns
+    -------
+    np.ndarray, shape=(K, 2)
+        Warping path in the same (reversed) order as returned by
+        :func:`librosa.sequence.dtw`.
+
+    """
+    if engine == "full":
+        return dtw_full(X, Y, n_threads=n_threads)
+    if engine == "band":
+        lo, hi = sakoe_chiba_band(
+            X.shape[1], Y.shape[1], 512 if radius is None else radius
+        )
+        return dtw_band(X, Y, lo, hi)
+    if engine == "multiscale":
+        return dtw_multiscale(X, Y, radius=16 if radius is None else radius)
+    if engine == "online":
+        return dtw_online(X, Y, radius=256 if radius is None else radius)
+    raise ValueError(f"Unknown DTW engine : {engine}")
@@ -0,0 +1,248 @@
+"""Numba kernels of the DTW engines.
+
+They are kept apart from `dtw` so that importing it does not load Numba,
+which is slow to import.
+
+"""
+
+import numba
+import numpy as np
+
+
+@numba.jit(nopython=True, cache=True)
+def band_accumulate(X, Y, lo, hi, offsets):
+    """Compute the accumulated costs and steps inside a band.
+
+    The steps are indexed as in :func:`librosa.sequence.dtw`, i.e., 0 for a
+    diagonal step, 1 for a horizontal step and 2 for a vertical step, and
+    ties are broken in the same order.
+
+    """
+    n_dims = X.shape[1]
+    D = np.full(offsets[-1], np.inf)
+    steps = np.zeros(offsets[-1], np.int8)
+    for i in range(X.shape[0]):
+        for j in range(lo[i], hi[i]):
+            # Compute the Euclidean distance as scipy.spatial.distance.cdist
+            dist = 0.0
+            for k in range(n_dims):
+                diff = np.float64(X[i, k]) - np.float64(Y[j, k])
+                dist += diff * diff
+            cost = np.sqrt(dist)
+            idx = offsets[i] + j - lo[i]
+            if i == 0 and j == 0:
+                D[idx] = cost
+                continue
+            best = np.inf
+            step = 0
+            if i > 0 and lo[i - 1] <= j - 1 < hi[i - 1]:
+                candidate = D[offsets[i - 1] + j - 1 - lo[i - 1]] + cost
+                if candidate < best:
+                    best = candidate
+                    step = 0
+            if j > lo[i]:
+                candidate = D[idx - 1] + cost
+                if candidate < best:
+                    best = candidate
+                    step = 1
+            if i > 0 and lo[i - 1] <= j < hi[i - 1]:
+                candidate = D[offsets[i - 1] + j - lo[i - 1]] + cost
+                if candidate < best:
+                    best = candidate
+                    step = 2
+            D[idx] = best
+            steps[idx] = step
+    return D, steps
+
+
+@numba.jit(nopython=True, cache=True)
+def band_backtrack(steps, lo, hi, offsets):
+    """Backtrack the warping path from the last cell of a band."""
+    i = len(lo) - 1
+    j = hi[-1] - 1
+    warp_path = np.empty((i + j + 1, 2), np.int64)
+    k = 0
+    warp_path[k] = (i, j)
+    while i > 0 or j > 0:
+        step = steps[offsets[i] + j - lo[i]]
+        if step == 0:
+            i -= 1
+            j -= 1
+        elif step == 1:
+            j -= 1
+        else:
+            i -= 1
+        k += 1
+        warp_path[k] = (i, j)
+    return warp_path[: k + 1]
+
+
+@numba.jit(nopython=True, cache=True)
+def fill_tile(X, Y, i0, i1, j0, j1, top, left, corner, steps):
+    """Compute the accumulated costs and steps of a tile of the full matrix.
+
+    `top` holds the accumulated costs of the row above the tile and `left`
+    those of the column left of it, with `corner` the one above and left of
+    the tile. They are infinite outside the matrix. The steps are written
+    into `steps` as in `band_accumulate`. Returns the accumulated costs of
+    the last row and of the last column of the tile.
+
+    """
+    n_dims = X.shape[1]
+    width = j1 - j0
+    prev = np.empty(width + 1)
+    cur = np.empty(width + 1)
+    prev[0] = corner
+    prev[1:] = top
+    last_col = np.empty(i1 - i0)
+    for i in range(i0, i1):
+        cur[0] = left[i - i0]
+        for k in range(width):
+            j = j0 + k
+            # Compute the Euclidean distance as scipy.spatial.distance.cdist
+            dist = 0.0
+            for d in range(n_dims):
+                diff = np.float64(X[i, d]) - np.float64(Y[j, d])
+                dist += diff * diff
+            cost = np.sqrt(dist)
+            if i == 0 and j == 0:
+                cur[1] = cost
+                steps[0, 0] = 0
+                continue
+            best = np.inf
+            step = 0
+            candidate = prev[k] + cost
+            if candidate < best:
+                best = candidate
+                step = 0
+            candidate = cur[k] + cost
+            if candidate < best:
+                best = candidate
+                step = 1
+            candidate = prev[k + 1] + cost
+            if candidate < best:
+                best = candidate
+                step = 2
+            cur[k + 1] = best
+            steps[i, j] = step
+        last_col[i - i0] = cur[width]
+        prev, cur = cur, prev
+    return prev[1:].copy(), last_col
+
+
+@numba.jit(nopython=True, parallel=True, cache=True)
+def wavefront_accumulate(X, Y, tile_size):
+    """Compute the steps of the full matrix tile by tile.
+
+    The tiles on each anti-diagonal depend only on those of the previous
+    ones, so they are computed in parallel. Only the accumulated costs of
+    the last row and column of each tile are kept for the next tiles.
+
+    """
+    n_rows, n_cols = X.shape[0], Y.shape[0]
+    n_tile_rows = (n_rows + tile_size - 1) // tile_size
+    n_tile_cols = (n_cols + tile_size - 1) // tile_size
+    steps = np.empty((n_rows, n_cols), np.int8)
+    # Accumulated costs of the last row of each row of tiles and of the last
+    # column of each column of tiles
+    row_edges = np.full((n_tile_rows, n_cols), np.inf)
+    col_edges = np.full((n_tile_cols, n_rows), np.inf)
+    inf_row = np.full(tile_size, np.inf)
+    for diagonal in range(n_tile_rows + n_tile_cols - 1):
+        first = max(diagonal - n_tile_cols + 1, 0)
+        last = min(diagonal, n_tile_rows - 1)
+        for t in numba.prange(last - first + 1):
+            ti = first + t
+            tj = diagonal - ti
+            i0, j0 = ti * tile_size, tj * tile_size
+            i1 = min(i0 + tile_size, n_rows)
+            j1 = min(j0 + tile_size, n_cols)
+            top = row_edges[ti - 1, j0:j1] if ti > 0 else inf_row[: j1 - j0]
+            left = col_edges[tj - 1, i0:i1] if tj > 0 else inf_row[: i1 - i0]
+            corner = row_edges[ti - 1, j0 - 1] if ti > 0 and tj > 0 else np.inf
+            last_row, last_col = fill_tile(
+                X, Y, i0, i1, j0, j1, top, left, corner, steps
+            )
+            row_edges[ti, j0:j1] = last_row
+            col_edges[tj, i0:i1] = last_col
+    return steps
+
+
+@numba.jit(nopython=True, cache=True)
+def backtrack(steps):
+    """Backtrack the warping path from the last cell of the full matrix."""
+    i = steps.shape[0] - 1
+    j = steps.shape[1] - 1
+    warp_path = np.empty((i + j + 1, 2), np.int64)
+    k = 0
+    warp_path[k] = (i, j)
+    while i > 0 or j > 0:
+        step = steps[i, j]
+        if step == 0:
+            i -= 1
+            j -= 1
+        elif step == 1:
+            j -= 1
+        else:
+            i -= 1
+        k += 1
+        warp_path[k] = (i, j)
+    return warp_path[: k + 1]
+
+
+@numba.jit(nopython=True, cache=True)
+def online_accumulate(X, Y, D, lo, n_rows, radius, position, positions):
+    """Advance online DTW by the rows of a chunk.
+
+    `D` holds the accumulated costs of the last row in the window of columns
+    starting at `lo`, and is updated in place. `position` is the position of
+    the last row. The position of each row of the chunk is written into
+    `positions`, and the start of the window after the chunk is returned.
+
+    """
+    width = len(D)
+    n_cols = Y.shape[0]
+    n_dims = X.shape[1]
+    prev = np.empty(width)
+    for r in range(X.shape[0]):
+        i = n_rows + r
+        if i > 0:
+            # Center the window on the position of the previous row, without
+            # moving it backward
+            new_lo = min(max(position - radius, lo), max(n_cols - width, 0))
+            shift = new_lo - lo
+            for k in range(width):
+                prev[k] = D[k + shift] if k + shift < width else np.inf
+            lo = new_lo
+        best = np.inf
+        best_j = position
+        for k in range(min(width, n_cols - lo)):
+            j = lo + k
+            # Compute the Euclidean distance as scipy.spatial.distance.cdist
+            dist = 0.0
+            for d in range(n_dims):
+                diff = np.float64(X[r, d]) - np.float64(Y[j, d])
+                dist += diff * diff
+            cost = np.sqrt(dist)
+            if i == 0:
+                D[k] = cost + (D[k - 1] if k > 0 else 0.0)
+            else:
+                acc = prev[k]
+                if k > 0:
+                    acc = min(acc, prev[k - 1], D[k - 1])
+                D[k] = cost + acc
+            # Follow the cell of the lowest cost per step of the path
+            normalized = D[k] / (i + j + 2)
+            if normalized < best:
+                best = normalized
+                best_j = j
+        position = max(position, best_j)
+        positions[r] = position
+    return lo
+
+
+def set_num_threads(n_threads):
+    """Set the number of threads of the parallel kernels."""
+    numba.set_num_threads(
+        min(max(n_threads, 1), numba.config.NUMBA_NUM_THREADS)
+    )
@@ -0,0 +1,182 @@
+"""Export the notes and alignments into packed, memory-mappable arrays."""
+import argparse
+import csv
+import logging
+import pathlib
+import sys
+
+import numpy as np
+
+NOTE_DTYPE = np.dtype(
+    [
+        ("onset", np.int32),
+        ("offset", np.int32),
+        ("pitch", np.int16),
+        ("velocity", np.int16),
+        ("start", np.float64),
+        ("end", np.float64),
+    ]
+)
+
+
+def parse_args(args=None, namespace=None):
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c",
+        "--csv_filename",
+        type=pathlib.Path,
+        required=True,
+        help="input CSV filename",
+    )
+    parser.add_argument(
+        "-i",
+        "--input_dir",
+        type=pathlib.Path,
+        required=True,
+        help="input data directory",
+    )
+    parser.add_argument(
+        "-o",
+        "--out_dir",
+        type=pathlib.Path,
+        required=True,
+        help="output directory",
+    )
+    parser.add_argument(
+        "-q", "--quiet", action="store_true", help="show warnings only"
+    )
+    return parser.parse_args(args=args, namespace=namespace)
+
+
+def read_csv(filename):
+    """Read a CSV file into a dictionary."""
+    with open(filename) as f:
+        reader = csv.DictReader(f)
+        data = [
+            {field: row[field] for field in reader.fieldnames}
+            for row in reader
+        ]
+    return data
+
+
+class PackedDataset:
+    """Packed notes and alignments exported by this script.
+
+    The notes of all movements are stored contiguously in `notes.npy` and
+    memory-mapped, so the notes of any movement can be accessed by filename
+    without parsing.
+
+    Parameters
+    ----------
+    data_dir : str or Path
+        Directory containing `notes.npy` and `index.npy`.
+
+    """
+
+    def __init__(self, data_dir):
+        data_dir = pathlib.Path(data_dir)
+        self.notes = np.load(data_dir / "notes.npy", mmap_mode="r")
+        self.index = np.load(data_dir / "index.npy")
+        self._positions = {
+            filename: i for i, filename in enumerate(self.index["filename"])
+        }
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, filename):
+        return filename in self._positions
+
+    def __getitem__(self, filename):
+        """Return the notes of a movement as a structured array.
+
+        The array has fields `onset`, `offset`, `pitch`, `velocity`, `start`
+        and `end`.
+
+        """
+        entry = self.index[self._positions[filename]]
+        return self.notes[entry["offset"] : entry["offset"] + entry["count"]]
+
+    @property
+    def filenames(self):
+        """Return the filenames of all the movements."""
+        return list(self.index["filename"])
+
+
+def main():
+    """Main function."""
+    # Parse the command-line arguments
+    args = parse_args()
+
+    # Make sure output directory exists
+    args.out_dir.mkdir(exist_ok=True)
+
+    # Set up the logger
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.ERROR if args.quiet else logging.INFO,
+        format="%(levelname)-8s %(message)s",
+    )
+
+    # Read the CSV file
+    logging.info("Reading the CSV file...")
+    data = read_csv(args.csv_filename)
+
+    # Iterate over rows
+    logging.info("Iterating over rows...")
+    arrays = []
+    for row in data:
+        # Read the notes
+        notes = read_csv(
+            args.input_dir
+            / "notes"
+            / row["collection"]
+            / (row["filename"] + ".csv")
+        )
+        array = np.zeros(len(notes), NOTE_DTYPE)
+        for field in ("onset", "offset", "pitch", "velocity"):
+            array[field] = [int(note[field]) for note in notes]
+
+        # Read the alignment
+        alignment_filename = (
+            args.input_dir
+            / "alignments"
+            / row["collection"]
+            / (row["filename"] + ".csv")
+        )
+        if alignment_filename.is_file():
+            alignment = read_csv(alignment_filename)
+            assert len(alignment) == len(notes)
+            for field in ("start", "end"):
+                array[field] = [float(note[field]) for note in alignment]
+        else:
+            logging.warning(f"No alignment found for {row['filename']}.")
+            array["start"] = np.nan
+            array["end"] = np.nan
+        arrays.append(array)
+
+    # Build the index
+    counts = np.array([len(array) for array in arrays], np.int64)
+    index = np.zeros(
+        len(data),
+        [
+            ("filename", f"U{max(len(row['filename']) for row in data)}"),
+            ("collection", f"U{max(len(row['collection']) for row in data)}"),
+            ("offset", np.int64),
+            ("count", np.int64),
+        ],
+    )
+    index["filename"] = [row["filename"] for row in data]
+    index["collection"] = [row["collection"] for row in data]
+    index["offset"][1:] = np.cumsum(counts)[:-1]
+    index["count"] = counts
+
+    # Save the arrays
+    np.save(args.out_dir / "notes.npy", np.concatenate(arrays))
+    np.save(args.out_dir / "index.npy", index)
+    logging.info(f"Exported {counts.sum()} notes in {len(data)} movements.")
+
+
+if __name__ == "__main__":
+    main()
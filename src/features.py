@@ -0,0 +1,278 @@
+"""Constant-Q spectrogram features with reusable filter kernels."""
+import functools
+
+import librosa
+import numpy as np
+import scipy.signal
+import soundfile as sf
+
+# Equivalent noise bandwidth of the Hann window in FFT bins
+_HANN_BANDWIDTH = 1.50018310546875
+
+
+class CQTExtractor:
+    """Extractor of constant-Q spectrograms in dB.
+
+    The constant-Q transform is computed an octave at a time as in
+    `librosa.cqt`, by applying the frequency-domain kernels of the filters of
+    the top octave to the STFT of the signal and downsampling the signal by
+    two for each lower octave. The kernels are built once when the extractor
+    is created and reused for every signal passed through it, and the
+    magnitudes of each octave are written into the output array and
+    converted to dB in place so that no full-size complex or magnitude copy
+    of the spectrogram is kept.
+
+    Parameters
+    ----------
+    rate : int
+        Sampling rate of the signals.
+    hop_length : int
+        Hop length in samples.
+    fmin : float
+        Center frequency of the lowest bin in Hz.
+    n_bins : int
+        Number of frequency bins.
+    bins_per_octave : int
+        Number of bins per octave.
+    dtype : np.dtype, optional
+        Real dtype of the computation and of the output, e.g., `np.float32`.
+        Defaults to the dtype of each input signal.
+    filter_scale : float
+        Scale of the filter lengths.
+    sparsity : float
+        Fraction of the energy of each kernel to discard.
+    top_db : float
+        Threshold of the output in dB below the peak, or below `ref` if
+        given.
+    ref : float, optional
+        Fixed reference magnitude of 0 dB. Defaults to the peak magnitude of
+        each signal. A fixed reference makes the spectrograms of consecutive
+        chunks of a signal consistent, as needed by `iter_chunks`.
+
+    """
+
+    def __init__(
+        self,
+        rate,
+        hop_length,
+        fmin,
+        n_bins,
+        bins_per_octave,
+        dtype=None,
+        filter_scale=1,
+        sparsity=0.01,
+        top_db=80.0,
+        ref=None,
+    ):
+        self.rate = rate
+        self.hop_length = hop_length
+        self.n_bins = n_bins
+        self.dtype = dtype
+        self.top_db = top_db
+        self.ref = ref
+
+        # Compute the center frequencies and the relative bandwidth
+        self.n_octaves = int(np.ceil(n_bins / bins_per_octave))
+        freqs = fmin * 2.0 ** (np.arange(n_bins) / bins_per_octave)
+        alpha = (2.0 ** (2 / bins_per_octave) - 1) / (
+            2.0 ** (2 / bins_per_octave) + 1
+        )
+        quality = filter_scale / alpha
+        cutoff = freqs[-1] * (1 + 0.5 * _HANN_BANDWIDTH / quality)
+        if cutoff > rate / 2:
+            raise ValueError(
+                f"The filter of the highest frequency {freqs[-1]:.1f} Hz "
+                f"exceeds the Nyquist frequency {rate / 2} Hz."
+            )
+
+        # Downsample early when the top octave is far below the Nyquist
+        # frequency and the hop length allows
+        self.n_early = max(0, int(np.ceil(np.log2(rate / 2 / cutoff))) - 2)
+        n_twos = 0
+        while hop_length % 2 ** (n_twos + 1) == 0:
+            n_twos += 1
+        self.n_early = min(self.n_early, max(0, n_twos - self.n_octaves + 1))
+        early_rate = rate / 2**self.n_early
+
+        # Build the kernels of the filters of each octave
+        self.kernels = []
+        self._cast_kernels = {}
+        self.n_ffts = []
+        n_filters = min(bins_per_octave, n_bins)
+        for i in range(self.n_octaves):
+            octave_rate = early_rate / 2**i
+            octave_freqs = freqs[
+                max(n_bins - n_filters * (i + 1), 0) : n_bins - n_filters * i
+            ]
+            kernel, n_fft = _make_kernel(
+                octave_freqs, octave_rate, quality, sparsity
+            )
+            kernel *= np.sqrt(early_rate / octave_rate)
+            self.kernels.append(kernel)
+            self.n_ffts.append(n_fft)
+
+        # Scale by the filter lengths as `librosa.cqt` does
+        self.scales = np.sqrt(quality * early_rate / freqs)[:, np.newaxis]
+
+        # Number of samples on each side of a frame that affect it, rounded
+        # up to a multiple of the hop length
+        context = self.n_ffts[-1] * 2 ** (self.n_octaves - 1 + self.n_early)
+        self.context = -(-context // hop_length) * hop_length
+
+    def __call__(self, y):
+        """Return the constant-Q spectrogram of a signal in dB.
+
+        Returns an array of shape (n_bins, n_frames) of dtype `dtype`.
+
+        """
+        dtype = np.dtype(self.dtype or y.dtype)
+        complex_dtype = np.result_type(dtype, np.complex64)
+        y = np.asarray(y, dtype)
+        hop_length = self.hop_length // 2**self.n_early
+        if self.n_early:
+            y = librosa.resample(y, orig_sr=2**self.n_early, target_sr=1)
+
+        # Compute the response of each octave, from the top
+        if complex_dtype not in self._cast_kernels:
+            self._cast_kernels[complex_dtype] = [
+                kernel.astype(complex_dtype) for kernel in self.kernels
+            ]
+        kernels = self._cast_kernels[complex_dtype]
+        cqt_db = None
+        end = self.n_bins
+        for i, (kernel, n_fft) in enumerate(zip(kernels, self.n_ffts)):
+            stft = librosa.stft(
+                y,
+                n_fft=n_fft,
+                hop_length=hop_length,
+                window="ones",
+                pad_mode="constant",
+                dtype=complex_dtype,
+            )
+            response = kernel.dot(stft)
+            del stft
+
+            # Write the magnitudes into the output array, trimmed to the
+            # shortest octave
+            if cqt_db is None:
+                cqt_db = np.empty((self.n_bins, response.shape[1]), dtype)
+            elif response.shape[1] < cqt_db.shape[1]:
+                cqt_db = cqt_db[:, : response.shape[1]]
+            start = max(end - response.shape[0], 0)
+            np.abs(
+                response[start - end :, : cqt_db.shape[1]],
+                out=cqt_db[start:end],
+            )
+            end = start
+            del response
+
+            # Downsample for the next octave
+            if i < self.n_octaves - 1:
+                if hop_length % 2:
+                    raise ValueError(
+                        f"The hop length {self.hop_length} must be divisible "
+                        f"by 2 for each of the {self.n_octaves} octaves."
+                    )
+                hop_length //= 2
+                y = librosa.resample(y, orig_sr=2, target_sr=1, scale=True)
+        cqt_db = np.ascontiguousarray(cqt_db)
+        cqt_db /= self.scales.astype(dtype)
+
+        # Convert to dB relative to the peak, as `librosa.amplitude_to_db`
+        ref = cqt_db.max() if self.ref is None else self.ref
+        np.square(cqt_db, out=cqt_db)
+        np.maximum(cqt_db, 1e-10, out=cqt_db)
+        np.log10(cqt_db, out=cqt_db)
+        cqt_db *= 10.0
+        cqt_db -= 10.0 * np.log10(max(1e-10, ref**2))
+        np.maximum(
+            cqt_db,
+            (
+                -self.top_db
+                if self.ref is not None
+                else cqt_db.max() - self.top_db
+            ),
+            out=cqt_db,
+        )
+        return cqt_db
+
+
+def _make_kernel(freqs, rate, quality, sparsity):
+    """Return the frequency-domain kernels of a set of filters."""
+    lengths = quality * rate / freqs
+    n_fft = int(2.0 ** np.ceil(np.log2(lengths.max())))
+    filters = np.zeros((len(freqs), n_fft), np.complex128)
+    for i, (length, freq) in enumerate(zip(lengths, freqs)):
+        # Build a windowed complex sinusoid normalized to unit L1 norm
+        t = np.arange(-length // 2, length // 2)
+        sig = np.exp(2j * np.pi * freq / rate * t)
+        sig *= scipy.signal.get_window("hann", len(sig), fftbins=True)
+        sig /= np.abs(sig).sum()
+
+        # Center it in the FFT window
+        offset = (n_fft - len(sig)) // 2
+        filters[i, offset : offset + len(sig)] = sig * length / n_fft
+
+    # Keep the non-negative frequencies and sparsify
+    kernel = np.fft.fft(filters, axis=1)[:, : n_fft // 2 + 1]
+    return librosa.util.sparsify_rows(kernel, quantile=sparsity), n_fft
+
+
+@functools.lru_cache(maxsize=None)
+def get_extractor(rate, hop_length, bins_per_note, dtype=None, ref=None):
+    """Return the shared extractor of the features used for alignment.
+
+    The extractor covers five octaves from C3, and is created once per set
+    of parameters in each process so that its kernels are shared by all
+    rows.
+
+    """
+    return CQTExtractor(
+        rate,
+        hop_length,
+        librosa.note_to_hz("C3"),
+        5 * 12 * bins_per_note,
+        12 * bins_per_note,
+        dtype,
+        ref=ref,
+    )
+
+
+def iter_chunks(extractor, filename, chunk_size=1024):
+    """Yield the spectrogram of an audio file in chunks of frames.
+
+    The file is read a block at a time, with `extractor.context` samples of
+    context on each side, so that the memory usage does not depend on the
+    length of the file. The extractor must have a fixed `ref`. Up to the
+    edge effects of the resampling, the chunks concatenate to the
+    spectrogram of the whole file.
+
+    """
+    if extractor.ref is None:
+        raise ValueError("The extractor must have a fixed reference `ref`.")
+    hop_length = extractor.hop_length
+    context = extractor.context
+    with sf.SoundFile(str(filename)) as f:
+        if f.samplerate != extractor.rate:
+            raise ValueError(
+                f"Expect a sampling rate of {extractor.rate} Hz, but got "
+                f"{f.samplerate} Hz : {filename}"
+            )
+        n_frames = 1 + f.frames // hop_length
+        for start in range(0, n_frames, chunk_size):
+            # Read the block with zero padding outside the file
+            n_chunk = min(chunk_size, n_frames - start)
+            begin = start * hop_length - context
+            end = (start + n_chunk - 1) * hop_length + context + 1
+            f.seek(max(begin, 0))
+            y = f.read(
+                min(end, f.frames) - max(begin, 0),
+                dtype="float32",
+                always_2d=True,
+            ).mean(axis=1)
+            y = np.pad(y, (max(-begin, 0), max(end - f.frames, 0)))
+
+            # Keep the frames of the chunk
+            cqt_db = extractor(y)
+            offset = context // hop_length
+            yield cqt_db[:, offset : offset + n_chunk]
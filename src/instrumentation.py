@@ -0,0 +1,225 @@
+"""Per-phase timing and memory instrumentation of the processing of rows."""
+import contextlib
+import cProfile
+import csv
+import heapq
+import json
+import logging
+import marshal
+import pathlib
+import resource
+import threading
+import time
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Context manager that records the time spent in a phase of a row.
+
+    The time is added to the row being processed by `call` in the current
+    thread, and nothing is recorded outside of it.
+
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = getattr(_local, "timings", None)
+        if timings is not None:
+            timings[name] = (
+                timings.get(name, 0.0) + time.perf_counter() - start
+            )
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size of the process, if supported."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def get_peak_rss():
+    """Return the peak resident set size of the process in bytes."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # Fall back to the peak since the start of the process
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def call(func, *func_args, profile=False, measure_peak=True):
+    """Call a function and measure its phases, wall time and peak memory.
+
+    Returns the value returned by the function and a dictionary of the
+    statistics, which holds the wall time `time` in seconds, the peak
+    resident set size `peak_rss` in bytes, the time spent in each phase
+    `phases`, and the marshalled cProfile statistics `profile` if `profile`
+    is True. As the peak is that of the whole process, it is measured only
+    if `measure_peak` is True, which must be False when other calls run in
+    other threads of the process. Otherwise, `peak_rss` is None.
+
+    """
+    _local.timings = {}
+    if measure_peak:
+        reset_peak_rss()
+    profiler = cProfile.Profile() if profile else None
+    start = time.perf_counter()
+    try:
+        if profiler is None:
+            value = func(*func_args)
+        else:
+            value = profiler.runcall(func, *func_args)
+        stats = {
+            "time": time.perf_counter() - start,
+            "peak_rss": get_peak_rss() if measure_peak else None,
+            "phases": _local.timings,
+        }
+    finally:
+        _local.timings = None
+    if profiler is not None:
+        profiler.create_stats()
+        stats["profile"] = marshal.dumps(profiler.stats)
+    return value, stats
+
+
+class Report:
+    """Report of the timings and peak memory of the rows in a run.
+
+    Parameters
+    ----------
+    profile_slowest : int
+        Number of slowest rows whose cProfile statistics are kept.
+
+    """
+
+    def __init__(self, profile_slowest=0):
+        self.profile_slowest = profile_slowest
+        self.rows = {}
+        self._profiles = []
+
+    def add(self, filename, stats):
+        """Add the statistics of a row.
+
+        The statistics of a row added more than once, e.g., by several
+        passes over the rows, are accumulated. The peak memory of a row is
+        None if it was never measured.
+
+        """
+        row = self.rows.setdefault(
+            filename, {"time": 0.0, "peak_rss": None, "phases": {}}
+        )
+        row["time"] += stats["time"]
+        if stats["peak_rss"] is not None:
+            row["peak_rss"] = max(row["peak_rss"] or 0, stats["peak_rss"])
+        for name, seconds in stats["phases"].items():
+            row["phases"][name] = row["phases"].get(name, 0.0) + seconds
+
+        # Keep the profiles of the slowest rows only
+        if stats.get("profile") is not None:
+            item = (stats["time"], filename, stats["profile"])
+            if len(self._profiles) < self.profile_slowest:
+                heapq.heappush(self._profiles, item)
+            elif self._profiles and item > self._profiles[0]:
+                heapq.heapreplace(self._profiles, item)
+
+    def get_phase_names(self):
+        """Return the names of all phases in order of appearance."""
+        names = {}
+        for row in self.rows.values():
+            names.update(dict.fromkeys(row["phases"]))
+        return list(names)
+
+    def summarize(self):
+        """Log the total time spent in each phase."""
+        if not self.rows:
+            return
+        total = sum(row["time"] for row in self.rows.values())
+        peaks = [
+            row["peak_rss"]
+            for row in self.rows.values()
+            if row["peak_rss"] is not None
+        ]
+        if peaks:
+            logging.info(
+                f"Total time : {total:.1f}s, peak memory : "
+                f"{max(peaks) / 2**20:.0f} MB"
+            )
+        else:
+            logging.info(f"Total time : {total:.1f}s")
+        totals = {
+            name: sum(
+                row["phases"].get(name, 0.0) for row in self.rows.values()
+            )
+            for name in self.get_phase_names()
+        }
+        for name, seconds in sorted(
+            totals.items(), key=lambda item: item[1], reverse=True
+        ):
+            logging.info(
+                f"{name:<16} {seconds:10.1f}s ({100 * seconds / total:.1f}%)"
+            )
+
+    def save(self, filename):
+        """Save the report as a JSON or CSV file, depending on the suffix."""
+        filename = pathlib.Path(filename)
+        if filename.suffix == ".json":
+            with open(filename, "w") as f:
+                json.dump(
+                    [
+                        {"filename": key, **row}
+                        for key, row in self.rows.items()
+                    ],
+                    f,
+                    indent=2,
+                )
+            return
+        names = self.get_phase_names()
+        with open(filename, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["filename", "time", "peak_rss"] + names)
+            for key, row in self.rows.items():
+                writer.writerow(
+                    [key, row["time"], row["peak_rss"]]
+                    + [row["phases"].get(name, 0.0) for name in names]
+                )
+
+    def save_profiles(self, profile_dir):
+        """Save the cProfile statistics of the slowest rows.
+
+        The files are named by the rank and the filename of the rows, and
+        can be loaded by `pstats.Stats`.
+
+        """
+        profile_dir = pathlib.Path(profile_dir)
+        profile_dir.mkdir(parents=True, exist_ok=True)
+        for rank, (_, filename, profile) in enumerate(
+            sorted(self._profiles, reverse=True), 1
+        ):
+            with open(profile_dir / f"{rank:02d}_{filename}.prof", "wb") as f:
+                f.write(profile)
+
+
+def make_report(args):
+    """Return a report if requested by the command-line arguments."""
+    if args.report is None and args.profile_dir is None:
+        return None
+    return Report(args.profile_slowest if args.profile_dir else 0)
+
+
+def save_report(report, args):
+    """Log and save a report as requested by the command-line arguments."""
+    if report is None:
+        return
+    report.summarize()
+    if args.report is not None:
+        report.save(args.report)
+    if args.profile_dir is not None:
+        report.save_profiles(args.profile_dir)
@@ -0,0 +1,102 @@
+"""Manifest of the inputs and parameters the outputs were built from."""
+import json
+import os
+import pathlib
+import tempfile
+
+from cache import hash_file, make_key
+
+MANIFEST_FILENAME = "manifest.json"
+
+
+class Manifest:
+    """Manifest of the inputs and parameters the outputs were built from.
+
+    For each row, the manifest records a fingerprint of the content of its
+    input files, its parameters and the code that built its outputs. A row
+    needs to be rebuilt only if its fingerprint has changed or any of its
+    outputs is missing. The manifest is stored as `manifest.json` in the
+    output directory of a stage. The hashes of the input files are cached in
+    the manifest by their sizes and modification times so that unchanged
+    files are not read again.
+
+    Parameters
+    ----------
+    out_dir : str or Path
+        Output directory of the stage.
+
+    """
+
+    def __init__(self, out_dir):
+        self.out_dir = pathlib.Path(out_dir)
+        self.files = {}
+        self.rows = {}
+        manifest_filename = self.out_dir / MANIFEST_FILENAME
+        if manifest_filename.is_file():
+            with open(manifest_filename) as f:
+                manifest = json.load(f)
+            self.files = manifest["files"]
+            self.rows = manifest["rows"]
+
+    def hash_file(self, filename):
+        """Return the SHA-1 hash of the content of a file."""
+        key = str(pathlib.Path(filename).resolve())
+        stat = os.stat(filename)
+        entry = self.files.get(key)
+        if entry is not None and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return entry[2]
+        sha1 = hash_file(filename)
+        self.files[key] = [stat.st_size, stat.st_mtime_ns, sha1]
+        return sha1
+
+    def is_fresh(self, key, fingerprint, filenames):
+        """Return whether the outputs of a row are up to date."""
+        return self.rows.get(key) == fingerprint and all(
+            pathlib.Path(filename).is_file() for filename in filenames
+        )
+
+    def update(self, key, fingerprint):
+        """Record the fingerprint of a row."""
+        self.rows[key] = fingerprint
+
+    def save(self):
+        """Save the manifest to the output directory."""
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.out_dir, suffix=".tmp", delete=False
+        ) as f:
+            json.dump({"files": self.files, "rows": self.rows}, f, indent=1)
+        os.replace(f.name, self.out_dir / MANIFEST_FILENAME)
+
+
+def select_stale(manifest, data, get_dependencies, get_outputs, args):
+    """Return the rows that need to be rebuilt and their fingerprints.
+
+    The functions are called as `get_dependencies(row, args, manifest)`,
+    which returns the hashes of the input files and the parameters of a row,
+    and `get_outputs(row, args)`, which returns its output filenames. A row
+    whose inputs cannot be hashed, e.g., because an input file is missing, is
+    always rebuilt so that the error is reported by the stage.
+
+    """
+    stale, fingerprints = [], []
+    for row in data:
+        try:
+            fingerprint = make_key(*get_dependencies(row, args, manifest))
+        except FileNotFoundError:
+            fingerprint = None
+        if fingerprint is None or not manifest.is_fresh(
+            row["filename"], fingerprint, get_outputs(row, args)
+        ):
+            stale.append(row)
+            fingerprints.append(fingerprint)
+    return stale, fingerprints
+
+
+def record(manifest, data, fingerprints, results):
+    """Record the fingerprints of the rows built successfully and save."""
+    for row, fingerprint, (result, error) in zip(data, fingerprints, results):
+        if fingerprint is None or error is not None or result == "skipped":
+            continue
+        manifest.update(row["filename"], fingerprint)
+    manifest.save()
@@ -0,0 +1,504 @@
+"""Fast extraction of the notes from MusicXML scores."""
+import fractions
+import functools
+import xml.etree.ElementTree as ET
+import zipfile
+
+import numpy as np
+
+# Time steps per quarter note, as `muspy.DEFAULT_RESOLUTION`
+RESOLUTION = 24
+
+# Velocity of the notes, as the default of `muspy`
+VELOCITY = 64
+
+# Quarter lengths of the note types
+TYPE_LENGTHS = {
+    "1024th": fractions.Fraction(1, 256),
+    "512th": fractions.Fraction(1, 128),
+    "256th": fractions.Fraction(1, 64),
+    "128th": fractions.Fraction(1, 32),
+    "64th": fractions.Fraction(1, 16),
+    "32nd": fractions.Fraction(1, 8),
+    "16th": fractions.Fraction(1, 4),
+    "eighth": fractions.Fraction(1, 2),
+    "quarter": fractions.Fraction(1),
+    "half": fractions.Fraction(2),
+    "whole": fractions.Fraction(4),
+    "breve": fractions.Fraction(8),
+    "long": fractions.Fraction(16),
+    "maxima": fractions.Fraction(32),
+}
+
+# Pitch classes of the steps
+STEPS = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11}
+
+
+def open_score(filename):
+    """Return a file object of the MusicXML document of a score.
+
+    Compressed scores (`.mxl`) are read from the root file listed in their
+    container.
+
+    """
+    if not zipfile.is_zipfile(filename):
+        return open(filename, "rb")
+    archive = zipfile.ZipFile(filename)
+    names = [
+        name for name in archive.namelist() if not name.startswith("META-INF")
+    ]
+    if "META-INF/container.xml" in archive.namelist():
+        container = ET.fromstring(archive.read("META-INF/container.xml"))
+        rootfile = container.find(".//rootfile")
+        if rootfile is not None:
+            names = [rootfile.get("full-path")]
+    return archive.open(names[0])
+
+
+@functools.lru_cache(maxsize=None)
+def _get_type_length(note_type, n_dots, normal_notes, actual_notes):
+    """Return the quarter length of a note type with dots and a tuplet."""
+    length = TYPE_LENGTHS[note_type]
+    length *= 2 - fractions.Fraction(1, 2**n_dots)
+    return length * fractions.Fraction(normal_notes, actual_notes)
+
+
+def _get_length(note, divisions):
+    """Return the quarter length of a note.
+
+    As `music21`, the length is computed from the type, dots and time
+    modification of the note when it has a type, and from its duration
+    otherwise.
+
+    """
+    if note.find("grace") is not None:
+        return fractions.Fraction(0)
+    note_type = note.findtext("type")
+    if note_type is None or not note_type.strip():
+        duration = note.findtext("duration")
+        if duration is None:
+            return fractions.Fraction(0)
+        return fractions.Fraction(duration.strip()) / divisions
+    time_modification = note.find("time-modification")
+    if time_modification is None:
+        normal_notes = actual_notes = 1
+    else:
+        normal_notes = int(time_modification.findtext("normal-notes"))
+        actual_notes = int(time_modification.findtext("actual-notes"))
+    return _get_type_length(
+        note_type.strip(), len(note.findall("dot")), normal_notes, actual_notes
+    )
+
+
+def _get_pitch(note):
+    """Return the MIDI pitch of a note."""
+    pitch = note.find("pitch")
+    alter = pitch.findtext("alter")
+    return int(
+        round(
+            12 * (int(pitch.findtext("octave")) + 1)
+            + STEPS[pitch.findtext("step").strip()]
+            + (float(alter) if alter else 0)
+        )
+    )
+
+
+def _get_tie(note):
+    """Return the type of the tie of a note, if any."""
+    types = {tie.get("type") for tie in note.findall("tie")}
+    if {"start", "stop"} <= types:
+        return "continue"
+    if types:
+        return types.pop()
+    return None
+
+
+def _parse_numbers(text):
+    """Return the list of the numbers of an ending, e.g., `1, 2`."""
+    numbers = []
+    for part in text.replace(" ", "").split(","):
+        if "-" in part:
+            low, high = part.split("-")
+            numbers.extend(range(int(low), int(high) + 1))
+        elif part:
+            numbers.append(int(part))
+    return numbers
+
+
+class _Parser:
+    """Parser of the measures of the first part of a MusicXML document."""
+
+    def __init__(self):
+        self.divisions = 1
+        self.bar_length = fractions.Fraction(4)
+        self.measures = []
+        self.brackets = []
+        self._bracket = None
+
+    def parse_measure(self, element):
+        """Parse a measure and append it to the measures."""
+        index = len(self.measures)
+        measure = {
+            "events": [],
+            "length": fractions.Fraction(0),
+            "start": False,
+            "times": None,
+        }
+        self.measures.append(measure)
+        offset = fractions.Fraction(0)
+        has_notes = False
+        voices = set()
+        for child in element:
+            if child.tag == "note":
+                has_notes = True
+                voice = child.findtext("voice")
+                voice = voice.strip() if voice else None
+                voices.add(voice)
+                is_rest = child.find("rest") is not None
+                if child.find("chord") is not None and measure["events"]:
+                    # Add the pitch to the chord of the previous note
+                    if not is_rest:
+                        measure["events"][-1]["pitches"].append(
+                            _get_pitch(child)
+                        )
+                    continue
+                length = _get_length(child, self.divisions)
+                measure["events"].append(
+                    {
+                        "offset": offset,
+                        "voice": voice,
+                        "pitches": [] if is_rest else [_get_pitch(child)],
+                        "length": length,
+                        "tie": _get_tie(child),
+                        "grace": child.find("grace") is not None,
+                    }
+                )
+                offset += length
+                measure["length"] = max(measure["length"], offset)
+            elif child.tag == "backup":
+                offset -= (
+                    fractions.Fraction(child.findtext("duration").strip())
+                    / self.divisions
+                )
+            elif child.tag == "forward":
+                offset += (
+                    fractions.Fraction(child.findtext("duration").strip())
+                    / self.divisions
+                )
+            elif child.tag == "attributes":
+                divisions = child.findtext("divisions")
+                if divisions is not None:
+                    self.divisions = fractions.Fraction(divisions.strip())
+                time = child.find("time")
+                if time is not None and time.find("beats") is not None:
+                    beats = sum(
+                        int(beat) for beat in time.findtext("beats").split("+")
+                    )
+                    self.bar_length = fractions.Fraction(
+                        4 * beats, int(time.findtext("beat-type"))
+                    )
+            elif child.tag == "barline":
+                self.parse_barline(child, index)
+
+        # An empty measure lasts a bar, as music21 fills it with a rest
+        if not has_notes:
+            measure["length"] = self.bar_length
+
+        # Order the chords and notes as in a flattened music21 stream, where
+        # the voices are sorted by their names
+        if len(voices) > 1:
+            names = sorted(voice for voice in voices if voice is not None)
+            ranks = {name: rank for rank, name in enumerate(names)}
+            order = sorted(
+                range(len(measure["events"])),
+                key=lambda i: ranks.get(measure["events"][i]["voice"], -1),
+            )
+            measure["events"] = [measure["events"][i] for i in order]
+
+    def parse_barline(self, barline, index):
+        """Parse the repeat and ending of a barline of a measure."""
+        location = barline.get("location", "right")
+        repeat = barline.find("repeat")
+        if repeat is not None:
+            direction = repeat.get("direction")
+            if direction == "forward" and location == "left":
+                self.measures[index]["start"] = True
+            elif direction == "backward" and location == "right":
+                self.measures[index]["times"] = int(repeat.get("times", 2))
+            elif direction == "backward" and index > 0:
+                # An end repeat on the left ends the previous measure
+                self.measures[index - 1]["times"] = int(repeat.get("times", 2))
+            else:
+                raise ValueError(
+                    f"Cannot process a {direction} repeat on the {location} "
+                    f"of measure {index}."
+                )
+        ending = barline.find("ending")
+        if ending is not None:
+            if ending.get("type") == "start":
+                self._bracket = {
+                    "first": index,
+                    "last": index,
+                    "numbers": _parse_numbers(ending.get("number", "1")),
+                }
+            elif self._bracket is not None:
+                self._bracket["last"] = index
+                self.brackets.append(self._bracket)
+                self._bracket = None
+
+
+def _strip(item):
+    """Return a measure item with its repeat barlines removed."""
+    return (item[0], False, None, item[3])
+
+
+class _Expander:
+    """Expander of the repeats of measures, following `music21.repeat`.
+
+    The measures are expanded from the innermost repeat outwards, and the
+    repeat brackets, i.e., the first and second endings, are associated
+    with the measures not yet copied only, as in `music21`, so that the same
+    scores are expanded in the same way. Each measure is represented by a
+    tuple of its index, whether it starts a repeat, the number of times of
+    the repeat it ends, if any, and whether it is the original measure.
+
+    """
+
+    def __init__(self, measures, brackets):
+        self.measures = measures
+        self.brackets = brackets
+        self._memo = set()
+
+    def is_expandable(self, items):
+        """Return whether the repeats are balanced and the brackets valid."""
+        n_starts = n_ends = balance = 0
+        for _, start, times, _ in items:
+            if start:
+                n_starts += 1
+                balance += 1
+            if times is not None:
+                if balance == 0:
+                    n_starts += 1
+                    balance += 1
+                n_ends += 1
+                balance -= 1
+        if balance not in (0, 1) or n_starts not in (n_ends, n_ends - 1):
+            return False
+        for group in self.group_brackets(items):
+            numbers = [n for i in group for n in self.brackets[i]["numbers"]]
+            if len(group) > 1 and numbers != list(range(1, max(numbers) + 1)):
+                return False
+            spanned = set()
+            for rank, i in enumerate(group):
+                bracket = self.brackets[i]
+                indices = set(range(bracket["first"], bracket["last"] + 1))
+                if spanned & indices:
+                    return False
+                spanned |= indices
+                if self.measures[bracket["last"]]["times"] is None and (
+                    len(group) == 1 or rank < len(group) - 1
+                ):
+                    return False
+        return True
+
+    def group_brackets(self, items):
+        """Return the groups of brackets in order."""
+        groups, group, numbers = [], [], []
+        for index, _, _, original in items:
+            if not original:
+                continue
+            for i, bracket in enumerate(self.brackets):
+                if bracket["first"] != index:
+                    continue
+                if bracket["numbers"][0] in numbers:
+                    groups.append(group)
+                    group, numbers = [], []
+                numbers += bracket["numbers"]
+                group.append(i)
+        groups.append(group)
+        return [group for group in groups if group]
+
+    def spans(self, i, item):
+        """Return whether a bracket spans a measure item."""
+        bracket = self.brackets[i]
+        return item[3] and bracket["first"] <= item[0] <= bracket["last"]
+
+    @staticmethod
+    def find_innermost(items):
+        """Return the positions of the innermost repeat."""
+        starts = []
+        for k, (_, start, times, _) in enumerate(items):
+            if start:
+                starts.append(k)
+            if times is not None:
+                return list(range(starts[-1] if starts else 0, k + 1))
+        return []
+
+    def expand_innermost(
+        self, items, positions=None, times=None, expansion_only=False
+    ):
+        """Expand the innermost repeat, or the given positions."""
+        forced = positions is not None
+        if positions is None:
+            positions = self.find_innermost(items)
+        expanded = []
+        k = 0
+        while k < len(items) and positions:
+            if k == positions[0]:
+                found_times = items[positions[-1]][2]
+                if found_times is None and not forced:
+                    raise ValueError(
+                        "Cannot find the end repeat of the measures "
+                        f"{positions[0]} to {positions[-1]}."
+                    )
+                if times is None:
+                    times = found_times
+                for _ in range(times):
+                    for j in positions:
+                        item = (items[j][0], items[j][1], items[j][2], False)
+                        if j in (positions[0], positions[-1]):
+                            item = _strip(item)
+                        expanded.append(item)
+                k = positions[-1] + 1
+            else:
+                if not expansion_only:
+                    expanded.append(items[k])
+                k += 1
+        return expanded
+
+    def expand_brackets(self, items):
+        """Expand the innermost repeat along with its brackets, if any."""
+        innermost = self.find_innermost(items)
+        focus = None
+        for group in self.group_brackets(items):
+            if not innermost:
+                continue
+            for i in group:
+                if i in self._memo:
+                    break
+                if self.spans(i, items[innermost[0]]) or self.spans(
+                    i, items[innermost[-1]]
+                ):
+                    focus = group
+                    break
+            if focus is not None:
+                break
+        if focus is None:
+            return self.expand_innermost(items)
+
+        # Repeat the measures up to each bracket, skipping earlier brackets
+        boundaries = []
+        for i in focus:
+            self._memo.add(i)
+            bracket = self.brackets[i]
+            first = last = None
+            for k, item in enumerate(items):
+                if item[3] and item[0] == bracket["last"]:
+                    last = k
+                if item[3] and item[0] == bracket["first"]:
+                    first = k
+            if first is None or last is None:
+                raise ValueError("Cannot find the measures of a bracket.")
+            positions = list(range(innermost[0], last + 1))
+            for _, _, bracket_positions in boundaries:
+                positions = [
+                    k for k in positions if k not in bracket_positions
+                ]
+            boundaries.append((i, positions, range(first, last + 1)))
+        expanded = list(items[: innermost[0]])
+        highest = None
+        for i, positions, _ in boundaries:
+            expanded.extend(
+                _strip(item)
+                for item in self.expand_innermost(
+                    items,
+                    positions,
+                    len(self.brackets[i]["numbers"]),
+                    expansion_only=True,
+                )
+            )
+            highest = max(positions)
+        expanded.extend(items[highest + 1 :])
+        return expanded
+
+    def expand(self):
+        """Return the indices of the measures in playing order."""
+        items = [
+            (index, measure["start"], measure["times"], True)
+            for index, measure in enumerate(self.measures)
+        ]
+        if not any(start or times is not None for _, start, times, _ in items):
+            return list(range(len(items)))
+        if not self.is_expandable(items):
+            raise ValueError("Cannot expand badly formed repeats.")
+        for _ in range(100):
+            items = self.expand_brackets(items)
+            if not any(
+                start or times is not None for _, start, times, _ in items
+            ):
+                break
+        return [item[0] for item in items]
+
+
+def read_notes(filename):
+    """Read the notes from a MusicXML score with repeats expanded.
+
+    The score is streamed a measure at a time without building a music21
+    stream. The repeats are expanded, the tied notes are merged and the
+    grace notes are dropped as done by `music21.converter.parse`,
+    `expandRepeats` and `muspy.from_music21_score`, so that the notes are
+    the same.
+
+    Returns an array of shape (n_notes, 4) holding the onset, offset, pitch
+    and velocity of each note, sorted in lexicographic order.
+
+    """
+    # Parse the measures of the first part
+    parser = _Parser()
+    n_parts = 0
+    with open_score(filename) as f:
+        for _, element in ET.iterparse(f):
+            if element.tag == "measure":
+                if n_parts == 0:
+                    parser.parse_measure(element)
+                element.clear()
+            elif element.tag == "part":
+                n_parts += 1
+    if n_parts != 1:
+        raise ValueError(f"Expect a single part, but got {n_parts}.")
+
+    # Expand the repeats
+    order = _Expander(parser.measures, parser.brackets).expand()
+
+    # Collect the notes and chords, merging the tied notes as `muspy`
+    notes = []
+    ties = {}
+    offset = fractions.Fraction(0)
+    events = []
+    for index in order:
+        measure = parser.measures[index]
+        for event in measure["events"]:
+            if event["pitches"] and not event["grace"]:
+                events.append((offset + event["offset"], len(events), event))
+        offset += measure["length"]
+    events.sort(key=lambda item: item[:2])
+    for time, _, event in events:
+        onset = round(float(time * RESOLUTION))
+        duration = round(float(event["length"] * RESOLUTION))
+        if len(event["pitches"]) > 1:
+            for pitch in event["pitches"]:
+                notes.append([onset, onset + duration, pitch, VELOCITY])
+            continue
+        pitch = event["pitches"][0]
+        is_outgoing_tie = event["tie"] in ("start", "continue")
+        if pitch in ties:
+            note = notes[ties[pitch]]
+            note[1] += duration
+            if not is_outgoing_tie:
+                del ties[pitch]
+        else:
+            notes.append([onset, onset + duration, pitch, VELOCITY])
+            if is_outgoing_tie:
+                ties[pitch] = len(notes) - 1
+    notes.sort()
+    return np.array(notes, dtype=np.int64).reshape(-1, 4)
@@ -0,0 +1,362 @@
+"""Utilities for processing rows in parallel."""
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import logging
+import os
+import subprocess
+import time
+import traceback
+
+import tqdm
+
+import instrumentation
+
+
+def parse_time(time):
+    """Convert a time string in H:MM:SS format to seconds."""
+    seconds = 0.0
+    for part in time.split(":"):
+        seconds = 60 * seconds + float(part)
+    return seconds
+
+
+def _call(func, *func_args):
+    """Call a function and capture the error, if any."""
+    try:
+        return func(*func_args), None
+    except Exception:  # pylint: disable=broad-except
+        return None, traceback.format_exc()
+
+
+def _call_measured(profile, measure_peak, func, *func_args):
+    """Call a function, capture the error and measure the call."""
+    return instrumentation.call(
+        _call, func, *func_args, profile=profile, measure_peak=measure_peak
+    )
+
+
+def _record(report, row, value):
+    """Add the statistics of a measured call to the report, if any."""
+    if report is None:
+        return value
+    result, stats = value
+    report.add(row["filename"], stats)
+    return result
+
+
+def run(func, data, args, jobs=1, largest_first=False, report=None):
+    """Apply a function to each row of the data.
+
+    The function is called as `func(row, args)`. Errors are captured per row
+    so that one bad row does not stop the run.
+
+    Parameters
+    ----------
+    func : callable
+        Function to apply. Must be picklable when `jobs` > 1.
+    data : list of dict
+        Rows to process.
+    args : argparse.Namespace
+        Command-line arguments passed to the function.
+    jobs : int
+        Number of worker processes. Rows are processed in the main process
+        when `jobs` is 1.
+    largest_first : bool
+        Whether to schedule rows with a longer `length` first.
+    report : instrumentation.Report, optional
+        Report to add the timings and peak memory of each row to.
+
+    Returns
+    -------
+    list of tuple
+        A `(result, error)` tuple for each row, in the same order as `data`.
+
+    """
+    order = list(range(len(data)))
+    if largest_first:
+        order.sort(key=lambda i: parse_time(data[i]["length"]), reverse=True)
+
+    if report is None:
+        call = _call
+    else:
+        call = functools.partial(
+            _call_measured, report.profile_slowest > 0, True
+        )
+
+    results = [None] * len(data)
+    prog_bar = tqdm.tqdm(total=len(data), ncols=120)
+    if jobs == 1:
+        for i in order:
+            # Append filename to progress bar
+            prog_bar.set_postfix_str(data[i]["filename"])
+            results[i] = _record(report, data[i], call(func, data[i], args))
+            prog_bar.update()
+    else:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            futures = {
+                executor.submit(call, func, data[i], args): i for i in order
+            }
+            for future in concurrent.futures.as_completed(futures):
+                i = futures[future]
+                try:
+                    results[i] = _record(report, data[i], future.result())
+                except Exception:  # pylint: disable=broad-except
+                    # The worker process died, e.g., of running out of memory
+                    results[i] = (None, traceback.format_exc())
+                # Append filename to progress bar
+                prog_bar.set_postfix_str(data[i]["filename"])
+                prog_bar.update()
+    prog_bar.close()
+    return results
+
+
+def run_prefetched(
+    load, func, data, args, prefetch=1, largest_first=False, report=None
+):
+    """Apply a function to each row of the data, loading the inputs ahead.
+
+    The rows are processed one at a time in the main process, while the
+    inputs of the next `prefetch` rows are loaded by background threads so
+    that loading overlaps processing. The functions are called as
+    `load(row, args)` and `func(row, inputs, args)`, where `inputs` is the
+    value returned by `load`. Errors are captured per row as in `run`. If a
+    report is given, the loading and processing of each row are measured,
+    but only the processing is profiled. The peak memory of the rows is not
+    measured if `prefetch` > 0, as it is shared by the threads.
+
+    Returns
+    -------
+    list of tuple
+        A `(result, error)` tuple for each row, in the same order as `data`.
+
+    """
+    order = list(range(len(data)))
+    if largest_first:
+        order.sort(key=lambda i: parse_time(data[i]["length"]), reverse=True)
+
+    if report is None:
+        load_call = call = _call
+    else:
+        load_call = functools.partial(_call_measured, False, prefetch < 1)
+        call = functools.partial(
+            _call_measured, report.profile_slowest > 0, prefetch < 1
+        )
+
+    results = [None] * len(data)
+    prog_bar = tqdm.tqdm(total=len(data), ncols=120)
+    with concurrent.futures.ThreadPoolExecutor(max(prefetch, 1)) as executor:
+        queue = iter(order)
+        pending = collections.deque()
+        while True:
+            # Keep loading the current row and the next `prefetch` rows
+            while len(pending) <= prefetch:
+                j = next(queue, None)
+                if j is None:
+                    break
+                pending.append(
+                    (j, executor.submit(load_call, load, data[j], args))
+                )
+            if not pending:
+                break
+            i, future = pending.popleft()
+
+            # Append filename to progress bar
+            prog_bar.set_postfix_str(data[i]["filename"])
+            inputs, error = _record(report, data[i], future.result())
+            if error is None:
+                results[i] = _record(
+                    report, data[i], call(func, data[i], inputs, args)
+                )
+            else:
+                results[i] = (None, error)
+            prog_bar.update()
+    prog_bar.close()
+    return results
+
+
+class Command:
+    """External command in a dependency graph run by `run_commands`.
+
+    After the run, `error` holds the error message if the command failed or
+    was not run because a dependency failed, `stderr` holds its standard
+    error output, `time` holds the wall time spent running it, retries
+    included, and `peak_rss` holds its peak resident memory in bytes.
+
+    Parameters
+    ----------
+    args : list
+        Program and arguments of the command.
+    key : str
+        Key of the task the command belongs to, e.g., the filename of a row.
+    name : str
+        Name of the step of the task, e.g., a phase of a report.
+    dependencies : list of Command
+        Commands that must succeed before this one starts.
+
+    """
+
+    def __init__(self, args, key, name, dependencies=()):
+        self.args = [str(arg) for arg in args]
+        self.key = key
+        self.name = name
+        self.dependencies = list(dependencies)
+        self.done = False
+        self.error = None
+        self.stderr = ""
+        self.time = 0.0
+        self.peak_rss = 0
+
+
+def _execute(args):
+    """Run a program until it exits.
+
+    The process is reaped by `os.wait4` to get its own resource usage, which
+    the child watcher of asyncio does not expose. As Linux counts the memory
+    of the parent process before `exec` in the peak of the child, the peak
+    is never below that of the calling process. Returns the exit status,
+    the standard error output and the peak resident memory in bytes.
+
+    """
+    process = subprocess.Popen(
+        args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+    with process.stderr:
+        stderr = process.stderr.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return process.returncode, stderr, usage.ru_maxrss * 1024
+
+
+async def _run_command(command, retries, retry_delay, executor):
+    """Run a command in a thread of an executor, retrying it if it fails."""
+    loop = asyncio.get_running_loop()
+    for attempt in range(retries + 1):
+        start = time.perf_counter()
+        try:
+            returncode, stderr, peak_rss = await loop.run_in_executor(
+                executor, _execute, command.args
+            )
+        except OSError:
+            # The program cannot be run at all, so do not retry
+            command.error = traceback.format_exc()
+            return
+        finally:
+            command.time += time.perf_counter() - start
+        command.stderr = stderr.decode(errors="replace")
+        command.peak_rss = max(command.peak_rss, peak_rss)
+        if returncode == 0:
+            command.error = None
+            return
+        command.error = (
+            f"Command {command.args} returned non-zero exit status "
+            f"{returncode} :\n{command.stderr}"
+        )
+        if attempt < retries:
+            logging.warning(
+                f"Retrying the {command.name} of {command.key} "
+                f"({attempt + 1}/{retries})..."
+            )
+            await asyncio.sleep(retry_delay * 2**attempt)
+
+
+async def _schedule(commands, jobs, retries, retry_delay, executor, prog_bar):
+    """Run the commands in order as their dependencies are done."""
+    pending = list(commands)
+    running = {}
+    while pending or running:
+        # Start the earliest ready commands, and drop those whose
+        # dependencies failed
+        for command in list(pending):
+            if len(running) >= jobs:
+                break
+            failed = [
+                dep for dep in command.dependencies if dep.done and dep.error
+            ]
+            if failed:
+                command.error = (
+                    f"Skipped as the {failed[0].name} of {failed[0].key} "
+                    "failed."
+                )
+            elif not all(dep.done for dep in command.dependencies):
+                continue
+            else:
+                running[
+                    asyncio.ensure_future(
+                        _run_command(command, retries, retry_delay, executor)
+                    )
+                ] = command
+            pending.remove(command)
+            if command.error:
+                command.done = True
+                prog_bar.update()
+        if not running:
+            if pending:
+                raise ValueError(
+                    "The dependencies of the commands must be in the list."
+                )
+            break
+
+        # Wait for a command to finish
+        finished, _ = await asyncio.wait(
+            running, return_when=asyncio.FIRST_COMPLETED
+        )
+        for task in finished:
+            command = running.pop(task)
+            command.done = True
+            prog_bar.set_postfix_str(command.key)
+            prog_bar.update()
+
+
+def run_commands(commands, jobs=1, retries=0, retry_delay=1.0):
+    """Run external commands concurrently as a dependency graph.
+
+    The commands are run by an asyncio event loop, up to `jobs` at a time.
+    Whenever a slot is free, the earliest command in the list whose
+    dependencies have succeeded is started, so listing the steps of each
+    task together lets the later steps of a task run alongside the first
+    step of the next one. A command that fails is retried up to `retries`
+    times, waiting `retry_delay` seconds at first and twice as long after
+    each attempt, and the commands depending on it are not run. The outcome
+    of each command is stored in the command itself.
+
+    Parameters
+    ----------
+    commands : list of Command
+        Commands to run, listed after their dependencies.
+    jobs : int
+        Maximum number of commands running at the same time.
+    retries : int
+        Number of times a failed command is retried.
+    retry_delay : float
+        Delay in seconds before the first retry.
+
+    """
+    jobs = max(jobs, 1)
+    prog_bar = tqdm.tqdm(total=len(commands), ncols=120)
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        asyncio.run(
+            _schedule(commands, jobs, retries, retry_delay, executor, prog_bar)
+        )
+    prog_bar.close()
+
+
+def summarize(data, results):
+    """Log a summary of the results and return the number of failed rows."""
+    n_skipped = sum(result == "skipped" for result, _ in results)
+    failed = [
+        (row, error)
+        for row, (_, error) in zip(data, results)
+        if error is not None
+    ]
+    logging.info(
+        f"Processed {len(data) - n_skipped - len(failed)} rows "
+        f"({n_skipped} skipped, {len(failed)} failed)."
+    )
+    for row, error in failed:
+        logging.error(f"Failed to process {row['filename']} :\n{error}")
+    return len(failed)
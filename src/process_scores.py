@@ -5,9 +5,17 @@
 import pathlib
 import sys
 
-import music21
-import muspy
-import tqdm
+import numpy as np
+
+import instrumentation
+import musicxml
+import parallel
+from cache import Cache, hash_file, make_key
+from manifest import Manifest, record, select_stale
+
+# Version of the note extraction, to be increased whenever it changes so that
+# the cached notes get invalidated
+CACHE_VERSION = 1
 
 
 def parse_args(args=None, namespace=None):
@@ -50,15 +58,60 @@ def parse_args(args=None, namespace=None):
         action="store_true",
         help="whether to adjust pitches for Baroque tuning",
     )
+    parser.add_argument(
+        "--cache_dir", type=pathlib.Path, help="cache directory for the notes"
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=float,
+        help="maximum size of the cache in MB (default: no limit)",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="whether to check the notes against those extracted with "
+        "music21, which is much slower",
+    )
     parser.add_argument(
         "-p", "--save_plot", action="store_true", help="save alignment plots"
     )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="number of worker processes"
+    )
+    parser.add_argument(
+        "--largest_first",
+        action="store_true",
+        help="whether to process the longest movements first",
+    )
     parser.add_argument(
         "-s",
         "--skip_existing",
         action="store_true",
         help="whether to skip existing files",
     )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="whether to rebuild only the rows whose inputs or parameters "
+        "have changed",
+    )
+    parser.add_argument(
+        "--report",
+        type=pathlib.Path,
+        help="filename of the JSON or CSV report of the timings and peak "
+        "memory of each row",
+    )
+    parser.add_argument(
+        "--profile_dir",
+        type=pathlib.Path,
+        help="directory to save the cProfile statistics of the slowest rows",
+    )
+    parser.add_argument(
+        "--profile_slowest",
+        type=int,
+        default=5,
+        help="number of slowest rows to save the cProfile statistics for",
+    )
     parser.add_argument(
         "-q", "--quiet", action="store_true", help="show warnings only"
     )
@@ -76,10 +129,155 @@ def read_csv(filename):
     return data
 
 
-def main():
+def extract_notes(filename):
+    """Extract the notes from a score with repeats expanded.
+
+    Returns an array of shape (n_notes, 4) holding the onset, offset, pitch
+    and velocity of each note, sorted in lexicographic order. The score is
+    read directly by `musicxml.read_notes`, which gives the same notes as
+    `extract_notes_music21` in a fraction of the time.
+
+    """
+    with instrumentation.phase("parse"):
+        return musicxml.read_notes(filename)
+
+
+def extract_notes_music21(filename):
+    """Extract the notes from a score with music21 and MusPy.
+
+    This is the reference implementation of `extract_notes`.
+
+    """
+    import music21
+    import muspy
+
+    # Read the score
+    with instrumentation.phase("parse"):
+        m21 = music21.converter.parse(filename)
+        music = muspy.from_music21_score(m21.expandRepeats())
+    assert len(music) == 1
+
+    # Collect the notes
+    notes = []
+    for note in music[0].notes:
+        notes.append(
+            (
+                int(note.time),
+                int(note.end),
+                int(note.pitch),
+                int(note.velocity),
+            )
+        )
+
+    # Collect the chords
+    for chord in music[0].chords:
+        for pitch in chord.pitches:
+            notes.append(
+                (
+                    int(chord.time),
+                    int(chord.end),
+                    int(pitch),
+                    int(chord.velocity),
+                )
+            )
+    notes.sort()
+    return np.array(notes, dtype=np.int64).reshape(-1, 4)
+
+
+def get_score_filename(row, args):
+    """Return the score filename of a row."""
+    return (
+        args.input_dir
+        / "scores"
+        / row["work"].lower()
+        / (row["score_filename"] + ".mxl")
+    )
+
+
+def get_notes(row, args):
+    """Return the notes of a row with the tuning adjusted if necessary."""
+    # Extract the notes from the score
+    score_filename = get_score_filename(row, args)
+    if args.cache_dir is None:
+        notes = extract_notes(score_filename)
+    else:
+        cache = Cache(
+            args.cache_dir,
+            None if args.cache_size is None else int(args.cache_size * 2**20),
+        )
+        key = make_key(hash_file(score_filename), "notes", CACHE_VERSION)
+        with instrumentation.phase("cache"):
+            notes = cache.load(key)
+        if notes is None:
+            notes = extract_notes(score_filename)
+            with instrumentation.phase("cache"):
+                cache.save(key, notes)
+
+    # Adjust the tuning
+    if args.adjust_tuning_pitches and row["baroque_tuning"] == "1":
+        notes[:, 2] -= 1
+
+    return notes
+
+
+def format_notes(notes):
+    """Return the notes formatted as a CSV file."""
+    lines = ["onset,offset,pitch,velocity\n"]
+    for onset, offset, pitch, velocity in notes:
+        lines.append(f"{onset},{offset},{pitch},{velocity}\n")
+    return "".join(lines)
+
+
+def process(row, args):
+    """Process a row."""
+    # Get directories
+    out_filename = (
+        args.out_dir / "notes" / row["collection"] / (row["filename"] + ".csv")
+    )
+    if args.skip_existing and out_filename.is_file():
+        return "skipped"
+    out_filename.parent.mkdir(exist_ok=True)
+
+    # Extract the notes
+    notes = get_notes(row, args)
+
+    # Check the notes against music21
+    if args.check:
+        expected = extract_notes_music21(get_score_filename(row, args))
+        if args.adjust_tuning_pitches and row["baroque_tuning"] == "1":
+            expected[:, 2] -= 1
+        if not np.array_equal(notes, expected):
+            raise ValueError(
+                "The notes differ from those extracted with music21 : "
+                f"{get_score_filename(row, args)}"
+            )
+
+    # Write the CSV file
+    with instrumentation.phase("write"), open(out_filename, "w") as f:
+        f.write(format_notes(notes))
+
+
+def get_dependencies(row, args, manifest):
+    """Return the hashes of the input files and the parameters of a row."""
+    return (
+        manifest.hash_file(get_score_filename(row, args)),
+        manifest.hash_file(__file__),
+        manifest.hash_file(musicxml.__file__),
+        args.adjust_tuning_pitches and row["baroque_tuning"] == "1",
+    )
+
+
+def get_outputs(row, args):
+    """Return the output filenames of a row."""
+    return [
+        args.out_dir / "notes" / row["collection"] / (row["filename"] + ".csv")
+    ]
+
+
+def main(args=None):
     """Main function."""
     # Parse the command-line arguments
-    args = parse_args()
+    args = parse_args(args)
 
     # Make sure output directory exists
     args.out_dir.mkdir(exist_ok=True)
@@ -96,66 +294,31 @@ def main():
     logging.info("Reading the CSV file...")
     data = read_csv(args.csv_filename)
 
+    # Select the rows whose outputs are out of date
+    if args.incremental:
+        manifest = Manifest(args.out_dir / "notes")
+        n_rows = len(data)
+        data, fingerprints = select_stale(
+            manifest, data, get_dependencies, get_outputs, args
+        )
+        logging.info(f"Found {n_rows - len(data)} up-to-date rows.")
+
     # Iterate over rows
     logging.info("Iterating over rows...")
-    pbar = tqdm.tqdm(data, ncols=120)
-    for row in pbar:
-        # Get directories
-        out_filename = (
-            args.out_dir
-            / "notes"
-            / row["collection"]
-            / (row["filename"] + ".csv")
-        )
-        if args.skip_existing and out_filename.is_file():
-            continue
-        out_filename.parent.mkdir(exist_ok=True)
-
-        # Read the score
-        m21 = music21.converter.parse(
-            args.input_dir
-            / "scores"
-            / row["work"].lower()
-            / (row["score_filename"] + ".mxl")
-        )
-        music = muspy.from_music21_score(m21.expandRepeats())
-        assert len(music) == 1
+    report = instrumentation.make_report(args)
+    results = parallel.run(
+        process, data, args, args.jobs, args.largest_first, report
+    )
+    n_failed = parallel.summarize(data, results)
 
-        # Collect the notes
-        notes = []
-        for note in music[0].notes:
-            notes.append(
-                (
-                    int(note.time),
-                    int(note.end),
-                    int(note.pitch),
-                    int(note.velocity),
-                )
-            )
+    # Record the rows built successfully
+    if args.incremental:
+        record(manifest, data, fingerprints, results)
 
-        # Collect the chords
-        for chord in music[0].chords:
-            for pitch in chord.pitches:
-                notes.append(
-                    (
-                        int(chord.time),
-                        int(chord.end),
-                        int(pitch),
-                        int(chord.velocity),
-                    )
-                )
-        notes.sort()
+    instrumentation.save_report(report, args)
 
-        # Adjust the tuning
-        if args.adjust_tuning_pitches and row["baroque_tuning"] == "1":
-            for note in notes:
-                note[2] -= 1
-
-        # Write the CSV file
-        with open(out_filename, "w") as f:
-            f.write("onset,offset,pitch,velocity\n")
-            for onset, offset, pitch, velocity in notes:
-                f.write(f"{onset},{offset},{pitch},{velocity}\n")
+    if n_failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,356 @@
+"""Run the whole pipeline on each row without intermediate files."""
+import argparse
+import csv
+import hashlib
+import logging
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+
+import soundfile as sf
+
+import align_scores
+import dtw
+import instrumentation
+import parallel
+import process_scores
+import slice_audio
+import synthesize_scores
+
+
+def parse_args(args=None, namespace=None):
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c",
+        "--csv_filename",
+        type=pathlib.Path,
+        required=True,
+        help="input CSV filename",
+    )
+    parser.add_argument(
+        "-i",
+        "--input_dir",
+        type=pathlib.Path,
+        required=True,
+        help="dataset directory containing the audio and scores",
+    )
+    parser.add_argument(
+        "-o",
+        "--out_dir",
+        type=pathlib.Path,
+        required=True,
+        help="output directory",
+    )
+    parser.add_argument(
+        "-r", "--rate", type=int, default=16000, help="sampling rate"
+    )
+    parser.add_argument(
+        "-a",
+        "--adjust_tuning_pitches",
+        action="store_true",
+        help="whether to adjust the pitches for baroque tuning",
+    )
+    parser.add_argument(
+        "-m",
+        "--mode",
+        choices=("direct", "stretch"),
+        default="direct",
+        help="whether to synthesize each recording directly or to "
+        "time-stretch a cached synthesis at the reference tempo",
+    )
+    parser.add_argument(
+        "--reference_qpm",
+        type=float,
+        default=60,
+        help="reference tempo (in qpm) for the stretch mode",
+    )
+    parser.add_argument(
+        "-l", "--hop_length", type=int, default=512, help="hop length for CQT"
+    )
+    parser.add_argument(
+        "-b",
+        "--bins_per_note",
+        type=int,
+        default=3,
+        help="number of bins per note for CQT",
+    )
+    parser.add_argument(
+        "--float32",
+        action="store_true",
+        help="whether to compute the spectrograms in single precision",
+    )
+    parser.add_argument(
+        "-d", "--dtw", choices=dtw.ENGINES, default="full", help="DTW engine"
+    )
+    parser.add_argument(
+        "--dtw_radius",
+        type=int,
+        help="radius of the search band or window in frames for the band, "
+        "multiscale and online DTW engines",
+    )
+    parser.add_argument(
+        "--dtw_threads",
+        type=int,
+        help="number of threads for the full DTW engine (default: the "
+        "number of cores divided by the number of worker processes)",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=pathlib.Path,
+        help="cache directory for the notes and the stretch mode (default: "
+        "no cache for the notes, and `cache` in the output directory for the "
+        "stretch mode)",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=float,
+        help="maximum size of the cache in MB (default: no limit)",
+    )
+    parser.add_argument(
+        "--save_intermediate",
+        action="store_true",
+        help="whether to also save the sliced audio, notes, synthesized "
+        "audio and tempos",
+    )
+    parser.add_argument(
+        "-p", "--save_plot", action="store_true", help="save alignment plots"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="number of worker processes"
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=1,
+        help="number of rows to load ahead when running in a single process",
+    )
+    parser.add_argument(
+        "--largest_first",
+        action="store_true",
+        help="whether to process the longest movements first",
+    )
+    parser.add_argument(
+        "-s",
+        "--skip_existing",
+        action="store_true",
+        help="whether to skip existing files",
+    )
+    parser.add_argument(
+        "--report",
+        type=pathlib.Path,
+        help="filename of the JSON or CSV report of the timings and peak "
+        "memory of each row",
+    )
+    parser.add_argument(
+        "--profile_dir",
+        type=pathlib.Path,
+        help="directory to save the cProfile statistics of the slowest rows",
+    )
+    parser.add_argument(
+        "--profile_slowest",
+        type=int,
+        default=5,
+        help="number of slowest rows to save the cProfile statistics for",
+    )
+    parser.add_argument(
+        "-q", "--quiet", action="store_true", help="show warnings only"
+    )
+    return parser.parse_args(args=args, namespace=namespace)
+
+
+def read_csv(filename):
+    """Read a CSV file into a dictionary."""
+    with open(filename) as f:
+        reader = csv.DictReader(f)
+        data = [
+            {field: row[field] for field in reader.fieldnames}
+            for row in reader
+        ]
+    return data
+
+
+def get_filename(row, args, subdir, suffix):
+    """Return the output filename of a row in a subdirectory."""
+    return (
+        args.out_dir / subdir / row["collection"] / (row["filename"] + suffix)
+    )
+
+
+def load(row, args):
+    """Slice the recording and extract the notes of a row."""
+    if (
+        args.skip_existing
+        and get_filename(row, args, "alignment", ".csv").is_file()
+    ):
+        return None
+
+    # Slice the recording
+    source_filename = (
+        args.input_dir / "audio" / row["collection"] / row["source_filename"]
+    )
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if args.save_intermediate:
+            sliced_filename = get_filename(row, args, "wav-original", ".wav")
+            sliced_filename.parent.mkdir(parents=True, exist_ok=True)
+        else:
+            sliced_filename = pathlib.Path(temp_dir) / "sliced.wav"
+        with instrumentation.phase("ffmpeg"):
+            subprocess.check_output(
+                [
+                    "ffmpeg",
+                    "-loglevel",
+                    "error",
+                    "-y",
+                    "-ss",
+                    row["start"],
+                    "-to",
+                    row["end"],
+                    "-i",
+                    source_filename,
+                    sliced_filename,
+                ]
+            )
+        with instrumentation.phase("read"):
+            y, rate = sf.read(sliced_filename, dtype="int16", always_2d=True)
+
+    # Downmix to mono and downsample
+    with instrumentation.phase("resample"):
+        y = slice_audio.downmix(y, rate, args.rate)
+
+    # Extract the notes from the score
+    notes = process_scores.get_notes(row, args)
+
+    return y, notes
+
+
+def process(row, inputs, args):
+    """Synthesize the score of a row and align it to the recording."""
+    if inputs is None:
+        return "skipped"
+    y, notes = inputs
+    notes_csv = process_scores.format_notes(notes)
+
+    # Synthesize the score at the tempo that matches the recording
+    music = synthesize_scores.make_music(notes)
+    qpm = synthesize_scores.compute_qpm(music, args.rate, len(y))
+    if args.mode == "direct":
+        y_synth = synthesize_scores.synthesize(music, qpm, args.rate)
+    else:
+        y_synth = synthesize_scores.synthesize_stretched(
+            music, qpm, hashlib.sha1(notes_csv.encode()).hexdigest(), args
+        )
+
+    # Save the intermediate outputs
+    if args.save_intermediate:
+        with instrumentation.phase("write"):
+            for subdir in ("wav", "notes", "synth", "tempo"):
+                (args.out_dir / subdir / row["collection"]).mkdir(
+                    parents=True, exist_ok=True
+                )
+            sf.write(
+                get_filename(row, args, "wav", ".wav"),
+                y,
+                args.rate,
+                subtype="PCM_16",
+            )
+            with open(get_filename(row, args, "notes", ".csv"), "w") as f:
+                f.write(notes_csv)
+            sf.write(
+                get_filename(row, args, "synth", ".wav"), y_synth, args.rate
+            )
+            with open(get_filename(row, args, "tempo", ".txt"), "w") as f:
+                f.write(f"{qpm}\n")
+
+    # Compute spectrograms
+    dtype = "float32" if args.float32 else None
+    cqt_db = align_scores.compute_features(
+        y, args.rate, args.hop_length, args.bins_per_note, dtype
+    )
+    cqt_db_synth = align_scores.compute_features(
+        y_synth, args.rate, args.hop_length, args.bins_per_note, dtype
+    )
+
+    # Align the notes
+    warp_path, starts, ends = align_scores.align(
+        cqt_db,
+        cqt_db_synth,
+        args.rate,
+        args.rate,
+        notes[:, 0],
+        notes[:, 1],
+        args,
+    )
+    out_filename = get_filename(row, args, "alignment", ".csv")
+    out_filename.parent.mkdir(parents=True, exist_ok=True)
+    align_scores.write_alignment(out_filename, warp_path, starts, ends)
+
+    # Plot alignment
+    if args.save_plot:
+        align_scores.save_plots(
+            out_filename,
+            cqt_db,
+            cqt_db_synth,
+            args.rate,
+            warp_path,
+            notes[:, 2],
+            args,
+        )
+
+
+def load_and_process(row, args):
+    """Process a row end-to-end."""
+    return process(row, load(row, args), args)
+
+
+def main():
+    """Main function."""
+    # Parse the command-line arguments
+    args = parse_args()
+
+    # Make sure output directory exists
+    args.out_dir.mkdir(exist_ok=True)
+
+    # Set up the logger
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.ERROR if args.quiet else logging.INFO,
+        format="%(levelname)-8s %(message)s",
+    )
+
+    # Read the CSV file
+    logging.info("Reading the CSV file...")
+    data = read_csv(args.csv_filename)
+
+    # Share the cores among the worker processes
+    if args.dtw_threads is None:
+        args.dtw_threads = max(os.cpu_count() // args.jobs, 1)
+
+    # Iterate over rows
+    logging.info("Iterating over rows...")
+    report = instrumentation.make_report(args)
+    if args.jobs == 1:
+        results = parallel.run_prefetched(
+            load,
+            process,
+            data,
+            args,
+            args.prefetch,
+            args.largest_first,
+            report,
+        )
+    else:
+        results = parallel.run(
+            load_and_process, data, args, args.jobs, args.largest_first, report
+        )
+    n_failed = parallel.summarize(data, results)
+    instrumentation.save_report(report, args)
+
+    if n_failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Fixed-length training segments of aligned audio and notes."""
+import numpy as np
+
+import audio_store
+from audio_index import AudioIndex
+from dataset import LRUCache
+
+
+class IntervalIndex:
+    """Index for finding the intervals overlapping a query range.
+
+    The intervals are sorted by their starts, and the running maximum of
+    their ends is precomputed, so that a query takes logarithmic time plus
+    time linear in the number of candidate intervals.
+
+    Parameters
+    ----------
+    starts, ends : np.ndarray, shape=(n_intervals,)
+        Starts and ends of the intervals.
+
+    """
+
+    def __init__(self, starts, ends):
+        self.order = np.argsort(starts, kind="stable")
+        self.starts = np.asarray(starts)[self.order]
+        self.ends = np.asarray(ends)[self.order]
+        self.max_ends = np.maximum.accumulate(self.ends)
+
+    def query(self, start, end):
+        """Return the indices of the intervals overlapping `[start, end)`."""
+        hi = np.searchsorted(self.starts, end, side="left")
+        lo = np.searchsorted(self.max_ends[:hi], start, side="right")
+        candidates = np.arange(lo, hi)
+        return self.order[candidates[self.ends[lo:hi] > start]]
+
+
+class SegmentSampler:
+    """Sampler of fixed-length segments of aligned audio and notes.
+
+    The audio is read from the sliced recordings created by `slice_audio.py`
+    by seeking to the segment, and the notes are found by the interval index
+    of the aligned note times, so the cost of drawing a segment does not
+    depend on the length of the movement.
+
+    Parameters
+    ----------
+    dataset : dataset.BachViolinDataset
+        Dataset to sample from. Its `wav_dir` must be set.
+    duration : float
+        Duration of the segments in seconds.
+    seed : int, optional
+        Random seed.
+    cache_size : int
+        Maximum number of movements whose interval indexes are kept in
+        memory.
+
+    Examples
+    --------
+    >>> dataset = BachViolinDataset("bach-violin/", wav_dir="processed/wav/")
+    >>> sampler = SegmentSampler(dataset, duration=5.0)
+    >>> segment = sampler.sample()
+
+    """
+
+    def __init__(self, dataset, duration, seed=None, cache_size=128):
+        if dataset.wav_dir is None:
+            raise ValueError("The `wav_dir` of the dataset must be set.")
+        self.dataset = dataset
+        self.duration = duration
+        self.rng = np.random.default_rng(seed)
+        self._index_cache = LRUCache(cache_size)
+
+        # Get the lengths of the recordings from their headers
+        audio_index = AudioIndex(dataset.wav_dir)
+        self.rates = np.zeros(len(dataset), np.int64)
+        self.lengths = np.zeros(len(dataset), np.int64)
+        for i in range(len(dataset)):
+            self.rates[i], self.lengths[i] = audio_index.lookup(
+                self._get_wav_path(i)
+            )
+
+        # Weight each movement by the number of segment start positions
+        n_starts = np.maximum(
+            self.lengths - np.round(duration * self.rates) + 1, 0
+        )
+        if not n_starts.any():
+            raise ValueError("All recordings are shorter than the duration.")
+        self.weights = n_starts / n_starts.sum()
+
+    def _get_wav_path(self, i):
+        info = self.dataset[i]
+        return audio_store.find(
+            self.dataset.wav_dir
+            / info["collection"]
+            / (info["filename"] + ".wav")
+        )
+
+    def _get_interval_index(self, i):
+        alignment = self.dataset.get_alignment(i)
+        return IntervalIndex(alignment[:, 0], alignment[:, 1])
+
+    def get_segment(self, i, start):
+        """Return the segment of a movement starting at a given sample.
+
+        Returns a dictionary with the filename, the audio, the sampling
+        rate, the start time in seconds, the notes overlapping the segment
+        and their start and end times relative to the start of the segment.
+
+        """
+        rate = int(self.rates[i])
+        n_samples = int(round(self.duration * rate))
+        audio, _ = audio_store.read(
+            self._get_wav_path(i), start, start + n_samples
+        )
+        if audio.ndim > 1:
+            audio = audio.mean(axis=1)
+
+        # Find the notes overlapping the segment
+        start_sec = start / rate
+        interval_index = self._index_cache.get(i, self._get_interval_index)
+        indices = interval_index.query(start_sec, start_sec + self.duration)
+        alignment = self.dataset.get_alignment(i)
+        return {
+            "filename": self.dataset[i]["filename"],
+            "audio": audio,
+            "rate": rate,
+            "start": start_sec,
+            "notes": self.dataset.get_notes(i)[indices],
+            "note_starts": alignment[indices, 0] - start_sec,
+            "note_ends": alignment[indices, 1] - start_sec,
+        }
+
+    def sample(self):
+        """Return a random segment."""
+        i = self.rng.choice(len(self.weights), p=self.weights)
+        n_samples = int(round(self.duration * self.rates[i]))
+        start = self.rng.integers(0, self.lengths[i] - n_samples + 1)
+        return self.get_segment(i, int(start))
+
+    def __iter__(self):
+        while True:
+            yield self.sample()
@@ -5,8 +5,17 @@
 import pathlib
 import subprocess
 import sys
+import tempfile
+import traceback
 
-import tqdm
+import numpy as np
+import soundfile as sf
+
+import audio_store
+import instrumentation
+import parallel
+from audio_index import AudioIndex
+from manifest import Manifest, record, select_stale
 
 
 def parse_args(args=None, namespace=None):
@@ -36,18 +45,76 @@ def parse_args(args=None, namespace=None):
     parser.add_argument(
         "-r", "--rate", type=int, default=16000, help="sampling rate"
     )
+    parser.add_argument(
+        "-f",
+        "--audio_format",
+        choices=("wav", "flac"),
+        default="wav",
+        help="format of the sliced and downsampled audio, where FLAC files "
+        "are lossless, about half as large and seekable to any sample",
+    )
     parser.add_argument(
         "-m",
         "--save_mp3",
         action="store_true",
         help="whether to save MP3 files",
     )
+    parser.add_argument(
+        "-g",
+        "--grouped",
+        action="store_true",
+        help="whether to decode each source recording only once",
+    )
+    parser.add_argument(
+        "--concurrent",
+        action="store_true",
+        help="whether to run the FFmpeg and SoX commands of all rows "
+        "concurrently, up to `--jobs` at a time, unless `--grouped`",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=2,
+        help="number of times a failed command is retried with "
+        "`--concurrent`",
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="number of worker processes"
+    )
+    parser.add_argument(
+        "--largest_first",
+        action="store_true",
+        help="whether to process the longest movements first",
+    )
     parser.add_argument(
         "-s",
         "--skip_existing",
         action="store_true",
         help="whether to skip existing files",
     )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="whether to rebuild only the rows whose inputs or parameters "
+        "have changed",
+    )
+    parser.add_argument(
+        "--report",
+        type=pathlib.Path,
+        help="filename of the JSON or CSV report of the timings and peak "
+        "memory of each row",
+    )
+    parser.add_argument(
+        "--profile_dir",
+        type=pathlib.Path,
+        help="directory to save the cProfile statistics of the slowest rows",
+    )
+    parser.add_argument(
+        "--profile_slowest",
+        type=int,
+        default=5,
+        help="number of slowest rows to save the cProfile statistics for",
+    )
     parser.add_argument(
         "-q", "--quiet", action="store_true", help="show warnings only"
     )
@@ -65,49 +132,61 @@ def read_csv(filename):
     return data
 
 
-def main():
-    """Main function."""
-    # Parse the command-line arguments
-    args = parse_args()
+def get_audio_filename(row, args, subdir):
+    """Return the output audio filename of a row in a subdirectory."""
+    return (
+        args.out_dir
+        / subdir
+        / row["collection"]
+        / (row["filename"] + "." + args.audio_format)
+    )
 
-    # Make sure output directory exists
-    args.out_dir.mkdir(exist_ok=True)
-    (args.out_dir / "wav-original").mkdir(exist_ok=True)
-    (args.out_dir / "wav").mkdir(exist_ok=True)
-    if args.save_mp3 is not None:
-        (args.out_dir / "mp3").mkdir(exist_ok=True)
 
-    # Set up the logger
-    logging.basicConfig(
-        stream=sys.stdout,
-        level=logging.ERROR if args.quiet else logging.INFO,
-        format="%(levelname)-8s %(message)s",
+def get_mp3_command(filename, row, args):
+    """Return the command that encodes an audio file of a row into MP3."""
+    mp3_filename = (
+        args.out_dir / "mp3" / row["collection"] / (row["filename"] + ".mp3")
     )
+    mp3_filename.parent.mkdir(exist_ok=True)
+    return [
+        "ffmpeg",
+        "-loglevel",
+        "error",
+        "-y",
+        "-i",
+        filename,
+        "-b:a",
+        "192k",
+        mp3_filename,
+    ]
 
-    # Read the CSV file
-    logging.info("Reading the CSV file...")
-    data = read_csv(args.csv_filename)
 
-    # Iterate over rows
-    logging.info("Iterating over rows...")
-    pbar = tqdm.tqdm(data, ncols=120)
-    for row in pbar:
-        pbar.set_postfix_str(row["filename"])
-        source_filename = (
-            args.input_dir / row["collection"] / row["source_filename"]
-        )
-        out_filename = (
-            args.out_dir
-            / "wav-original"
-            / row["collection"]
-            / (row["filename"] + ".wav")
-        )
-        if args.skip_existing and out_filename.is_file():
-            continue
+def encode_mp3(filename, row, args):
+    """Encode an audio file into MP3."""
+    command = get_mp3_command(filename, row, args)
+    with instrumentation.phase("mp3"):
+        subprocess.check_output(command)
+
+
+def get_commands(row, args):
+    """Return the commands that process a row, with their phase names.
 
-        # Slice and convert to WAV
-        out_filename.parent.mkdir(exist_ok=True)
-        subprocess.check_output(
+    The recording is sliced and converted to WAV by FFmpeg, downmixed to
+    mono and downsampled by SoX, and encoded into MP3 by FFmpeg if
+    requested, each command reading the output of the previous one. The
+    output directories are created.
+
+    """
+    source_filename = (
+        args.input_dir / row["collection"] / row["source_filename"]
+    )
+    out_filename = get_audio_filename(row, args, "wav-original")
+    out_filename.parent.mkdir(exist_ok=True)
+    downsampled_filename = get_audio_filename(row, args, "wav")
+    downsampled_filename.parent.mkdir(exist_ok=True)
+    commands = [
+        (
+            "ffmpeg",
             [
                 "ffmpeg",
                 "-loglevel",
@@ -120,18 +199,10 @@ def main():
                 "-i",
                 source_filename,
                 out_filename,
-            ]
-        )
-
-        # Downmix to mono and downsample to 16 kHz
-        downsampled_filename = (
-            args.out_dir
-            / "wav"
-            / row["collection"]
-            / (row["filename"] + ".wav")
-        )
-        downsampled_filename.parent.mkdir(exist_ok=True)
-        subprocess.check_output(
+            ],
+        ),
+        (
+            "sox",
             [
                 "sox",
                 out_filename,
@@ -141,18 +212,158 @@ def main():
                 "rate",
                 "-s",
                 str(args.rate),
-            ]
+            ],
+        ),
+    ]
+    if args.save_mp3:
+        commands.append(
+            ("mp3", get_mp3_command(downsampled_filename, row, args))
+        )
+    return commands
+
+
+def process(row, args):
+    """Process a row."""
+    out_filename = get_audio_filename(row, args, "wav-original")
+    if args.skip_existing and out_filename.is_file():
+        return "skipped"
+
+    # Slice, downsample and encode the recording
+    for name, command in get_commands(row, args):
+        with instrumentation.phase(name):
+            subprocess.check_output(command)
+
+    # Add the seek tables of the FLAC files
+    with instrumentation.phase("seek_table"):
+        for subdir in ("wav-original", "wav"):
+            audio_store.add_seek_table(get_audio_filename(row, args, subdir))
+
+
+def process_concurrently(data, args, report=None):
+    """Process the rows with their commands run concurrently.
+
+    The commands of all rows are run as a dependency graph by
+    `parallel.run_commands`, so that the later commands of a row run while
+    the next rows are sliced.
+
+    Returns
+    -------
+    list of tuple
+        A `(result, error)` tuple for each row, in the same order as `data`.
+
+    """
+    order = list(range(len(data)))
+    if args.largest_first:
+        order.sort(
+            key=lambda i: parallel.parse_time(data[i]["length"]), reverse=True
         )
 
-        # Encode into MP3
-        if args.save_mp3 is not None:
-            mp3_filename = (
-                args.out_dir
-                / "mp3"
-                / row["collection"]
-                / (row["filename"] + ".mp3")
+    # Build the commands of the rows
+    results = [(None, None)] * len(data)
+    commands = []
+    row_commands = {}
+    for i in order:
+        out_filename = get_audio_filename(data[i], args, "wav-original")
+        if args.skip_existing and out_filename.is_file():
+            results[i] = ("skipped", None)
+            continue
+        row_commands[i] = []
+        for name, command_args in get_commands(data[i], args):
+            row_commands[i].append(
+                parallel.Command(
+                    command_args,
+                    data[i]["filename"],
+                    name,
+                    row_commands[i][-1:],
+                )
             )
-            mp3_filename.parent.mkdir(exist_ok=True)
+        commands.extend(row_commands[i])
+
+    # Run the commands
+    parallel.run_commands(commands, args.jobs, args.retries)
+
+    # Collect the results and the standard error outputs, with the peak
+    # memory of the largest command of each row as that of the row
+    for i, steps in row_commands.items():
+        for command in steps:
+            if command.error is None and command.stderr.strip():
+                logging.warning(
+                    f"The {command.name} of {command.key} printed :\n"
+                    f"{command.stderr}"
+                )
+        errors = [command.error for command in steps if command.error]
+        if errors:
+            results[i] = (None, errors[0])
+        else:
+            # Add the seek tables of the FLAC files
+            try:
+                for subdir in ("wav-original", "wav"):
+                    audio_store.add_seek_table(
+                        get_audio_filename(data[i], args, subdir)
+                    )
+            except Exception:  # pylint: disable=broad-except
+                results[i] = (None, traceback.format_exc())
+        if report is not None:
+            phases = {}
+            for command in steps:
+                phases[command.name] = (
+                    phases.get(command.name, 0.0) + command.time
+                )
+            report.add(
+                data[i]["filename"],
+                {
+                    "time": sum(phases.values()),
+                    "peak_rss": max(command.peak_rss for command in steps),
+                    "phases": phases,
+                },
+            )
+    return results
+
+
+def downmix(y, orig_rate, rate):
+    """Downmix 16-bit audio to mono and downsample it."""
+    import librosa
+
+    y_mono = y.mean(axis=1) / -np.iinfo(np.int16).min
+    y_mono = librosa.resample(y_mono, orig_sr=orig_rate, target_sr=rate)
+    return np.clip(y_mono, -1, 1)
+
+
+def group_by_source(data):
+    """Group the rows by their source recordings."""
+    groups = {}
+    for row in data:
+        key = (row["collection"], row["source_filename"])
+        if key not in groups:
+            groups[key] = {
+                "filename": row["source_filename"],
+                "collection": row["collection"],
+                "length": "0",
+                "rows": [],
+            }
+        groups[key]["rows"].append(row)
+        groups[key]["length"] = str(
+            parallel.parse_time(groups[key]["length"])
+            + parallel.parse_time(row["length"])
+        )
+    return list(groups.values())
+
+
+def process_group(group, args):
+    """Process all the rows sliced from the same source recording."""
+    rows = [
+        row
+        for row in group["rows"]
+        if not args.skip_existing
+        or not get_audio_filename(row, args, "wav-original").is_file()
+    ]
+    if not rows:
+        return "skipped"
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Decode the whole recording into WAV
+        decoded_filename = pathlib.Path(temp_dir) / "decoded.wav"
+        with instrumentation.phase("decode"):
             subprocess.check_output(
                 [
                     "ffmpeg",
@@ -160,13 +371,153 @@ def main():
                     "error",
                     "-y",
                     "-i",
-                    downsampled_filename,
-                    "-b:a",
-                    "192k",
-                    mp3_filename,
+                    args.input_dir / group["collection"] / group["filename"],
+                    decoded_filename,
                 ]
             )
 
+        with sf.SoundFile(decoded_filename) as f:
+            for row in rows:
+                # Slice the decoded recording
+                start = round(parallel.parse_time(row["start"]) * f.samplerate)
+                end = round(parallel.parse_time(row["end"]) * f.samplerate)
+                with instrumentation.phase("read"):
+                    f.seek(min(start, f.frames))
+                    y = f.read(end - start, dtype="int16", always_2d=True)
+                out_filename = get_audio_filename(row, args, "wav-original")
+                out_filename.parent.mkdir(exist_ok=True)
+                with instrumentation.phase("write"):
+                    audio_store.write(out_filename, y, f.samplerate)
+
+                # Downmix to mono and downsample
+                downsampled_filename = get_audio_filename(row, args, "wav")
+                downsampled_filename.parent.mkdir(exist_ok=True)
+                with instrumentation.phase("resample"):
+                    y_mono = downmix(y, f.samplerate, args.rate)
+                with instrumentation.phase("write"):
+                    audio_store.write(downsampled_filename, y_mono, args.rate)
+
+                # Encode into MP3
+                if args.save_mp3:
+                    encode_mp3(downsampled_filename, row, args)
+
+
+def get_dependencies(row, args, manifest):
+    """Return the hashes of the input files and the parameters of a row."""
+    return (
+        manifest.hash_file(
+            args.input_dir / row["collection"] / row["source_filename"]
+        ),
+        manifest.hash_file(__file__),
+        row["start"],
+        row["end"],
+        args.rate,
+        args.grouped,
+        args.audio_format,
+    )
+
+
+def get_outputs(row, args):
+    """Return the output filenames of a row."""
+    filenames = [
+        get_audio_filename(row, args, name) for name in ("wav-original", "wav")
+    ]
+    if args.save_mp3:
+        filenames.append(
+            args.out_dir
+            / "mp3"
+            / row["collection"]
+            / (row["filename"] + ".mp3")
+        )
+    return filenames
+
+
+def main(args=None):
+    """Main function."""
+    # Parse the command-line arguments
+    args = parse_args(args)
+
+    # Make sure output directory exists
+    args.out_dir.mkdir(exist_ok=True)
+    (args.out_dir / "wav-original").mkdir(exist_ok=True)
+    (args.out_dir / "wav").mkdir(exist_ok=True)
+    if args.save_mp3:
+        (args.out_dir / "mp3").mkdir(exist_ok=True)
+
+    # Set up the logger
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.ERROR if args.quiet else logging.INFO,
+        format="%(levelname)-8s %(message)s",
+    )
+
+    # Read the CSV file
+    logging.info("Reading the CSV file...")
+    data = read_csv(args.csv_filename)
+
+    # Select the rows whose outputs are out of date
+    if args.incremental:
+        manifest = Manifest(args.out_dir / "wav")
+        n_rows = len(data)
+        data, fingerprints = select_stale(
+            manifest, data, get_dependencies, get_outputs, args
+        )
+        logging.info(f"Found {n_rows - len(data)} up-to-date rows.")
+
+    # Set up the run report
+    report = instrumentation.make_report(args)
+
+    # Iterate over source recordings
+    if args.grouped:
+        logging.info("Iterating over source recordings...")
+        groups = group_by_source(data)
+        results = parallel.run(
+            process_group, groups, args, args.jobs, args.largest_first, report
+        )
+        n_failed = parallel.summarize(groups, results)
+
+        # Assign the result of each source recording to its rows
+        group_results = {
+            row["filename"]: result
+            for group, result in zip(groups, results)
+            for row in group["rows"]
+        }
+        results = [group_results[row["filename"]] for row in data]
+
+    # Run the commands of all rows concurrently
+    elif args.concurrent:
+        logging.info("Running the commands of all rows...")
+        results = process_concurrently(data, args, report)
+        n_failed = parallel.summarize(data, results)
+
+    # Iterate over rows
+    else:
+        logging.info("Iterating over rows...")
+        results = parallel.run(
+            process, data, args, args.jobs, args.largest_first, report
+        )
+        n_failed = parallel.summarize(data, results)
+
+    # Update the audio indexes
+    logging.info("Updating the audio indexes...")
+    for name in ("wav-original", "wav"):
+        index = AudioIndex(args.out_dir / name)
+        for row in data:
+            filename = get_audio_filename(row, args, name)
+            # Skip the empty FLAC files of empty slices, which have no header
+            if filename.is_file() and filename.stat().st_size:
+                index.lookup(filename)
+        index.save()
+
+    # Record the rows built successfully
+    if args.incremental:
+        record(manifest, data, fingerprints, results)
+
+    instrumentation.save_report(report, args)
+
+    if n_failed:
+        sys.exit(1)
+
 
 if __name__ == "__main__":
     main()
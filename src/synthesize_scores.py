@@ -5,11 +5,19 @@
 import pathlib
 import sys
 
-import librosa
-import muspy
 import numpy as np
 import soundfile as sf
-import tqdm
+
+import audio_store
+import instrumentation
+import parallel
+from audio_index import AudioIndex
+from cache import Cache, hash_file, make_key
+from manifest import Manifest, record, select_stale
+
+# Version of the synthesis, to be increased whenever it changes so that the
+# cached synthesized audio gets invalidated
+CACHE_VERSION = 1
 
 
 def parse_args(args=None, namespace=None):
@@ -36,12 +44,82 @@ def parse_args(args=None, namespace=None):
         required=True,
         help="output directory",
     )
+    parser.add_argument(
+        "-r", "--rate", type=int, default=16000, help="sampling rate"
+    )
+    parser.add_argument(
+        "-m",
+        "--mode",
+        choices=("direct", "stretch"),
+        default="direct",
+        help="whether to synthesize each recording directly or to "
+        "time-stretch a cached synthesis at the reference tempo",
+    )
+    parser.add_argument(
+        "--reference_qpm",
+        type=float,
+        default=60,
+        help="reference tempo (in qpm) for the stretch mode",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=pathlib.Path,
+        help="cache directory for the stretch mode (default: `cache` in the "
+        "output directory)",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=float,
+        help="maximum size of the cache in MB (default: no limit)",
+    )
+    parser.add_argument(
+        "--check_accuracy",
+        action="store_true",
+        help="whether to compare the time-stretched synthesis against the "
+        "direct synthesis",
+    )
+    parser.add_argument(
+        "--verify_length",
+        action="store_true",
+        help="whether to decode the recordings to verify their lengths",
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="number of worker processes"
+    )
+    parser.add_argument(
+        "--largest_first",
+        action="store_true",
+        help="whether to process the longest movements first",
+    )
     parser.add_argument(
         "-s",
         "--skip_existing",
         action="store_true",
         help="whether to skip existing files",
     )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="whether to rebuild only the rows whose inputs or parameters "
+        "have changed",
+    )
+    parser.add_argument(
+        "--report",
+        type=pathlib.Path,
+        help="filename of the JSON or CSV report of the timings and peak "
+        "memory of each row",
+    )
+    parser.add_argument(
+        "--profile_dir",
+        type=pathlib.Path,
+        help="directory to save the cProfile statistics of the slowest rows",
+    )
+    parser.add_argument(
+        "--profile_slowest",
+        type=int,
+        default=5,
+        help="number of slowest rows to save the cProfile statistics for",
+    )
     parser.add_argument(
         "-q", "--quiet", action="store_true", help="show warnings only"
     )
@@ -59,10 +137,200 @@ def read_csv(filename):
     return data
 
 
-def main():
+def make_music(notes):
+    """Create a music object from an array of notes.
+
+    The notes are given as an array of shape (n_notes, 4) holding the onset,
+    offset, pitch and velocity of each note.
+
+    """
+    import muspy
+
+    muspy_notes = [
+        muspy.Note(
+            time=int(onset),
+            pitch=int(pitch),
+            duration=int(offset) - int(onset),
+            velocity=int(velocity),
+        )
+        for onset, offset, pitch, velocity in notes
+    ]
+    track = muspy.Track(notes=muspy_notes)
+    return muspy.Music(resolution=24, tracks=[track])
+
+
+def compute_qpm(music, rate, n_samples):
+    """Return the global tempo that matches the length of a recording."""
+    return 60 * rate * music.get_end_time() / music.resolution / n_samples
+
+
+def synthesize(music, qpm, rate):
+    """Synthesize a music object at a global tempo into a mono waveform."""
+    import librosa
+    import muspy
+
+    music.tempos = [muspy.Tempo(time=0, qpm=qpm)]
+    with instrumentation.phase("render"):
+        y = muspy.synthesize(music, rate=rate)
+    return librosa.to_mono(y.T / np.iinfo(np.int16).max)
+
+
+def synthesize_stretched(music, qpm, notes_hash, args):
+    """Synthesize a music object by time-stretching a reference synthesis.
+
+    The music is synthesized once at the reference tempo, and the result is
+    cached by the hash of the notes file and time-stretched to the target
+    tempo. The cache defaults to `cache` in the output directory.
+
+    """
+    import librosa
+
+    cache = Cache(
+        args.out_dir / "cache" if args.cache_dir is None else args.cache_dir,
+        None if args.cache_size is None else int(args.cache_size * 2**20),
+    )
+    key = make_key(
+        notes_hash, "synth", args.rate, args.reference_qpm, CACHE_VERSION
+    )
+    with instrumentation.phase("cache"):
+        y_ref = cache.load(key)
+    if y_ref is None:
+        y_ref = synthesize(music, args.reference_qpm, args.rate)
+        with instrumentation.phase("cache"):
+            cache.save(key, y_ref.astype(np.float32))
+    with instrumentation.phase("stretch"):
+        return librosa.effects.time_stretch(
+            np.asarray(y_ref), rate=qpm / args.reference_qpm
+        )
+
+
+def compute_spectral_distance(y1, y2):
+    """Return the mean absolute difference between log spectrograms in dB."""
+    import librosa
+
+    spec1 = librosa.amplitude_to_db(np.abs(librosa.stft(y1)), ref=np.max)
+    spec2 = librosa.amplitude_to_db(np.abs(librosa.stft(y2)), ref=np.max)
+    n_frames = min(spec1.shape[1], spec2.shape[1])
+    return float(np.mean(np.abs(spec1[:, :n_frames] - spec2[:, :n_frames])))
+
+
+def process(row, args):
+    """Process a row."""
+    # Get directories
+    out_filename = (
+        args.out_dir / "synth" / row["collection"] / (row["filename"] + ".wav")
+    )
+    if args.skip_existing and out_filename.is_file():
+        return "skipped"
+
+    # Read the notes
+    notes_filename = (
+        args.input_dir
+        / "notes"
+        / row["collection"]
+        / (row["filename"] + ".csv")
+    )
+    with instrumentation.phase("read"):
+        notes = read_csv(notes_filename)
+    music = make_music(
+        [
+            (
+                int(note["onset"]),
+                int(note["offset"]),
+                int(note["pitch"]),
+                int(note["velocity"]),
+            )
+            for note in notes
+        ]
+    )
+
+    # Get the length of the recording
+    wav_filename = audio_store.find(
+        args.input_dir / "wav" / row["collection"] / (row["filename"] + ".wav")
+    )
+    rate, n_samples = AudioIndex(args.input_dir / "wav").lookup(wav_filename)
+    if args.verify_length:
+        import librosa
+
+        with instrumentation.phase("verify"):
+            y, _ = librosa.load(wav_filename, sr=None)
+        if len(y) != n_samples:
+            raise RuntimeError(
+                f"Expect {n_samples} samples in {wav_filename}, but got "
+                f"{len(y)}."
+            )
+
+    # Set a global tempo
+    qpm = compute_qpm(music, rate, n_samples)
+
+    # Synthesize the score
+    if args.mode == "direct":
+        y_synth = synthesize(music, qpm, args.rate)
+    else:
+        y_synth = synthesize_stretched(
+            music, qpm, hash_file(notes_filename), args
+        )
+    out_filename.parent.mkdir(exist_ok=True)
+    with instrumentation.phase("write"):
+        sf.write(out_filename, y_synth, args.rate)
+
+    # Write the tempo to a txt file
+    out_filename_tempo = (
+        args.out_dir / "tempo" / row["collection"] / (row["filename"] + ".txt")
+    )
+    out_filename_tempo.parent.mkdir(exist_ok=True)
+    with open(out_filename_tempo, "w") as f:
+        f.write(f"{qpm}\n")
+
+    # Compare against the direct synthesis
+    if args.mode == "stretch" and args.check_accuracy:
+        y_direct = synthesize(music, qpm, args.rate)
+        with instrumentation.phase("check"):
+            return compute_spectral_distance(y_synth, y_direct)
+
+
+def get_dependencies(row, args, manifest):
+    """Return the hashes of the input files and the parameters of a row."""
+    return (
+        manifest.hash_file(
+            args.input_dir
+            / "notes"
+            / row["collection"]
+            / (row["filename"] + ".csv")
+        ),
+        manifest.hash_file(
+            audio_store.find(
+                args.input_dir
+                / "wav"
+                / row["collection"]
+                / (row["filename"] + ".wav")
+            )
+        ),
+        manifest.hash_file(__file__),
+        args.rate,
+        args.mode,
+        args.reference_qpm if args.mode == "stretch" else None,
+    )
+
+
+def get_outputs(row, args):
+    """Return the output filenames of a row."""
+    return [
+        args.out_dir
+        / "synth"
+        / row["collection"]
+        / (row["filename"] + ".wav"),
+        args.out_dir
+        / "tempo"
+        / row["collection"]
+        / (row["filename"] + ".txt"),
+    ]
+
+
+def main(args=None):
     """Main function."""
     # Parse the command-line arguments
-    args = parse_args()
+    args = parse_args(args)
 
     # Make sure output directory exists
     args.out_dir.mkdir(exist_ok=True)
@@ -80,72 +348,41 @@ def main():
     logging.info("Reading the CSV file...")
     data = read_csv(args.csv_filename)
 
+    # Select the rows whose outputs are out of date
+    if args.incremental:
+        manifest = Manifest(args.out_dir / "synth")
+        n_rows = len(data)
+        data, fingerprints = select_stale(
+            manifest, data, get_dependencies, get_outputs, args
+        )
+        logging.info(f"Found {n_rows - len(data)} up-to-date rows.")
+
     # Iterate over rows
     logging.info("Iterating over rows...")
-    prog_bar = tqdm.tqdm(data, ncols=120)
-    for row in prog_bar:
-        # Append filename to progress bar
-        prog_bar.set_postfix_str(row["filename"])
-
-        # Get directories
-        out_filename = (
-            args.out_dir
-            / "synth"
-            / row["collection"]
-            / (row["filename"] + ".wav")
-        )
-        if args.skip_existing and out_filename.is_file():
-            continue
+    report = instrumentation.make_report(args)
+    results = parallel.run(
+        process, data, args, args.jobs, args.largest_first, report
+    )
 
-        # Read the notes
-        notes = read_csv(
-            args.input_dir
-            / "notes"
-            / row["collection"]
-            / (row["filename"] + ".csv"),
+    # Summarize the accuracy of the time-stretched synthesis
+    distances = [result for result, _ in results if isinstance(result, float)]
+    if distances:
+        logging.info(
+            "Spectral distance between the time-stretched and direct "
+            f"synthesis : mean={np.mean(distances):.2f} dB, "
+            f"max={np.max(distances):.2f} dB"
         )
-        muspy_notes = [
-            muspy.Note(
-                time=int(row["onset"]),
-                pitch=int(row["pitch"]),
-                duration=int(row["offset"]) - int(row["onset"]),
-                velocity=int(row["velocity"]),
-            )
-            for row in notes
-        ]
-        track = muspy.Track(notes=muspy_notes)
-        music = muspy.Music(resolution=24, tracks=[track])
 
-        # Load the audio
-        y, rate = librosa.load(
-            args.input_dir
-            / "wav"
-            / row["collection"]
-            / (row["filename"] + ".wav"),
-            sr=None,
-        )
+    n_failed = parallel.summarize(data, results)
 
-        # Set a global tempo
-        qpm = 60 * rate * music.get_end_time() / music.resolution / len(y)
-        music.tempos = [muspy.Tempo(time=0, qpm=qpm)]
+    # Record the rows built successfully
+    if args.incremental:
+        record(manifest, data, fingerprints, results)
 
-        # Synthesize the score
-        y_synth = librosa.to_mono(
-            muspy.synthesize(music, rate=args.rate).T / np.iinfo(np.int16).max
-        )
-        out_filename.parent.mkdir(exist_ok=True)
-        sf.write(out_filename, y_synth, args.rate)
+    instrumentation.save_report(report, args)
 
-        # Write the tempo to a txt file
-        out_filename_tempo = (
-            args.out_dir
-            / "tempo"
-            / row["collection"]
-            / (row["filename"] + ".txt")
-        )
-        out_filename_tempo.parent.mkdir(exist_ok=True)
-        with open(out_filename_tempo, "w") as f:
-            f.write(f"{qpm}\n")
+    if n_failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
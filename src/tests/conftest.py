@@ -0,0 +1,6 @@
+"""Test configuration."""
+import pathlib
+import sys
+
+# Make the scripts importable as modules
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
@@ -0,0 +1,25 @@
+"""Tests for `audio_store`."""
+import numpy as np
+
+import audio_store
+
+
+def test_read_range(tmp_path):
+    """Test that range reads of a FLAC file with a seek table are exact."""
+    filename = tmp_path / "a.flac"
+    y = np.random.default_rng(0).integers(-1000, 1000, (40000, 1), np.int16)
+    audio_store.write(filename, y, 16000)
+    with open(filename, "rb") as f:
+        # The seek table follows the STREAMINFO block
+        assert f.read(4 + 4 + 34 + 1)[-1] & 0x7F == audio_store._SEEKTABLE
+    for start, stop in ((0, 10), (12345, 23456), (39990, 50000)):
+        z, rate = audio_store.read(filename, start, stop, "int16", True)
+        assert rate == 16000
+        np.testing.assert_array_equal(z, y[start:stop])
+
+
+def test_write_empty(tmp_path):
+    """Test that writing audio without samples does not fail."""
+    filename = tmp_path / "a.flac"
+    audio_store.write(filename, np.zeros((0, 1), np.int16), 16000)
+    assert filename.is_file()
@@ -0,0 +1,55 @@
+"""Tests for `musicxml`."""
+import csv
+import pathlib
+
+import numpy as np
+import pytest
+
+import musicxml
+
+DATASET_DIR = pathlib.Path(__file__).resolve().parents[2] / "bach-violin"
+
+# Movements covering repeats, ties, chords, grace notes and tuplets
+SCORES = (
+    "bwv1001_mov1",
+    "bwv1001_mov4",
+    "bwv1002_mov2",
+    "bwv1004_mov5",
+    "bwv1006_mov1",
+)
+
+
+def get_rows():
+    """Return the first row of the dataset for each score tested."""
+    filename = DATASET_DIR / "info.csv"
+    if not filename.is_file():
+        return []
+    rows = {}
+    with open(filename, encoding="utf8") as f:
+        for row in csv.DictReader(f):
+            rows.setdefault(row["score_filename"], row)
+    return [rows[score] for score in SCORES if score in rows]
+
+
+@pytest.mark.parametrize(
+    "row", get_rows(), ids=lambda row: row["score_filename"]
+)
+def test_read_notes(row):
+    """Test that the notes match those bundled with the dataset."""
+    score_filename = (
+        DATASET_DIR
+        / "scores"
+        / row["work"].lower()
+        / f"{row['score_filename']}.mxl"
+    )
+    notes = musicxml.read_notes(score_filename)
+    if row["baroque_tuning"] == "1":
+        notes[:, 2] -= 1
+    expected = np.loadtxt(
+        DATASET_DIR / "notes" / row["collection"] / f"{row['filename']}.csv",
+        np.int64,
+        delimiter=",",
+        skiprows=1,
+        ndmin=2,
+    )
+    np.testing.assert_array_equal(notes, expected)
@@ -0,0 +1,110 @@
+"""Tests for `warping`."""
+import numpy as np
+import pytest
+
+import warping
+
+PATHS = {
+    "empty": np.zeros((0, 2), np.int64),
+    "single": np.array([[3, 5]]),
+    "diagonal": np.stack([np.arange(10), np.arange(10)], 1),
+    "mixed": np.array([[0, 0], [0, 1], [1, 2], [2, 2], [3, 2], [4, 3]]),
+}
+
+
+@pytest.mark.parametrize("name", PATHS)
+def test_encode_round_trip(name):
+    """Test that decoding an encoded path gives the path back."""
+    warp_path = PATHS[name]
+    encoded = warping.encode_path(warp_path)
+    assert encoded.dtype == np.int32
+    np.testing.assert_array_equal(warping.decode_path(encoded), warp_path)
+
+
+@pytest.mark.parametrize("name", PATHS)
+def test_save_round_trip(name, tmp_path):
+    """Test that loading a saved path gives the path back."""
+    warp_path = PATHS[name]
+    filename = tmp_path / "a.npy"
+    warping.save_path(filename, warp_path)
+    loaded = warping.load_path(filename)
+    assert loaded.shape == (len(warp_path), 2)
+    np.testing.assert_array_equal(loaded, warp_path)
+
+
+def test_load_legacy(tmp_path):
+    """Test that a path saved as its points by earlier versions loads."""
+    warp_path = PATHS["mixed"]
+    filename = tmp_path / "a.npy"
+    np.save(filename, warp_path.astype(np.int64))
+    loaded = warping.load_path(filename)
+    assert loaded.dtype == np.int64
+    np.testing.assert_array_equal(loaded, warp_path)
+
+
+@pytest.mark.parametrize("name", ["single", "diagonal", "mixed"])
+def test_to_recording_side(name):
+    """Test that snapping matches the note mapping of `align_scores`."""
+    warp_path = PATHS[name]
+    mapping = warping.WarpPath(warp_path)
+    frames_synth = np.arange(-2, warp_path[-1, 1] + 3, 0.5)
+    starts = np.clip(
+        np.searchsorted(warp_path[:, 1], frames_synth, side="right"),
+        0,
+        len(warp_path) - 1,
+    )
+    ends = np.clip(
+        np.searchsorted(warp_path[:, 1], frames_synth) - 1,
+        0,
+        len(warp_path) - 1,
+    )
+    np.testing.assert_array_equal(
+        mapping.to_recording(frames_synth, side="right"), warp_path[starts, 0]
+    )
+    np.testing.assert_array_equal(
+        mapping.to_recording(frames_synth, side="left"), warp_path[ends, 0]
+    )
+
+
+def test_to_recording_interpolate():
+    """Test the interpolation where the path stays on a synthesized frame."""
+    mapping = warping.WarpPath(PATHS["mixed"])
+    np.testing.assert_allclose(
+        mapping.to_recording([0, 1, 2, 2.5, 3]), [0, 0, 2, 3, 4]
+    )
+    np.testing.assert_allclose(mapping.to_synth([0, 2, 3.5]), [0.5, 2, 2.5])
+
+
+def test_inverse():
+    """Test that the mappings in both directions invert each other."""
+    mapping = warping.WarpPath(PATHS["diagonal"], hop_length=512, rate=16000)
+    frames = np.linspace(0, 9, 19)
+    np.testing.assert_allclose(
+        mapping.to_synth(mapping.to_recording(frames)), frames
+    )
+    np.testing.assert_allclose(
+        mapping.to_recording(mapping.to_synth(frames)), frames
+    )
+    # The score lasts 480 ticks, i.e., 48 ticks per frame
+    ticks = np.linspace(0, 432, 19)
+    seconds = mapping.ticks_to_seconds(ticks, 480)
+    np.testing.assert_allclose(seconds, ticks / 48 * 512 / 16000)
+    np.testing.assert_allclose(mapping.seconds_to_ticks(seconds, 480), ticks)
+
+
+def test_lazy_load(tmp_path):
+    """Test that the path is loaded from its file on the first query."""
+    filename = tmp_path / "a.npy"
+    mapping = warping.WarpPath(filename=filename)
+    warping.save_path(filename, PATHS["mixed"])
+    assert mapping.n_frames == 5
+    assert mapping.n_frames_synth == 4
+    np.testing.assert_array_equal(mapping.path, PATHS["mixed"])
+
+
+def test_errors():
+    """Test that invalid arguments raise errors."""
+    with pytest.raises(ValueError):
+        warping.WarpPath()
+    with pytest.raises(ValueError):
+        warping.WarpPath(PATHS["mixed"]).to_recording([1], side="middle")
@@ -0,0 +1,178 @@
+"""Compact storage of warping paths and mapping of times along them."""
+import numpy as np
+
+
+def encode_path(warp_path):
+    """Run-length encode a monotonic warping path into an int32 array.
+
+    The first row holds the first point of the path and the number of
+    points, and each next row holds a step between consecutive points and
+    the number of times it repeats. As a warping path mostly repeats the
+    same few steps, this is much smaller than the points themselves.
+
+    """
+    warp_path = np.asarray(warp_path, np.int64).reshape(-1, 2)
+    if not len(warp_path):
+        return np.zeros((1, 3), np.int32)
+    steps = np.diff(warp_path, axis=0)
+    starts = np.flatnonzero(
+        np.concatenate(([True], np.any(steps[1:] != steps[:-1], axis=1)))
+    )[: len(steps)]
+    counts = np.diff(np.append(starts, len(steps)))
+    encoded = np.empty((len(starts) + 1, 3), np.int64)
+    encoded[0] = (*warp_path[0], len(warp_path))
+    encoded[1:, :2] = steps[starts]
+    encoded[1:, 2] = counts
+    if np.abs(encoded).max() > np.iinfo(np.int32).max:
+        raise ValueError("The warping path is too long to encode.")
+    return encoded.astype(np.int32)
+
+
+def decode_path(encoded):
+    """Decode a warping path encoded by `encode_path`.
+
+    Returns an array of shape (n_points, 2).
+
+    """
+    n_points = int(encoded[0, 2])
+    warp_path = np.empty((n_points, 2), np.int64)
+    if not n_points:
+        return warp_path
+    warp_path[0] = encoded[0, :2]
+    steps = np.repeat(encoded[1:, :2], encoded[1:, 2], axis=0)
+    np.cumsum(steps, axis=0, out=warp_path[1:])
+    warp_path[1:] += warp_path[0]
+    return warp_path
+
+
+def save_path(filename, warp_path):
+    """Save a warping path encoded by `encode_path` to a NumPy file."""
+    np.save(filename, encode_path(warp_path))
+
+
+def load_path(filename):
+    """Load a warping path from a NumPy file.
+
+    Paths saved by earlier versions as their points are returned as is.
+
+    """
+    array = np.load(filename)
+    if array.ndim == 2 and array.shape[1] == 2:
+        return array.astype(np.int64)
+    return decode_path(array)
+
+
+def _compress(x, y):
+    """Return the distinct values of `x` with the mean of `y` at each.
+
+    The result can be interpolated with `np.interp` even where the path
+    stays on a frame of `x` for several frames of `y`.
+
+    """
+    values, indices, counts = np.unique(
+        x, return_index=True, return_counts=True
+    )
+    sums = np.add.reduceat(y.astype(float), indices)
+    return values, sums / counts
+
+
+class WarpPath:
+    """Mapping between the frames of a recording and its synthesized score.
+
+    The mapping is defined by a monotonic warping path between the
+    spectrograms of the recording and of the synthesized audio, with the
+    frames of the recording in the first column. The path is loaded from
+    its file on the first query only. As the synthesized audio lasts as
+    long as the recording, the score time in ticks is mapped to the frames
+    of the synthesized audio in proportion to the number of frames of the
+    recording, as in `align_scores.align`.
+
+    Parameters
+    ----------
+    path : np.ndarray, optional
+        Warping path of shape (n_points, 2), sorted in increasing order.
+    filename : str or Path, optional
+        NumPy file of the warping path, as saved by `save_path`. Either
+        `path` or `filename` must be given.
+    hop_length : int
+        Hop length of the spectrograms in samples.
+    rate : int
+        Sampling rate of the recording.
+
+    """
+
+    def __init__(self, path=None, filename=None, hop_length=512, rate=16000):
+        if path is None and filename is None:
+            raise ValueError("Either `path` or `filename` must be given.")
+        self.filename = filename
+        self.hop_length = hop_length
+        self.rate = rate
+        self._path = None if path is None else np.asarray(path)
+        self._forward = None
+        self._backward = None
+
+    @property
+    def path(self):
+        """Return the warping path, loading it if needed."""
+        if self._path is None:
+            self._path = load_path(self.filename)
+        return self._path
+
+    @property
+    def n_frames(self):
+        """Return the number of frames of the recording."""
+        return int(self.path[-1, 0]) + 1
+
+    @property
+    def n_frames_synth(self):
+        """Return the number of frames of the synthesized audio."""
+        return int(self.path[-1, 1]) + 1
+
+    def to_recording(self, frames_synth, side=None):
+        """Map frames of the synthesized audio to frames of the recording.
+
+        By default, the frames are interpolated linearly along the path.
+        Otherwise, each frame is snapped to the first point of the path past
+        it if `side` is "right", as for the starts of the notes, and to the
+        last point before it if `side` is "left", as for their ends.
+
+        """
+        frames_synth = np.asarray(frames_synth, float)
+        path = self.path
+        if side == "right":
+            indices = np.searchsorted(path[:, 1], frames_synth, side="right")
+        elif side == "left":
+            indices = np.searchsorted(path[:, 1], frames_synth) - 1
+        elif side is None:
+            if self._forward is None:
+                self._forward = _compress(path[:, 1], path[:, 0])
+            return np.interp(frames_synth, *self._forward)
+        else:
+            raise ValueError(f"Unknown side : {side}")
+        return path[np.clip(indices, 0, len(path) - 1), 0]
+
+    def to_synth(self, frames):
+        """Map frames of the recording to frames of the synthesized audio.
+
+        The frames are interpolated linearly along the path.
+
+        """
+        if self._backward is None:
+            self._backward = _compress(self.path[:, 0], self.path[:, 1])
+        return np.interp(np.asarray(frames, float), *self._backward)
+
+    def ticks_to_seconds(self, ticks, n_ticks, side=None):
+        """Map score times in ticks to times in the recording in seconds.
+
+        The score lasts `n_ticks` ticks, i.e., the last offset of its notes.
+        See `to_recording` for `side`.
+
+        """
+        frames_synth = np.asarray(ticks, float) * (self.n_frames / n_ticks)
+        frames = self.to_recording(frames_synth, side)
+        return frames * self.hop_length / self.rate
+
+    def seconds_to_ticks(self, seconds, n_ticks):
+        """Map times in the recording in seconds to score times in ticks."""
+        frames = np.asarray(seconds, float) * self.rate / self.hop_length
+        return self.to_synth(frames) * (n_ticks / self.n_frames)